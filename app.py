@@ -1,52 +1,94 @@
 import os
+import threading
 import streamlit as st
 import pandas as pd
-from movie_prediction.constants import PREDICTION, DATA_DIR, ACTORS_LINES_DEFAULT, UTTERANCE, PRINCIPAL
-from movie_prediction.data_loaders.processed import load_actor_movie_lines
+from movie_prediction.client import PrincipalPredictionClient, ServiceError
+from movie_prediction.constants import PREDICTION, DATA_DIR, PRINCIPALS_LINES_PARQUET_DEFAULT, UTTERANCE, PRINCIPAL
+from movie_prediction.data_loaders.sampling import LineSampler
 from movie_prediction.utils import sanitize_string
-from movie_prediction.wrappers import DistilBertForPrincipalPredictionWrapper
 
-DATA_PATH = DATA_DIR + '/' + ACTORS_LINES_DEFAULT
+DATA_PATH = os.environ.get('PRINCIPAL_LINES_PATH', DATA_DIR + '/' + PRINCIPALS_LINES_PARQUET_DEFAULT)
+# URL of the FastAPI service, when set the app is a thin client of it and loads no model
+API_URL = os.environ.get('PRINCIPAL_API_URL')
 
-@st.cache(allow_output_mutation=True)
+# Resources shared by every session of the app process, `st.cache` on Streamlit versions without `cache_resource`
+shared_resource = (getattr(st, 'cache_resource', None) or getattr(st, 'experimental_singleton', None)
+                   or st.cache(allow_output_mutation=True))
+
+
+@shared_resource
+def load_client():
+    return PrincipalPredictionClient(API_URL)
+
+
+@shared_resource
 def load_model_wrapper():
-    model_wrapper = DistilBertForPrincipalPredictionWrapper()
-    return model_wrapper
+    # Only imported when the app serves the model itself, torch is not needed in front of the service
+    from movie_prediction.cache import PredictionCache
+    from movie_prediction.wrappers import DistilBertForPrincipalPredictionWrapper
+    model_wrapper = DistilBertForPrincipalPredictionWrapper(cache=PredictionCache())
+    # Sessions run in their own threads, predict one at a time rather than oversubscribing the CPU
+    return model_wrapper, threading.Lock()
 
-@st.cache(allow_output_mutation=True)
-def load_dataset():
+
+@shared_resource
+def load_sampler():
     if os.path.isfile(DATA_PATH):
-        dataset = load_actor_movie_lines(DATA_PATH)
+        sampler = LineSampler(DATA_PATH)
     else:
-        dataset = None
-    return dataset
+        sampler = None
+    return sampler
+
+
+def predict(utterance: str, model: str = None):
+    if API_URL:
+        return load_client().predict(utterance, model=model)
+    model_wrapper, lock = load_model_wrapper()
+    with lock:
+        return model_wrapper.predict(utterance)
 
 
 if __name__ == '__main__':
     st.title('Movie Principal Prediction App')
     utterance = None
     sample_utterance = None
-    dataset = load_dataset()
+    sampler = load_sampler()
     button = False
     principal = None
+    model = None
+
+    if API_URL:
+        try:
+            model_names = list(load_client().models())
+        except (ServiceError, OSError) as e:
+            st.error(f"Prediction service at {API_URL} is unavailable: {e}")
+            st.stop()
+        if len(model_names) > 1:
+            model = st.selectbox('Model', model_names)
 
-    if dataset is not None:
+    if sampler is not None:
         button = st.button("Sample From Dataset")
     if button:
-        sample = dataset.sample(1)
-        sample_utterance = sample[UTTERANCE].values[0]
-        principal = sample[PRINCIPAL].values[0]
+        sample = sampler.sample()
+        if sample is not None:
+            sample_utterance = sample[UTTERANCE]
+            principal = sample[PRINCIPAL]
     text_utterance = st.text_input('Enter some text')
     utterance = sample_utterance or text_utterance
 
     if utterance:
-        model_wrapper = load_model_wrapper()
         st.info(utterance)
         if principal is not None:
             st.info(f"Principal Who Said This: {principal}")
 
         utterance = sanitize_string(utterance, upper=True, alphanumeric_only=True, strip=True, whitespace=True)
-        predicted = model_wrapper.predict(utterance)
+        try:
+            predicted = predict(utterance, model=model)
+        except ServiceError as e:
+            if e.status != 503:
+                raise
+            st.warning(f"The prediction service is not ready yet: {e.detail}")
+            st.stop()
         predicted = pd.DataFrame.from_dict(
             predicted, orient='index', columns=[PREDICTION])
         predicted[PREDICTION] = (100 * predicted[PREDICTION]).round(2).astype(str) + ' %'
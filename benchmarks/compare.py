@@ -0,0 +1,91 @@
+"""
+Compare two benchmark result files written by `benchmarks.run` and flag regressions:
+
+    python -m benchmarks.compare baseline.json candidate.json --threshold 0.1
+
+Exits with status 1 when a stage's throughput drops, or its median or p99 latency or peak memory grows,
+by more than the threshold.
+"""
+import sys
+import json
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+__all__ = ['compare_results', 'main']
+
+# Metric name, path in a stage result, whether higher is better
+_METRICS = [
+    ('throughput', ('throughput',), True),
+    ('p50_ms', ('latency_ms', 'p50'), False),
+    ('p99_ms', ('latency_ms', 'p99'), False),
+    ('peak_rss_mb', ('peak_rss_mb',), False),
+]
+
+
+def _lookup(result: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    for key in path:
+        if not isinstance(result, dict) or result.get(key) is None:
+            return None
+        result = result[key]
+    return result
+
+
+def compare_results(baseline: Dict[str, Any], candidate: Dict[str, Any],
+                    threshold: float = 0.1) -> List[Dict[str, Any]]:
+    """
+    Compare the stages two benchmark runs have in common.
+
+    :param baseline: Dict[str, Any]
+        Results of the reference run.
+    :param candidate: Dict[str, Any]
+        Results of the run to check.
+    :param threshold: float, default 0.1
+        Relative change beyond which a worse metric is a regression.
+    :return:
+        List[Dict[str, Any]]
+        One row per stage and metric with both values, their ratio and whether it regressed.
+    """
+    rows = []
+    for stage, base_result in baseline['stages'].items():
+        candidate_result = candidate['stages'].get(stage)
+        if candidate_result is None:
+            continue
+        for metric, path, higher_is_better in _METRICS:
+            base, new = _lookup(base_result, path), _lookup(candidate_result, path)
+            if base is None or new is None or base == 0:
+                continue
+            ratio = new / base
+            change = 1 - ratio if higher_is_better else ratio - 1
+            rows.append({'stage': stage, 'metric': metric, 'baseline': base, 'candidate': new, 'ratio': ratio,
+                         'regression': change > threshold})
+    return rows
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files and flag regressions.")
+    parser.add_argument('baseline', help="Results of the reference commit.")
+    parser.add_argument('candidate', help="Results of the commit to check.")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Tolerated relative change, default 10%%.")
+    args = parser.parse_args(argv)
+
+    results = []
+    for path in [args.baseline, args.candidate]:
+        with open(path) as results_file:
+            results.append(json.load(results_file))
+    baseline, candidate = results
+    print(f"Baseline {baseline['environment'].get('commit')} vs candidate {candidate['environment'].get('commit')}")
+    if baseline['config'].get('rows') != candidate['config'].get('rows'):
+        print(f"Warning: runs used {baseline['config'].get('rows')} and {candidate['config'].get('rows')} rows")
+
+    rows = compare_results(baseline, candidate, args.threshold)
+    print(f"{'stage':<28} {'metric':<12} {'baseline':>14} {'candidate':>14} {'ratio':>7}")
+    for row in rows:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f"{row['stage']:<28} {row['metric']:<12} {row['baseline']:>14.4g} {row['candidate']:>14.4g} "
+              f"{row['ratio']:>7.2f}{flag}")
+    if any(row['regression'] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
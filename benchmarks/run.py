@@ -0,0 +1,283 @@
+"""
+Benchmark the data loading, text processing and inference hot paths on synthetic data.
+
+Inputs are generated at the requested scale and the model is a tiny random DistilBERT, so the suite runs
+offline. Each stage runs in a fresh process, which isolates its peak memory and keeps module caches of one
+stage from flattering another:
+
+    python -m benchmarks.run --rows 100000 --output results.json
+
+Results are written as JSON with the commit they were measured on, compare two runs with `benchmarks.compare`.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+__all__ = ['STAGES', 'run_benchmarks', 'main']
+
+
+def _peak_rss_mb() -> Optional[float]:
+    # The high-water mark of the process' own memory, `ru_maxrss` keeps the parent's across fork and exec on Linux
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _summary(items: int, seconds: float, latencies: Optional[List[float]] = None) -> Dict[str, Any]:
+    result = {'items': items, 'seconds': seconds, 'throughput': items / seconds if seconds else None}
+    if latencies:
+        percentiles = np.percentile(latencies, [50, 90, 99]) * 1000
+        result['latency_ms'] = {
+            'p50': float(percentiles[0]), 'p90': float(percentiles[1]), 'p99': float(percentiles[2]),
+            'max': float(max(latencies)) * 1000}
+    return result
+
+
+def _time_calls(fn: Callable[[Any], Any], inputs: List[Any]) -> Dict[str, Any]:
+    latencies = []
+    start = time.perf_counter()
+    for item in inputs:
+        call_start = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - call_start)
+    return _summary(len(inputs), time.perf_counter() - start, latencies)
+
+
+def _time_repeats(fn: Callable[[], Any], items: int, repeats: int) -> Dict[str, Any]:
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return dict(_summary(items, float(np.median(seconds))), repeats=repeats)
+
+
+def _load_wrapper(config: Dict[str, Any]):
+    import torch
+    from movie_prediction.wrappers import DistilBertForPrincipalPredictionWrapper
+    if config['threads']:
+        torch.set_num_threads(config['threads'])
+    return DistilBertForPrincipalPredictionWrapper(model_path=config['model_dir'])
+
+
+def _bench_load_lines(config: Dict[str, Any]) -> Dict[str, Any]:
+    from movie_prediction.data_loaders.processed import load_principal_movie_lines
+    output_rows = []
+
+    def load():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            output_rows.append(len(load_principal_movie_lines(data_dir=config['data_dir'])))
+
+    return dict(_time_repeats(load, config['rows'], config['repeats']), output_rows=output_rows[-1])
+
+
+def _bench_sanitize_string_column(config: Dict[str, Any]) -> Dict[str, Any]:
+    import pandas as pd
+    from benchmarks.synthetic import synthetic_utterances
+    from movie_prediction.utils import sanitize_string_column
+    utterances = pd.Series(synthetic_utterances(config['rows'], config['seed']), dtype=object)
+    return _time_repeats(
+        lambda: sanitize_string_column(utterances, upper=True, alphanumeric_only=True, strip=True, whitespace=True),
+        len(utterances), config['repeats'])
+
+
+def _bench_sanitize_string(config: Dict[str, Any]) -> Dict[str, Any]:
+    from benchmarks.synthetic import synthetic_utterances
+    from movie_prediction.utils import sanitize_string
+    return _time_calls(sanitize_string, synthetic_utterances(config['calls'], config['seed']))
+
+
+def _bench_extract_names_column(config: Dict[str, Any]) -> Dict[str, Any]:
+    from benchmarks.synthetic import synthetic_names
+    from movie_prediction.utils import extract_names_column
+    names = synthetic_names(config['rows'], config['seed'])
+    return _time_repeats(lambda: extract_names_column(names), len(names), config['repeats'])
+
+
+def _bench_extract_names(config: Dict[str, Any]) -> Dict[str, Any]:
+    from benchmarks.synthetic import synthetic_names
+    from movie_prediction.utils import extract_names
+    return _time_calls(extract_names, synthetic_names(config['calls'], config['seed']).tolist())
+
+
+def _bench_predict(config: Dict[str, Any]) -> Dict[str, Any]:
+    from benchmarks.synthetic import synthetic_utterances
+    wrapper = _load_wrapper(config)
+    utterances = synthetic_utterances(config['requests'], config['seed'])
+    for utt in utterances[:10]:
+        wrapper.predict(utt)
+    return _time_calls(wrapper.predict, utterances)
+
+
+def _bench_predict_batch(config: Dict[str, Any]) -> Dict[str, Any]:
+    from benchmarks.synthetic import synthetic_utterances
+    wrapper = _load_wrapper(config)
+    utterances = synthetic_utterances(min(config['rows'], 100 * config['requests']), config['seed'])
+    wrapper.predict_batch(utterances[:100])
+    return _time_repeats(lambda: wrapper.predict_batch(utterances), len(utterances), config['repeats'])
+
+
+def _bench_http(config: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        from fastapi.testclient import TestClient
+    except (ImportError, RuntimeError) as e:
+        return {'skipped': f"FastAPI's TestClient is unavailable: {e}"}
+    from benchmarks.synthetic import synthetic_utterances
+
+    os.environ.update(PRINCIPAL_MODEL_PATH=config['model_dir'], PRINCIPAL_REQUEST_LOG_RATE='0')
+    sys.path.insert(0, REPO_DIR)
+    import main
+    # Unique utterances, so every request runs the model instead of hitting the cache
+    utterances = list(dict.fromkeys(synthetic_utterances(4 * config['requests'], config['seed'])))
+    utterances = utterances[:config['requests']]
+    with TestClient(main.app) as client:
+        main.model_loaded.wait()
+        if main.model_load_error is not None:
+            raise main.model_load_error
+        for utt in utterances[:10]:
+            client.get('/principal-prediction', params={'text': utt + ' warmup'})
+        result = _time_calls(
+            lambda utt: client.get('/principal-prediction', params={'text': utt}).raise_for_status(), utterances)
+    return dict(result, unique_requests=len(utterances))
+
+
+# Stage name: (benchmark function, what is counted as an item)
+STAGES = {
+    'load_principal_movie_lines': (_bench_load_lines, 'raw movie lines'),
+    'sanitize_string_column': (_bench_sanitize_string_column, 'utterances'),
+    'sanitize_string': (_bench_sanitize_string, 'calls'),
+    'extract_names_column': (_bench_extract_names_column, 'names'),
+    'extract_names': (_bench_extract_names, 'calls'),
+    'predict': (_bench_predict, 'calls'),
+    'predict_batch': (_bench_predict_batch, 'utterances'),
+    'http_principal_prediction': (_bench_http, 'requests'),
+}
+
+
+def _run_stage(name: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    sys.path.insert(0, REPO_DIR)
+    result = STAGES[name][0](config)
+    result['item'] = STAGES[name][1]
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def _environment() -> Dict[str, Any]:
+    def git(*args):
+        try:
+            return subprocess.run(['git'] + list(args), cwd=REPO_DIR, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+        except OSError:
+            return ''
+
+    import pandas
+    import torch
+    import transformers
+    return {
+        'commit': git('rev-parse', 'HEAD') or None,
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'transformers': transformers.__version__,
+        'pandas': pandas.__version__,
+    }
+
+
+def run_benchmarks(stages: List[str], rows: int = 10000, calls: int = 10000, requests: int = 500,
+                   repeats: int = 3, threads: Optional[int] = None, seed: int = 0,
+                   work_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Generate the synthetic inputs and run benchmark stages, each in a fresh process.
+
+    :param stages: List[str]
+        Names of the stages to run, see `STAGES`.
+    :param rows: int, default 10000
+        Number of raw movie lines, and of utterances or names processed by the column stages.
+    :param calls: int, default 10000
+        Number of calls timed by the single string stages.
+    :param requests: int, default 500
+        Number of single predictions and HTTP requests timed. Batch prediction scores up to 100 times more.
+    :param repeats: int, default 3
+        Number of runs of the bulk stages, the median is reported.
+    :param threads: int, optional
+        Number of torch threads of the inference stages, defaults to torch's choice.
+    :param seed: int, default 0
+        Seed of the synthetic data.
+    :param work_dir: str, optional
+        Directory the synthetic data and model are written to and reused from.
+    :return:
+        Dict[str, Any]
+        The configuration, the environment including the git commit, and the results of every stage.
+    """
+    from benchmarks.synthetic import write_raw_data
+    from benchmarks.tiny_model import write_tiny_model
+
+    work_dir = work_dir or os.path.join(tempfile.gettempdir(), 'movie_prediction_benchmarks')
+    config = dict(rows=rows, calls=calls, requests=requests, repeats=repeats, threads=threads, seed=seed,
+                  data_dir=os.path.join(work_dir, f'data-{rows}-{seed}'), model_dir=os.path.join(work_dir, 'model'))
+    if not os.path.isdir(config['data_dir']):
+        print(f"Writing {rows} synthetic movie lines to: {config['data_dir']}")
+        write_raw_data(config['data_dir'] + '.tmp', rows, seed=seed)
+        os.replace(config['data_dir'] + '.tmp', config['data_dir'])
+    write_tiny_model(config['model_dir'])
+
+    results = {'config': config, 'environment': _environment(), 'stages': {}}
+    context = multiprocessing.get_context('spawn')
+    for name in stages:
+        print(f"Running {name}...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results['stages'][name] = executor.submit(_run_stage, name, config).result()
+    return results
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the movie prediction hot paths on synthetic data.")
+    parser.add_argument('--stages', nargs='*', default=list(STAGES), choices=list(STAGES))
+    parser.add_argument('--rows', type=int, default=10000, help="Scale of the data stages, 10k to 10M.")
+    parser.add_argument('--calls', type=int, default=10000, help="Calls timed by the single string stages.")
+    parser.add_argument('--requests', type=int, default=500, help="Predictions timed by the inference stages.")
+    parser.add_argument('--repeats', type=int, default=3, help="Runs of the bulk stages, the median is reported.")
+    parser.add_argument('--threads', type=int, default=None, help="Torch threads of the inference stages.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=None, help="Directory for the synthetic data and model.")
+    parser.add_argument('--output', default=None, help="JSON file the results are written to.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.stages, rows=args.rows, calls=args.calls, requests=args.requests,
+                             repeats=args.repeats, threads=args.threads, seed=args.seed, work_dir=args.work_dir)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written to: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Measure how fast the serving app starts and check it against a time budget.
+
+Every measurement runs in a fresh interpreter, so module caches of earlier runs do not hide import costs:
+
+    python -m benchmarks.startup --model-path models/principal-prediction-tuned-inference-snapshot
+
+Reports the seconds to import the app, to load the model until `/ready` answers, and to answer the first
+prediction, and exits with status 1 when a budget is exceeded or the app imports a heavy module eagerly.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import Any, Dict, List, Optional
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_SECONDS = 1.0
+READY_BUDGET_SECONDS = 15.0
+
+# Modules the app must only import once the model loads
+HEAVY_MODULES = ['torch', 'transformers', 'pandas', 'pyarrow', 'onnxruntime']
+
+_PROBE = """
+import sys, json, time, asyncio
+start = time.perf_counter()
+import main
+result = {'import_seconds': time.perf_counter() - start,
+          'heavy_modules': [name for name in sys.argv[2:] if name in sys.modules]}
+
+async def serve():
+    await main.start_batcher()
+    await asyncio.get_running_loop().run_in_executor(None, main.model_loaded.wait)
+    result['ready_seconds'] = time.perf_counter() - start
+    result['load_error'] = repr(main.model_load_error) if main.model_load_error else None
+    if main.model_registry is not None:
+        first = time.perf_counter()
+        await main.principal_prediction('where are you going', top_k=None, min_prob=None, model=None)
+        result['first_prediction_seconds'] = time.perf_counter() - first
+    await main.stop_batcher()
+
+if sys.argv[1] == 'ready':
+    asyncio.run(serve())
+print(json.dumps(result))
+"""
+
+
+def _probe(mode: str, env: Dict[str, str]) -> Dict[str, Any]:
+    output = subprocess.run(
+        [sys.executable, '-c', _PROBE, mode] + HEAVY_MODULES,
+        cwd=REPO_DIR, env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_startup(model_path: Optional[str] = None, backend: str = 'fp32', repeats: int = 3) -> Dict[str, Any]:
+    """
+    Measure the startup of the serving app in fresh interpreters.
+
+    :param model_path: str, optional
+        Model or snapshot directory served, defaults to the app's default.
+    :param backend: str, default 'fp32'
+        Inference backend served.
+    :param repeats: int, default 3
+        Number of import measurements, the median is reported.
+    :return:
+        Dict[str, Any]
+        The median import seconds, the heavy modules imported with the app, and the seconds until the model
+        is ready and for the first prediction.
+    """
+    env = dict(os.environ, PRINCIPAL_BACKEND=backend, TOKENIZERS_PARALLELISM='false')
+    if model_path:
+        env['PRINCIPAL_MODEL_PATH'] = model_path
+    imports = [_probe('import', env) for _ in range(repeats)]
+    results = {
+        'import_seconds': statistics.median(run['import_seconds'] for run in imports),
+        'heavy_modules': imports[0]['heavy_modules'],
+    }
+    results.update({key: value for key, value in _probe('ready', env).items() if key not in results})
+    return results
+
+
+def check_budget(results: Dict[str, Any], import_budget: float = IMPORT_BUDGET_SECONDS,
+                 ready_budget: float = READY_BUDGET_SECONDS) -> List[str]:
+    """
+    List the ways startup measurements exceed their budget, empty when they are within it.
+    """
+    failures = []
+    if results['heavy_modules']:
+        failures.append(f"Importing the app imports {', '.join(results['heavy_modules'])}")
+    if results['import_seconds'] > import_budget:
+        failures.append(f"Import took {results['import_seconds']:.2f}s, the budget is {import_budget:.2f}s")
+    if results.get('load_error'):
+        failures.append(f"Model failed to load: {results['load_error']}")
+    elif results['ready_seconds'] > ready_budget:
+        failures.append(f"Ready after {results['ready_seconds']:.2f}s, the budget is {ready_budget:.2f}s")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Check the serving app's import and startup time budget.")
+    parser.add_argument('--model-path', default=None, help="Model or snapshot directory to serve.")
+    parser.add_argument('--backend', default='fp32', help="Inference backend: fp32, int8 or onnx.")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of import measurements.")
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_SECONDS)
+    parser.add_argument('--ready-budget', type=float, default=READY_BUDGET_SECONDS)
+    parser.add_argument('--output', default=None, help="JSON file the measurements are written to.")
+    args = parser.parse_args(argv)
+
+    results = measure_startup(args.model_path, args.backend, args.repeats)
+    results['failures'] = check_budget(results, args.import_budget, args.ready_budget)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if results['failures']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
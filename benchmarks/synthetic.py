@@ -0,0 +1,151 @@
+"""
+Synthetic inputs shaped like the IMDb extensive dataset and the Cornell movie dialog corpus.
+
+Files are written with the names, columns and formats the raw data loaders read, with characters named after
+the principals who play them so the loaders find matches. Generation is vectorized and scales to 10M lines.
+"""
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from movie_prediction.constants import (
+    IMDB_PRINCIPALS_FILE, IMDB_NAMES_FILE, IMDB_MOVIES_FILE, CORNELL_LINES_FILE, CORNELL_TITLES_FILE
+)
+
+__all__ = ['WORDS', 'FIRST_NAMES', 'LAST_NAMES', 'synthetic_utterances', 'synthetic_names', 'write_raw_data']
+
+WORDS = (
+    "i you he she we they it the a an and but or not no yes what where when why how who this that here there "
+    "is are was were be been have has had do does did can could will would should must go come get got make "
+    "know think want need see look tell say said take give find call keep let mean feel try leave stay run stop "
+    "wait listen talk work help love kill die live man woman boy girl kid guy friend father mother brother "
+    "sister baby money time day night home house car door gun phone police job life world way thing nothing "
+    "something everything anything right wrong good bad great sorry okay please thanks well now then just "
+    "really never always again still only very too much more back out up down over off in on at to from with"
+).split()
+FIRST_NAMES = (
+    "JOHN JACK MARY ANNE BOB TOM JOE DAN KATE SARAH MIKE NICK SAM LUCY PAUL FRANK RACHEL DAVID LAURA PETER "
+    "HARRY EMMA GEORGE ALICE HENRY GRACE MAX RUTH LEO NORA"
+).split()
+LAST_NAMES = (
+    "SMITH DOE BROWN LEE RAY JONES MILLER DAVIS WILSON MOORE TAYLOR CLARK HALL YOUNG KING WRIGHT SCOTT GREEN "
+    "BAKER ADAMS"
+).split()
+_TITLE_PREFIXES = ['', '', '', '', 'MR ', 'MS ', 'MRS ', 'LT ', 'MISS ']
+_PUNCTUATION = ['.', '.', '?', '!', ',', ' ...', '']
+
+# Principals cast per movie
+_CAST_SIZE = 8
+
+
+def synthetic_utterances(n: int, seed: int = 0, max_words: int = 24) -> List[str]:
+    """
+    Generate movie-line-like utterances of 1 to `max_words` words.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.minimum(rng.geometric(0.12, n), max_words)
+    words = np.array(WORDS, dtype=object)[rng.integers(len(WORDS), size=int(lengths.sum()))]
+    punctuation = np.array(_PUNCTUATION, dtype=object)[rng.integers(len(_PUNCTUATION), size=n)]
+    ends = np.cumsum(lengths)
+    return [' '.join(words[end - length:end]) + mark for end, length, mark in zip(ends, lengths, punctuation)]
+
+
+def synthetic_names(n: int, seed: int = 0) -> pd.Series:
+    """
+    Generate sanitized character names: first names with optional title prefixes, last and middle names.
+    """
+    rng = np.random.default_rng(seed)
+    first = pd.Series(np.array(FIRST_NAMES, dtype=object)[rng.integers(len(FIRST_NAMES), size=n)])
+    last = pd.Series(np.array(LAST_NAMES, dtype=object)[rng.integers(len(LAST_NAMES), size=n)])
+    prefix = pd.Series(np.array(_TITLE_PREFIXES, dtype=object)[rng.integers(len(_TITLE_PREFIXES), size=n)])
+    parts = rng.integers(3, size=n)
+    names = prefix + first
+    names[parts >= 1] = names + ' ' + last
+    names[parts == 2] = names + ' ' + last.sample(frac=1, random_state=seed).values
+    return names
+
+
+def _makedirs(data_dir: str, name: str) -> str:
+    path = os.path.join(data_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def write_raw_data(data_dir: str, num_lines: int, lines_per_movie: int = 300, seed: int = 0) -> str:
+    """
+    Write synthetic raw IMDb and Cornell files for `num_lines` movie lines to `data_dir`.
+
+    :param data_dir: str
+        Directory to write the raw datasets to, laid out like `DATA_DIR`.
+    :param num_lines: int
+        Number of Cornell movie lines.
+    :param lines_per_movie: int, default 300
+        Number of lines per movie, which sets the number of movies and principals.
+    :param seed: int, default 0
+        Seed of the generator, the same arguments write the same files.
+    :return:
+        str
+        The data directory.
+    """
+    rng = np.random.default_rng(seed)
+    num_movies = max(1, -(-num_lines // lines_per_movie))
+    num_actors = max(50, num_movies * 2)
+    first_names = np.array(FIRST_NAMES, dtype=object)
+    last_names = np.array(LAST_NAMES, dtype=object)
+
+    # IMDb principals, movies and their casts
+    name_ids = pd.Series(np.arange(num_actors)).map('nm{:07d}'.format)
+    birth_names = (first_names[rng.integers(len(first_names), size=num_actors)] + ' '
+                   + last_names[rng.integers(len(last_names), size=num_actors)]
+                   + ' ' + pd.Series(np.arange(num_actors)).map('{:d}'.format).values)
+    pd.DataFrame({'imdb_name_id': name_ids, 'name': birth_names, 'birth_name': birth_names}).to_csv(
+        _makedirs(data_dir, IMDB_NAMES_FILE), index=False)
+
+    title_ids = pd.Series(np.arange(num_movies)).map('tt{:07d}'.format)
+    titles = pd.Series(np.arange(num_movies)).map('Movie Title {:d}'.format)
+    years = rng.integers(1930, 2011, size=num_movies)
+    pd.DataFrame({'imdb_title_id': title_ids, 'title': titles, 'original_title': titles, 'year': years}).to_csv(
+        _makedirs(data_dir, IMDB_MOVIES_FILE), index=False)
+
+    cast_first = first_names[rng.integers(len(first_names), size=num_movies * _CAST_SIZE)]
+    cast_last = last_names[rng.integers(len(last_names), size=num_movies * _CAST_SIZE)]
+    categories = rng.choice(['actor', 'actress', 'director', 'writer'], p=[.45, .45, .05, .05],
+                            size=num_movies * _CAST_SIZE)
+    pd.DataFrame({
+        'imdb_title_id': np.repeat(title_ids.values, _CAST_SIZE),
+        'ordering': np.tile(np.arange(1, _CAST_SIZE + 1), num_movies),
+        'imdb_name_id': name_ids.values[rng.integers(num_actors, size=num_movies * _CAST_SIZE)],
+        'category': categories,
+        'job': '',
+        'characters': '["' + cast_first + ' ' + cast_last + '"]',
+    }).to_csv(_makedirs(data_dir, IMDB_PRINCIPALS_FILE), index=False)
+
+    # Cornell titles and lines, spoken by cast characters or by extras, sometimes by first name only
+    pd.DataFrame({
+        'movieID': pd.Series(np.arange(num_movies)).map('m{:d}'.format),
+        'movie title': titles.str.lower(),
+        'movie year': years,
+        'IMDB rating': np.round(rng.uniform(1, 10, size=num_movies), 1),
+        'IMDB votes': rng.integers(10, 100000, size=num_movies),
+        'genres': "['drama']",
+    }).to_csv(_makedirs(data_dir, CORNELL_TITLES_FILE), sep='\t', header=False, index=False)
+
+    movies = np.arange(num_lines) // lines_per_movie
+    speakers = movies * _CAST_SIZE + rng.integers(_CAST_SIZE, size=num_lines)
+    speaker_names = cast_first[speakers] + ' ' + cast_last[speakers]
+    first_only = rng.random(num_lines) < 0.5
+    speaker_names[first_only] = cast_first[speakers[first_only]]
+    extras = rng.random(num_lines) < 0.2
+    speaker_names[extras] = 'EXTRA ' + first_names[rng.integers(len(first_names), size=int(extras.sum()))]
+
+    pool = np.array(synthetic_utterances(min(num_lines, 100000), seed), dtype=object)
+    pd.DataFrame({
+        'lineID': pd.Series(np.arange(num_lines)).map('L{:d}'.format),
+        'characterID': pd.Series(speakers).map('u{:d}'.format),
+        'movieID': pd.Series(movies).map('m{:d}'.format),
+        'character name': speaker_names,
+        'utterance': pool[rng.integers(len(pool), size=num_lines)],
+    }).to_csv(_makedirs(data_dir, CORNELL_LINES_FILE), sep='\t', header=False, index=False)
+    return data_dir
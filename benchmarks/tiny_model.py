@@ -0,0 +1,57 @@
+"""
+A tiny randomly initialized DistilBERT principal prediction model with a local vocabulary.
+
+The model is written as a serving snapshot, see `movie_prediction.snapshot`, so the model wrapper and the app
+load it offline without downloading weights or a tokenizer.
+"""
+import os
+
+from transformers import DistilBertConfig, DistilBertTokenizerFast
+
+from benchmarks.synthetic import WORDS, FIRST_NAMES, LAST_NAMES
+from movie_prediction.models import DistilBertForPrincipalPrediction
+
+__all__ = ['write_tiny_model']
+
+_SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+
+
+def write_tiny_model(output_dir: str, num_labels: int = 100, dim: int = 64, n_layers: int = 2, n_heads: int = 2,
+                     seed: int = 0) -> str:
+    """
+    Write a randomly initialized model and its tokenizer to `output_dir`, unless it is already there.
+
+    :param output_dir: str
+        Directory of the model snapshot.
+    :param num_labels: int, default 100
+        Number of principals predicted.
+    :param dim: int, default 64
+        Hidden size, the feed forward layers are four times wider.
+    :param n_layers: int, default 2
+        Number of transformer layers.
+    :param n_heads: int, default 2
+        Number of attention heads.
+    :param seed: int, default 0
+        Seed of the weight initialization.
+    :return:
+        str
+        The snapshot directory.
+    """
+    if os.path.isfile(os.path.join(output_dir, 'model.safetensors')):
+        return output_dir
+    import torch
+    os.makedirs(output_dir, exist_ok=True)
+
+    vocab = _SPECIAL_TOKENS + sorted(set(WORDS) | {name.lower() for name in FIRST_NAMES + LAST_NAMES})
+    vocab_fp = os.path.join(output_dir, 'vocab.txt')
+    with open(vocab_fp, 'w') as vocab_file:
+        vocab_file.write('\n'.join(vocab) + '\n')
+    DistilBertTokenizerFast(vocab_file=vocab_fp).save_pretrained(output_dir)
+
+    torch.manual_seed(seed)
+    labels = [f'PRINCIPAL {i}' for i in range(num_labels)]
+    config = DistilBertConfig(
+        vocab_size=len(vocab), dim=dim, hidden_dim=4 * dim, n_layers=n_layers, n_heads=n_heads,
+        num_labels=num_labels, id2label=dict(enumerate(labels)), label2id={label: i for i, label in enumerate(labels)})
+    DistilBertForPrincipalPrediction(config).save_pretrained(output_dir, safe_serialization=True)
+    return output_dir
@@ -1,9 +1,24 @@
+import os
 import sys
+import time
+import asyncio
+import random
 import logging
-from fastapi import FastAPI
-from fastapi.logger import logger as fastapi_logger
+import threading
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from movie_prediction.batching import MicroBatcher
+from movie_prediction.cache import PredictionCache
+from movie_prediction.constants import (
+    BATCH_SIZE_DEFAULT, BATCH_WAIT_MS_DEFAULT, BATCH_REQUEST_MAX_TEXTS_DEFAULT, CACHE_SIZE_DEFAULT,
+    DATA_DIR, MODEL_DIR, LINE_INDEX_DEFAULT, SIMILAR_LINES_DEFAULT, SIMILAR_LINES_MAX, REQUEST_LOG_RATE_DEFAULT,
+    PRINC_PRED_MODEL_TUNED_INF
+)
+from movie_prediction.metrics import METRICS, STAGE_SECONDS
+from movie_prediction.registry import ModelRegistry, default_models
 from movie_prediction.utils import sanitize_string
-from movie_prediction.wrappers import DistilBertForPrincipalPredictionWrapper
 
 app = FastAPI()
 
@@ -12,8 +27,172 @@ logging.getLogger("uvicorn.error").propagate = False
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Setup model wrapper
-model_wrapper = DistilBertForPrincipalPredictionWrapper()
+# Share of request texts logged, logging every request is costly and fills the logs with user input
+request_log_rate = float(os.environ.get('PRINCIPAL_REQUEST_LOG_RATE', REQUEST_LOG_RATE_DEFAULT))
+
+# Setup metrics, exported on `/metrics` and disabled with PRINCIPAL_METRICS=0
+REQUESTS = METRICS.counter('principal_requests_total', "HTTP requests by endpoint and status.", ['endpoint', 'status'])
+REQUEST_SECONDS = METRICS.histogram('principal_request_seconds', "HTTP request latency by endpoint.", ['endpoint'])
+CACHE_HITS = METRICS.counter('principal_cache_hits_total', "Prediction requests answered from the cache.")
+
+# Setup prediction cache and model registry
+cache_ttl = os.environ.get('PRINCIPAL_CACHE_TTL')
+prediction_cache = PredictionCache(
+    max_size=int(os.environ.get('PRINCIPAL_CACHE_SIZE', CACHE_SIZE_DEFAULT)),
+    ttl=float(cache_ttl) if cache_ttl else None,
+    disk_path=os.environ.get('PRINCIPAL_CACHE_PATH'))
+
+# The model registry is created and the default model loaded in the background at startup, see `/ready`
+model_registry = None
+model_load_error = None
+model_load_seconds = None
+model_loaded = threading.Event()
+
+
+def registered_models():
+    """
+    The served models by name, and the default model's name. Models are the variants found in the model
+    directory, `PRINCIPAL_MODEL_PATH` for the default model, and `PRINCIPAL_MODELS`, comma separated name=path pairs.
+    """
+    models = default_models()
+    default = os.environ.get('PRINCIPAL_DEFAULT_MODEL', PRINC_PRED_MODEL_TUNED_INF)
+    if os.environ.get('PRINCIPAL_MODEL_PATH'):
+        models[default] = os.environ['PRINCIPAL_MODEL_PATH']
+    for pair in filter(None, os.environ.get('PRINCIPAL_MODELS', '').split(',')):
+        name, _, path = pair.partition('=')
+        models[name.strip()] = path.strip()
+    # Register the default model even when it is missing, so the load error says where it was looked for
+    models.setdefault(default, MODEL_DIR + '/' + default)
+    return models, default
+
+
+def load_model():
+    """
+    Create the model registry and load the default model and the similar lines index. torch and transformers
+    are only imported here, so importing the app and answering `/ready` stay fast while the model loads.
+    """
+    global model_registry, model_load_error, model_load_seconds
+    start = time.perf_counter()
+    try:
+        from movie_prediction.search import LineIndex
+
+        models, default = registered_models()
+        memory_budget = os.environ.get('PRINCIPAL_MEMORY_BUDGET_MB')
+        registry = ModelRegistry(
+            models, default=default, backend=os.environ.get('PRINCIPAL_BACKEND', 'fp32'),
+            memory_budget_mb=float(memory_budget) if memory_budget else None, cache=prediction_cache)
+        # Load the similar lines index of the default model if it was built
+        line_index_path = os.environ.get('PRINCIPAL_LINE_INDEX', DATA_DIR + '/' + LINE_INDEX_DEFAULT)
+        if os.path.isdir(line_index_path):
+            registry.register(default, models[default], line_index=LineIndex.load(line_index_path))
+        registry.get()
+        model_registry = registry
+        model_load_seconds = time.perf_counter() - start
+        logger.info(f"Model loaded in {model_load_seconds:.2f}s, serving {registry.names}")
+    except Exception as e:
+        logger.exception("Model failed to load")
+        model_load_error = e
+    finally:
+        model_loaded.set()
+
+
+def ready_registry() -> ModelRegistry:
+    """
+    Return the model registry, or answer 503 while the default model is loading or if it failed to load.
+    """
+    if model_registry is None:
+        detail = f"Model failed to load: {model_load_error!r}" if model_load_error else "Model is loading"
+        raise HTTPException(status_code=503, detail=detail)
+    return model_registry
+
+
+async def ready_wrapper(model: Optional[str] = None):
+    """
+    Return the wrapper of a model, loading it in a worker thread if needed so other requests are not blocked.
+    Answers 404 for unknown models and 503 if the model fails to load.
+    """
+    registry = ready_registry()
+    try:
+        wrapper = registry.get(model, load=False)
+        if wrapper is None:
+            wrapper = await asyncio.get_running_loop().run_in_executor(None, registry.get, model)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    except Exception as e:
+        logger.exception(f"Model {model} failed to load")
+        raise HTTPException(status_code=503, detail=f"Model {model} failed to load: {e!r}")
+    return wrapper
+
+
+def log_request(kind: str, text: str):
+    """
+    Log the text of a sample of requests, at `request_log_rate`.
+    """
+    if request_log_rate > 0 and random.random() < request_log_rate:
+        logger.info("%s REQUEST|%s", kind, text)
+
+
+# Setup request batching
+def predict_requests(requests):
+    """
+    Predict a batch of (wrapper, text, top_k, min_prob) requests, with one model call per model and output mode.
+    Requests hold the model version they were accepted with, so a hot swap does not disturb them.
+    """
+    groups = {}
+    for i, (wrapper, _, top_k, min_prob) in enumerate(requests):
+        groups.setdefault((wrapper, top_k, min_prob), []).append(i)
+    predictions = [None] * len(requests)
+    for (wrapper, top_k, min_prob), indices in groups.items():
+        texts = [requests[i][1] for i in indices]
+        for i, prediction in zip(indices, wrapper.predict_batch(texts, top_k=top_k, min_prob=min_prob)):
+            predictions[i] = prediction
+    return predictions
+
+
+batcher = MicroBatcher(
+    predict_requests,
+    max_batch_size=int(os.environ.get('PRINCIPAL_BATCH_SIZE', BATCH_SIZE_DEFAULT)),
+    max_wait_ms=float(os.environ.get('PRINCIPAL_BATCH_WAIT_MS', BATCH_WAIT_MS_DEFAULT)))
+# Largest number of texts accepted by one `/principal-prediction/batch` request
+batch_max_texts = int(os.environ.get('PRINCIPAL_BATCH_MAX_TEXTS', BATCH_REQUEST_MAX_TEXTS_DEFAULT))
+
+
+class PredictionBatch(BaseModel):
+    texts: List[str]
+    top_k: Optional[int] = Field(None, ge=1)
+    min_prob: Optional[float] = Field(None, ge=0, le=1)
+    model: Optional[str] = None
+
+
+@app.on_event("startup")
+async def start_batcher():
+    threading.Thread(target=load_model, name='model-loader', daemon=True).start()
+    await batcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await batcher.stop()
+    # Write the predictions still queued for the disk cache
+    prediction_cache.close()
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    if not METRICS.enabled:
+        return await call_next(request)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template so path parameters do not create new series
+        route = request.scope.get('route')
+        endpoint = route.path if route is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status=status)
 
 
 @app.get("/")
@@ -22,9 +201,105 @@ async def root():
     return {"Warning": "This endpoint does nothing."}
 
 
+@app.get("/ready")
+async def ready():
+    registry = ready_registry()
+    wrapper = registry.get(load=False)
+    return {"ready": True, "model": registry.default, "model_id": wrapper.model_id if wrapper else None,
+            "backend": registry.backend, "load_seconds": model_load_seconds,
+            "loaded_models": [name for name in registry.names if registry.get(name, load=False) is not None]}
+
+
 @app.get("/principal-prediction")
-async def principal_prediction(text: str):
-    logging.info(f"PRINCIPAL PREDICTION REQUEST|{text}")
-    return model_wrapper.predict(
-        sanitize_string(text))
+async def principal_prediction(text: str, top_k: Optional[int] = Query(None, ge=1),
+                               min_prob: Optional[float] = Query(None, ge=0, le=1),
+                               model: Optional[str] = None):
+    """
+    Predict the principals who may have said `text`, by descending probability. `top_k` keeps only the most
+    probable principals and `min_prob` drops the improbable ones, which keeps responses small for large heads.
+    `model` names the model variant to ask, see `/models`, and defaults to the default model.
+    """
+    log_request("PRINCIPAL PREDICTION", text)
+    wrapper = await ready_wrapper(model)
+    with STAGE_SECONDS.time(stage='sanitize'):
+        text = sanitize_string(text)
+    # Only the memory tier is looked up on the event loop, the batcher looks the disk tier up and counts misses
+    cached = wrapper.cached_prediction(text, top_k, min_prob, memory_only=True)
+    if cached is not None:
+        CACHE_HITS.inc()
+        return cached
+    return await batcher.submit((wrapper, text, top_k, min_prob))
+
+
+@app.post("/principal-prediction/batch")
+async def principal_prediction_batch(batch: PredictionBatch):
+    """
+    Predict the principals of several texts in one request, answered in the order of `texts`. Cached texts are
+    answered from the cache and the others share the micro-batches of concurrent `/principal-prediction` requests.
+    """
+    if len(batch.texts) > batch_max_texts:
+        raise HTTPException(status_code=422, detail=f"At most {batch_max_texts} texts per request, "
+                                                    f"got {len(batch.texts)}")
+    for text in batch.texts:
+        log_request("PRINCIPAL PREDICTION BATCH", text)
+    wrapper = await ready_wrapper(batch.model)
+    with STAGE_SECONDS.time(stage='sanitize'):
+        texts = [sanitize_string(text) for text in batch.texts]
+    predictions = {}
+    for text in texts:
+        if text not in predictions:
+            predictions[text] = wrapper.cached_prediction(text, batch.top_k, batch.min_prob, memory_only=True)
+    missing = [text for text, prediction in predictions.items() if prediction is None]
+    CACHE_HITS.inc(len(predictions) - len(missing))
+    results = await asyncio.gather(*[batcher.submit((wrapper, text, batch.top_k, batch.min_prob)) for text in missing])
+    predictions.update(zip(missing, results))
+    return [predictions[text] for text in texts]
+
+
+@app.get("/similar-lines")
+async def similar_lines(text: str, k: int = Query(SIMILAR_LINES_DEFAULT, ge=1, le=SIMILAR_LINES_MAX),
+                        model: Optional[str] = None):
+    log_request("SIMILAR LINES", text)
+    wrapper = await ready_wrapper(model)
+    if wrapper.line_index is None:
+        raise HTTPException(status_code=503, detail="No line index loaded")
+    with STAGE_SECONDS.time(stage='sanitize'):
+        text = sanitize_string(text)
+    return await asyncio.get_running_loop().run_in_executor(None, wrapper.similar_lines, text, k)
+
+
+@app.get("/models")
+async def models():
+    return ready_registry().status()
+
+
+@app.post("/models/{name}/reload")
+async def reload_model(name: str):
+    """
+    Load the model's directory again and swap the new version in once loaded. Requests keep being served by the
+    current version meanwhile, so a new version is rolled out by writing it to the model's directory and reloading.
+    """
+    registry = ready_registry()
+    if name not in registry.names:
+        raise HTTPException(status_code=404, detail=f"Unknown model {name!r}, expected one of {registry.names}")
+    try:
+        wrapper = await asyncio.get_running_loop().run_in_executor(None, registry.reload, name)
+    except Exception as e:
+        logger.exception(f"Model {name} failed to reload")
+        raise HTTPException(status_code=503, detail=f"Model {name} failed to reload, kept the current version: {e!r}")
+    return {"model": name, "model_id": wrapper.model_id}
+
+
+@app.get("/batching-stats")
+async def batching_stats():
+    return batcher.stats()
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(METRICS.render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,259 @@
+import os
+import time
+import inspect
+import logging
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import DistilBertConfig
+
+from movie_prediction.bucketing import length_sorted_batches, pad_sequences
+from movie_prediction.models import DistilBertForPrincipalPrediction
+from movie_prediction.constants import BATCH_SIZE_DEFAULT, SNAPSHOT_SUFFIX, TOKENIZER_ARGS_UNPADDED
+
+__all__ = [
+    'TorchBackend', 'QuantizedBackend', 'OnnxBackend', 'BACKENDS',
+    'load_backend', 'onnx_path', 'export_onnx', 'compare_backends'
+]
+
+
+def onnx_path(model_path: str) -> str:
+    """
+    Path of the ONNX export of a model, next to the model directory. A model and its snapshot share the export,
+    so it is found whichever of the two is loaded.
+    """
+    model_path = model_path.rstrip('/')
+    if model_path.endswith(SNAPSHOT_SUFFIX):
+        model_path = model_path[:-len(SNAPSHOT_SUFFIX)]
+    return model_path + '.onnx'
+
+
+class TorchBackend:
+    """
+    Runs the PyTorch model eagerly in fp32, on GPU when available.
+    """
+    name = 'fp32'
+
+    def __init__(self, model: DistilBertForPrincipalPrediction, device: Optional[torch.device] = None):
+        """
+        :param model: DistilBertForPrincipalPrediction
+            The model to run.
+        :param device: torch.device, optional
+            Device to run on, defaults to GPU when available.
+        """
+        if device is None:
+            device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.device = device
+        self.model = model.to(device)
+        self.model.eval()
+        self.config = model.config
+
+    @classmethod
+    def from_pretrained(cls, model_path: str) -> 'TorchBackend':
+        return cls(DistilBertForPrincipalPrediction.from_pretrained(model_path))
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the logits of a padded batch.
+        """
+        return self.model(input_ids, attention_mask)[0]
+
+    def embed(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the `[CLS]` embeddings of a padded batch.
+        """
+        return self.model.distilbert(input_ids=input_ids, attention_mask=attention_mask)[0][:, 0]
+
+    @property
+    def hierarchical(self) -> bool:
+        """
+        Whether the model has a two-level head, whose `top_k` skips the labels of unlikely clusters.
+        """
+        return getattr(self.model, 'hierarchical', False)
+
+    def top_k(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Compute the probabilities and label indices of the `k` most probable principals of a padded batch,
+        see `DistilBertForPrincipalPrediction.top_k`.
+        """
+        return self.model.top_k(input_ids, attention_mask, k)
+
+
+class QuantizedBackend(TorchBackend):
+    """
+    Runs the PyTorch model on CPU with its Linear layers dynamically quantized to INT8.
+    Weights are quantized once at load and activations per batch, which speeds up the
+    matrix products that dominate DistilBERT on CPU.
+    """
+    name = 'int8'
+
+    def __init__(self, model: DistilBertForPrincipalPrediction):
+        """
+        :param model: DistilBertForPrincipalPrediction
+            The fp32 model to quantize.
+        """
+        model = torch.quantization.quantize_dynamic(model.cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+        super().__init__(model, torch.device('cpu'))
+
+
+class _OnnxExportModule(nn.Module):
+    def __init__(self, model: DistilBertForPrincipalPrediction):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        outputs = self.model(input_ids, attention_mask, output_hidden_states=True, return_dict=True)
+        return outputs.logits, outputs.hidden_states[-1][:, 0]
+
+
+def export_onnx(model_path: str, output_path: Optional[str] = None, opset: int = 14) -> str:
+    """
+    Export a model to ONNX with dynamic batch and sequence axes.
+    The graph outputs the logits and the `[CLS]` embeddings.
+
+    :param model_path: str
+        Directory of the pretrained model.
+    :param output_path: str, optional
+        Path of the ONNX file, see `onnx_path` for the default.
+    :param opset: int, default 14
+        ONNX opset version.
+    :return:
+        str
+        The path of the ONNX file.
+    """
+    output_path = output_path or onnx_path(model_path)
+    model = DistilBertForPrincipalPrediction.from_pretrained(model_path)
+    model.eval()
+    dummy = torch.ones((2, 8), dtype=torch.long)
+    dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                    'logits': {0: 'batch'}, 'embedding': {0: 'batch'}}
+    # Newer torch versions default to the dynamo exporter, which ignores `dynamic_axes`
+    export_args = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    logging.info(f"Exporting {model_path} to {output_path}...")
+    with torch.no_grad():
+        torch.onnx.export(
+            _OnnxExportModule(model), (dummy, dummy), output_path,
+            input_names=['input_ids', 'attention_mask'], output_names=['logits', 'embedding'],
+            dynamic_axes=dynamic_axes, opset_version=opset, **export_args)
+    return output_path
+
+
+class OnnxBackend:
+    """
+    Runs a model exported with `export_onnx` on ONNX Runtime's CPU provider.
+    """
+    name = 'onnx'
+
+    def __init__(self, path: str, config: DistilBertConfig, num_threads: Optional[int] = None):
+        """
+        :param path: str
+            Path of the ONNX file.
+        :param config: DistilBertConfig
+            Configuration of the exported model.
+        :param num_threads: int, optional
+            Number of intra-op threads, defaults to ONNX Runtime's choice.
+        """
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx backend requires onnxruntime, install it with `pip install onnxruntime`") from e
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.device = torch.device('cpu')
+        self.config = config
+
+    @classmethod
+    def from_pretrained(cls, model_path: str) -> 'OnnxBackend':
+        path = onnx_path(model_path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No ONNX export at {path}, create it with `python -m movie_prediction.export`")
+        return cls(path, DistilBertConfig.from_pretrained(model_path))
+
+    def _run(self, output: str, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(self.session.run([output], {
+            'input_ids': input_ids.numpy(), 'attention_mask': attention_mask.numpy()})[0])
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the logits of a padded batch.
+        """
+        return self._run('logits', input_ids, attention_mask)
+
+    def embed(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the `[CLS]` embeddings of a padded batch.
+        """
+        return self._run('embedding', input_ids, attention_mask)
+
+
+BACKENDS = {backend.name: backend for backend in [TorchBackend, QuantizedBackend, OnnxBackend]}
+
+
+def load_backend(name: str, model_path: str):
+    """
+    Load a model with an inference backend.
+
+    :param name: str
+        One of `BACKENDS`: 'fp32', 'int8' or 'onnx'.
+    :param model_path: str
+        Directory of the pretrained model.
+    :return:
+        TorchBackend, QuantizedBackend or OnnxBackend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}, expected one of {list(BACKENDS)}")
+    logging.info(f"Loading {name} model from {model_path}...")
+    return BACKENDS[name].from_pretrained(model_path)
+
+
+def compare_backends(reference, backends: Dict[str, object], tokenizer, utterances: Sequence[str],
+                     batch_size: int = BATCH_SIZE_DEFAULT) -> Dict[str, Dict[str, float]]:
+    """
+    Compare the predictions of backends against a reference backend, usually fp32.
+
+    :param reference:
+        The reference backend.
+    :param backends: Dict[str, object]
+        The backends to check, by name.
+    :param tokenizer:
+        The models' huggingface tokenizer.
+    :param utterances: Sequence[str]
+        Held-out utterances to predict.
+    :param batch_size: int, default BATCH_SIZE_DEFAULT
+        Number of utterances per forward pass.
+    :return:
+        Dict[str, Dict[str, float]]
+        For the reference and every backend: the share of utterances with the same top-1 principal as the
+        reference, the mean and max absolute probability difference to the reference, and the seconds spent
+        predicting.
+    """
+    input_ids = tokenizer([str(utt) for utt in utterances], **TOKENIZER_ARGS_UNPADDED)['input_ids']
+    batches = length_sorted_batches([len(ids) for ids in input_ids], batch_size)
+
+    def predict(backend):
+        probs = np.empty((len(input_ids), backend.config.num_labels), dtype=np.float32)
+        start = time.perf_counter()
+        with torch.inference_mode():
+            for batch in batches:
+                batch_ids, attention_mask = pad_sequences([input_ids[i] for i in batch], tokenizer.pad_token_id)
+                logits = backend(batch_ids.to(backend.device), attention_mask.to(backend.device))
+                probs[batch] = torch.softmax(logits.float(), dim=-1).cpu().numpy()
+        return probs, time.perf_counter() - start
+
+    reference_probs, reference_seconds = predict(reference)
+    results = {reference.name: {
+        'top1_agreement': 1.0, 'mean_prob_drift': 0.0, 'max_prob_drift': 0.0, 'seconds': reference_seconds}}
+    for name, backend in backends.items():
+        probs, seconds = predict(backend)
+        drift = np.abs(probs - reference_probs)
+        results[name] = {
+            'top1_agreement': float(np.mean(probs.argmax(axis=1) == reference_probs.argmax(axis=1))),
+            'mean_prob_drift': float(drift.mean()),
+            'max_prob_drift': float(drift.max()),
+            'seconds': seconds,
+        }
+    return results
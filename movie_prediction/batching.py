@@ -0,0 +1,194 @@
+import asyncio
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Sequence
+
+from movie_prediction.constants import BATCH_SIZE_DEFAULT, BATCH_WAIT_MS_DEFAULT
+from movie_prediction.metrics import METRICS, BATCH_SIZE_BUCKETS
+
+__all__ = ['MicroBatcher']
+
+BATCHES = METRICS.counter('principal_batches_total', "Batches handed to the prediction function.")
+BATCH_FAILURES = METRICS.counter('principal_batch_failures_total', "Batches whose prediction raised an error.")
+BATCH_SIZE = METRICS.histogram(
+    'principal_batch_size', "Number of requests per executed batch.", buckets=BATCH_SIZE_BUCKETS)
+QUEUE_DEPTH = METRICS.histogram(
+    'principal_queue_depth', "Requests already queued when a request arrives.", buckets=(0,) + BATCH_SIZE_BUCKETS)
+QUEUE_SECONDS = METRICS.histogram(
+    'principal_queue_seconds', "Seconds the first request of a batch waited before the batch was executed.")
+
+
+def _depth_bucket(depth: int) -> int:
+    """
+    Round a queue depth up to the next power of two so the histogram stays small.
+    """
+    bucket = 1
+    while bucket < depth:
+        bucket *= 2
+    return bucket if depth else 0
+
+
+class MicroBatcher:
+    """
+    Asyncio scheduler which groups concurrent requests into batches for a single forward pass.
+
+    Requests are queued until either `max_batch_size` items are pending or the oldest item has
+    waited `max_wait_ms` milliseconds. The batch is then handed to `predict_fn` on a worker thread,
+    so the event loop stays free, and every caller's future is resolved with its own result.
+    """
+
+    def __init__(self, predict_fn: Callable[[List[Any]], Sequence[Any]],
+                 max_batch_size: int = BATCH_SIZE_DEFAULT,
+                 max_wait_ms: float = BATCH_WAIT_MS_DEFAULT):
+        """
+        :param predict_fn: Callable[[List[Any]], Sequence[Any]]
+            Function mapping a list of inputs to a sequence of results in the same order.
+        :param max_batch_size: int, default BATCH_SIZE_DEFAULT
+            Maximum number of items passed to `predict_fn` at once.
+        :param max_wait_ms: float, default BATCH_WAIT_MS_DEFAULT
+            Maximum time the first item of a batch waits for more items to arrive.
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = None
+        self._worker = None
+        self._executor = None
+
+        self.batch_size_histogram = Counter()
+        self.queue_depth_histogram = Counter()
+        self.num_batches = 0
+        self.num_items = 0
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self):
+        """
+        Start the batching worker on the running event loop.
+        """
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='micro-batcher')
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Stop the batching worker and fail any requests still waiting in the queue.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher stopped before the request was processed"))
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Queue an item for batched prediction and wait for its result.
+
+        :param item: Any
+            A single input for `predict_fn`.
+        :return:
+            Any
+            The result `predict_fn` produced for this item.
+        """
+        if not self.running:
+            raise RuntimeError("MicroBatcher.start() must be awaited before submitting requests")
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        depth = self._queue.qsize()
+        self.queue_depth_histogram[_depth_bucket(depth)] += 1
+        QUEUE_DEPTH.observe(depth)
+        self._queue.put_nowait((item, future, loop.time()))
+        return await future
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return queue and batch statistics for tuning `max_batch_size` and `max_wait_ms`.
+
+        :return:
+            Dict[str, Any]
+            The current queue depth, the histogram of queue depths seen by incoming requests
+            (bucketed to powers of two) and the histogram of executed batch sizes.
+        """
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'batches': self.num_batches,
+            'items': self.num_items,
+            'queue_depth_histogram': dict(sorted(self.queue_depth_histogram.items())),
+            'batch_size_histogram': dict(sorted(self.batch_size_histogram.items())),
+        }
+
+    async def _collect(self) -> List[tuple]:
+        loop = asyncio.get_event_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        try:
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Requests already taken off the queue are out of reach of `stop`, fail them here
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Batcher stopped before the request was processed"))
+            raise
+        QUEUE_SECONDS.observe(loop.time() - batch[0][2])
+        return [(item, future) for item, future, _ in batch if not future.cancelled()]
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            self.batch_size_histogram[len(batch)] += 1
+            self.num_batches += 1
+            self.num_items += len(batch)
+            BATCHES.inc()
+            BATCH_SIZE.observe(len(batch))
+
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.predict_fn, [item for item, _ in batch])
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Batcher stopped while the request was processed"))
+                raise
+            except Exception as e:
+                logging.exception("Batched prediction failed")
+                BATCH_FAILURES.inc()
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
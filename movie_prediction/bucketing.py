@@ -0,0 +1,172 @@
+import logging
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+__all__ = ['PaddingStats', 'length_sorted_batches', 'pad_sequences', 'LengthBucketSampler']
+
+
+def _in_order_padded_size(lengths: np.ndarray, batch_size: int) -> int:
+    """
+    Number of token slots used when batches are formed in input order and padded to their longest member.
+    """
+    if not len(lengths):
+        return 0
+    starts = np.arange(0, len(lengths), batch_size)
+    sizes = np.diff(np.append(starts, len(lengths)))
+    return int((np.maximum.reduceat(lengths, starts) * sizes).sum())
+
+
+class PaddingStats:
+    """
+    Running count of the pad tokens produced by length-aware batching, compared with batching the
+    same inputs in their original order.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.baseline_padded_tokens = 0
+
+    def update(self, lengths: Sequence[int], batches: Sequence[np.ndarray], batch_size: int):
+        """
+        :param lengths: Sequence[int]
+            Token length of every input.
+        :param batches: Sequence[np.ndarray]
+            The index batches that were actually formed.
+        :param batch_size: int
+            The batch size of the in-order baseline.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.tokens += int(lengths.sum())
+        self.padded_tokens += sum(int(lengths[batch].max()) * len(batch) for batch in batches if len(batch))
+        self.baseline_padded_tokens += _in_order_padded_size(lengths, batch_size)
+
+    @property
+    def pad_tokens(self) -> int:
+        return self.padded_tokens - self.tokens
+
+    @property
+    def baseline_pad_tokens(self) -> int:
+        return self.baseline_padded_tokens - self.tokens
+
+    @property
+    def saved_pad_tokens(self) -> int:
+        return self.baseline_padded_tokens - self.padded_tokens
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            'tokens': self.tokens,
+            'pad_tokens': self.pad_tokens,
+            'baseline_pad_tokens': self.baseline_pad_tokens,
+            'saved_pad_tokens': self.saved_pad_tokens,
+        }
+
+
+def length_sorted_batches(lengths: Sequence[int], batch_size: int, shuffle: bool = False,
+                          bucket_batches: int = 50, seed: Optional[int] = None) -> List[np.ndarray]:
+    """
+    Group input indices into batches of similar token length.
+
+    :param lengths: Sequence[int]
+        Token length of every input.
+    :param batch_size: int
+        Maximum number of inputs per batch.
+    :param shuffle: bool, default False
+        If False all inputs are sorted by length, which gives the least padding and suits inference.
+        If True inputs are shuffled, split into buckets of `bucket_batches` batches, sorted by length
+        within each bucket and the resulting batches are shuffled, which keeps training batches random.
+    :param bucket_batches: int, default 50
+        Number of batches per bucket when shuffling.
+    :param seed: int, optional
+        Seed for the shuffle.
+    :return:
+        List[np.ndarray]
+        The batches as arrays of indices into `lengths`. Scatter outputs back with these indices
+        to restore the original order.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if not shuffle:
+        order = np.argsort(lengths, kind='stable')
+        return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    rng = np.random.default_rng(seed)
+    permutation = rng.permutation(len(lengths))
+    bucket_size = batch_size * bucket_batches
+    batches = []
+    for start in range(0, len(permutation), bucket_size):
+        bucket = permutation[start:start + bucket_size]
+        bucket = bucket[np.argsort(lengths[bucket], kind='stable')]
+        batches.extend(bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size))
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+
+def pad_sequences(sequences: Sequence[Sequence[int]], pad_token_id: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Pad token id sequences to the longest one.
+
+    :param sequences: Sequence[Sequence[int]]
+        Token ids of every input.
+    :param pad_token_id: int, default 0
+        Token id used for padding.
+    :return:
+        (input_ids, attention_mask)
+        Two long tensors of shape (n_sequences, longest sequence).
+    """
+    max_len = max((len(seq) for seq in sequences), default=0)
+    input_ids = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        input_ids[i, :len(seq)] = torch.as_tensor(seq, dtype=torch.long)
+        attention_mask[i, :len(seq)] = 1
+    return input_ids, attention_mask
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler which yields shuffled batches of similar token length, to be passed to a
+    DataLoader as `batch_sampler`. Padding statistics are kept for every epoch.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, shuffle: bool = True,
+                 bucket_batches: int = 50, seed: int = 0):
+        """
+        :param lengths: Sequence[int]
+            Token length of every item in the dataset.
+        :param batch_size: int
+            Maximum number of items per batch.
+        :param shuffle: bool, default True
+            Whether to shuffle the batches, see `length_sorted_batches`.
+        :param bucket_batches: int, default 50
+            Number of batches per length bucket when shuffling.
+        :param seed: int, default 0
+            Base seed, offset by the epoch number so every epoch is shuffled differently.
+        """
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+        self.epoch_stats: List[PaddingStats] = []
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = length_sorted_batches(
+            self.lengths, self.batch_size, shuffle=self.shuffle,
+            bucket_batches=self.bucket_batches, seed=self.seed + self.epoch)
+        stats = PaddingStats()
+        stats.update(self.lengths, batches, self.batch_size)
+        self.epoch_stats.append(stats)
+        logging.info(f"Epoch {self.epoch} length bucketing saved {stats.saved_pad_tokens} pad tokens "
+                     f"({stats.pad_tokens} remaining)")
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
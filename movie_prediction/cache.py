@@ -0,0 +1,254 @@
+import json
+import queue
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Any, Dict, Optional
+
+from movie_prediction.constants import CACHE_SIZE_DEFAULT, CACHE_FLUSH_SIZE_DEFAULT, CACHE_FLUSH_MS_DEFAULT
+
+__all__ = ['PredictionCache']
+
+
+class PredictionCache:
+    """
+    Thread-safe LRU cache for model predictions with an optional time-to-live and an optional
+    on-disk SQLite tier, so a restarted worker can start warm.
+    Cached values must be JSON serializable when the disk tier is used and should not be mutated.
+
+    Disk writes are queued and committed in batches by a background thread, so `put` never waits on SQLite.
+    The lock of the in-memory entries is not held during disk reads or writes.
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE_DEFAULT, ttl: Optional[float] = None,
+                 disk_path: Optional[str] = None, disk_max_size: Optional[int] = None,
+                 flush_size: int = CACHE_FLUSH_SIZE_DEFAULT, flush_ms: float = CACHE_FLUSH_MS_DEFAULT):
+        """
+        :param max_size: int, default CACHE_SIZE_DEFAULT
+            Maximum number of predictions held in memory before the least recently used is evicted.
+        :param ttl: float, optional
+            Seconds after which a cached prediction expires. Predictions never expire by default.
+        :param disk_path: str, optional
+            Path of a SQLite file used as a second, persistent cache tier.
+        :param disk_max_size: int, optional
+            Maximum number of predictions kept on disk, defaults to 10 times `max_size`.
+        :param flush_size: int, default CACHE_FLUSH_SIZE_DEFAULT
+            Maximum number of predictions written to disk in one transaction.
+        :param flush_ms: float, default CACHE_FLUSH_MS_DEFAULT
+            Maximum milliseconds a prediction waits for more to be written with it.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_max_size = disk_max_size or 10 * max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_ms / 1000
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        self._disk_puts = 0
+        self._pending = queue.Queue()
+        self._writer = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            # Write-ahead logging lets reads proceed during a write and syncs less often
+            self._disk.execute('PRAGMA journal_mode=WAL')
+            self._disk.execute('PRAGMA synchronous=NORMAL')
+            self._disk.execute(
+                'CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, value TEXT, created REAL)')
+            self._disk.execute('CREATE INDEX IF NOT EXISTS predictions_created ON predictions (created)')
+            self._disk.commit()
+            self._writer = threading.Thread(target=self._write_loop, name='prediction-cache-writer', daemon=True)
+            self._writer.start()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(utterance: str, *namespace: Any) -> str:
+        """
+        Build a cache key from a sanitized utterance and anything else the prediction depends on,
+        such as the model identity.
+
+        :param utterance: str
+            The sanitized utterance text.
+        :param namespace: Any
+            Additional values identifying the prediction, converted with `str`.
+        :return:
+            str
+            A 128 bit hex digest.
+        """
+        key = blake2b(digest_size=16)
+        for part in namespace:
+            key.update(str(part).encode('utf-8'))
+            key.update(b'\0')
+        key.update(utterance.encode('utf-8'))
+        return key.hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _get_memory(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, created = entry
+            if not self._expired(created):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+            self.expirations += 1
+        return None
+
+    def peek(self, key: str) -> Optional[Any]:
+        """
+        Return the prediction cached in memory for `key`, or None without counting a miss.
+        The disk tier is not read, so a peek never waits on SQLite, e.g. on an event loop. A None is expected to
+        be followed by a `get`, which counts the miss.
+        """
+        with self._lock:
+            return self._get_memory(key)
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Return the cached prediction for `key`, or None if it is missing or expired.
+        """
+        with self._lock:
+            value = self._get_memory(key)
+            if value is not None:
+                return value
+            if self._disk is None:
+                self.misses += 1
+                return None
+
+        with self._disk_lock:
+            row = None if self._disk is None else self._disk.execute(
+                'SELECT value, created FROM predictions WHERE key = ?', (key,)).fetchone()
+        with self._lock:
+            if row is not None and not self._expired(row[1]):
+                value = json.loads(row[0])
+                self._insert(key, value, row[1])
+                self.disk_hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any):
+        """
+        Cache a prediction under `key`.
+        """
+        created = time.time()
+        with self._lock:
+            self._insert(key, value, created)
+        if self._writer is not None:
+            self._pending.put((key, json.dumps(value), created))
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_size:
+                try:
+                    item = self._pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._pending.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            except sqlite3.Error:
+                logging.exception(f"Failed to write {len(batch)} predictions to the disk cache")
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _write(self, batch):
+        with self._disk_lock:
+            self._disk.executemany(
+                'INSERT OR REPLACE INTO predictions (key, value, created) VALUES (?, ?, ?)', batch)
+            previous, self._disk_puts = self._disk_puts, self._disk_puts + len(batch)
+            if previous // 1000 != self._disk_puts // 1000:
+                self._prune_disk()
+            self._disk.commit()
+
+    def flush(self):
+        """
+        Wait until every prediction put so far is written to disk.
+        """
+        if self._writer is not None:
+            self._pending.join()
+
+    def close(self):
+        """
+        Write the pending predictions to disk and close it, the cache then only holds predictions in memory.
+        """
+        if self._writer is None:
+            return
+        self._pending.put(None)
+        self._writer.join()
+        self._writer = None
+        with self._disk_lock:
+            self._disk.close()
+            self._disk = None
+
+    def _insert(self, key: str, value: Any, created: float):
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _prune_disk(self):
+        if self.ttl is not None:
+            self._disk.execute('DELETE FROM predictions WHERE created < ?', (time.time() - self.ttl,))
+        self._disk.execute(
+            'DELETE FROM predictions WHERE key IN ('
+            'SELECT key FROM predictions ORDER BY created DESC LIMIT -1 OFFSET ?)',
+            (self.disk_max_size,))
+
+    def clear(self):
+        """
+        Remove every cached prediction from memory and disk.
+        """
+        self.flush()
+        with self._lock:
+            self._entries.clear()
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.execute('DELETE FROM predictions')
+                self._disk.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return:
+            Dict[str, Any]
+            Current size and hit, miss, eviction and expiration counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
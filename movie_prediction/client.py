@@ -0,0 +1,111 @@
+import json
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from movie_prediction.constants import API_TIMEOUT_DEFAULT
+
+__all__ = ['PrincipalPredictionClient', 'ServiceError']
+
+
+class ServiceError(RuntimeError):
+    """
+    Error answered by the prediction service, `status` is its HTTP status code.
+    """
+
+    def __init__(self, status: int, detail: Any):
+        super().__init__(f"Prediction service answered {status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+class PrincipalPredictionClient:
+    """
+    Client of the FastAPI prediction service in `main.py`.
+
+    It only uses the standard library and holds no state between calls, so one client can be shared by threads,
+    e.g. the sessions of the Streamlit app, which then all use the service's batching, cache and models.
+    """
+
+    def __init__(self, base_url: str, timeout: float = API_TIMEOUT_DEFAULT):
+        """
+        :param base_url: str
+            URL the service is served at, e.g. http://localhost:8000.
+        :param timeout: float, default API_TIMEOUT_DEFAULT
+            Seconds to wait for a response.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path: str, params: Optional[Dict[str, Any]] = None, body: Optional[Any] = None) -> Any:
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        url = self.base_url + path + ('?' + urlencode(params) if params else '')
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        request = Request(url, data=data, headers={'Content-Type': 'application/json'} if data else {})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)
+        except HTTPError as e:
+            try:
+                detail = json.load(e).get('detail')
+            except ValueError:
+                detail = e.reason
+            raise ServiceError(e.code, detail) from None
+
+    def ready(self) -> bool:
+        """
+        Whether the service has loaded its default model.
+        """
+        try:
+            return bool(self._request('/ready').get('ready'))
+        except ServiceError as e:
+            if e.status == 503:
+                return False
+            raise
+
+    def models(self) -> Dict[str, Any]:
+        """
+        Status of the served models, see `/models`.
+        """
+        return self._request('/models')
+
+    def predict(self, text: str, top_k: Optional[int] = None, min_prob: Optional[float] = None,
+                model: Optional[str] = None) -> Mapping[str, float]:
+        """
+        Given an utterance text return the predicted probabilities of what actors said it.
+
+        :param text: str
+            The utterance text to classify.
+        :param top_k: int, optional
+            Only return the `top_k` most probable principals.
+        :param min_prob: float, optional
+            Leave principals less probable than `min_prob` out.
+        :param model: str, optional
+            Name of the model to ask, defaults to the service's default model.
+        :return:
+            Mapping[str, float]
+            A mapping between each principal and their probability, by descending probability.
+        """
+        return self._request(
+            '/principal-prediction', params={'text': text, 'top_k': top_k, 'min_prob': min_prob, 'model': model})
+
+    def predict_batch(self, texts: Sequence[str], top_k: Optional[int] = None, min_prob: Optional[float] = None,
+                      model: Optional[str] = None) -> List[Mapping[str, float]]:
+        """
+        Given utterance texts return the predicted probabilities of what actors said them, in one request.
+
+        :param texts: Sequence[str]
+            The utterance texts to classify, at most the service's `PRINCIPAL_BATCH_MAX_TEXTS`.
+        :param top_k: int, optional
+            Only return the `top_k` most probable principals per utterance.
+        :param min_prob: float, optional
+            Leave principals less probable than `min_prob` out.
+        :param model: str, optional
+            Name of the model to ask, defaults to the service's default model.
+        :return:
+            List[Mapping[str, float]]
+            The predictions in the order of `texts`.
+        """
+        body = {'texts': list(texts), 'top_k': top_k, 'min_prob': min_prob, 'model': model}
+        return self._request('/principal-prediction/batch', body=body)
@@ -5,6 +5,14 @@ HOME_DIR = os.path.abspath(
     os.path.dirname(__file__) + '/../').replace('\\', '/')
 DATA_DIR = HOME_DIR + '/data'
 MODEL_DIR = HOME_DIR + '/models'
+EMBEDDING_DIR = DATA_DIR + '/embeddings'
+
+# Raw Data Files (relative to the data directory)
+IMDB_PRINCIPALS_FILE = 'imdb_movie_meta/IMDb title_principals.csv'
+IMDB_NAMES_FILE = 'imdb_movie_meta/IMDb names.csv'
+IMDB_MOVIES_FILE = 'imdb_movie_meta/IMDb movies.csv'
+CORNELL_LINES_FILE = 'cornell_movie_scripts/movie_lines.tsv'
+CORNELL_TITLES_FILE = 'cornell_movie_scripts/movie_titles_metadata.tsv'
 
 # Column Names
 LINE_ID = 'Line ID'
@@ -16,6 +24,10 @@ UTTERANCE_HASH = 'Utterance Hash'
 UTTERANCE_SAN = 'Utterance (sanitized)'
 PRINCIPAL_LINES = 'Principal Lines'
 PREDICTION = 'Prediction'
+PROBABILITY = 'Probability'
+SIMILARITY = 'Similarity'
+CLUSTER_ID = 'Cluster ID'
+CLUSTER_SIZE = 'Cluster Size'
 
 CHARAC = 'Character'
 CHARAC_RAW = 'Character (Raw)'
@@ -45,4 +57,44 @@ TOKENIZER_ARGS_DEFAULT = {
     'padding': True, 'truncation': True,
     'max_length': WORD_LIMIT_DEFAULT
 }
-PRINCIPALS_LINES_DEFAULT = 'principal_lines.tsv'
\ No newline at end of file
+TOKENIZER_ARGS_UNPADDED = {
+    'padding': False, 'truncation': True,
+    'max_length': WORD_LIMIT_DEFAULT
+}
+PRINCIPALS_LINES_DEFAULT = 'principal_lines.tsv'
+PRINCIPALS_LINES_PARQUET_DEFAULT = 'principal_lines.parquet'
+LINE_CHUNK_SIZE_DEFAULT = 100000
+EMBEDDING_CHUNK_ROWS_DEFAULT = 65536
+EMBEDDING_FLUSH_ROWS_DEFAULT = 4096
+LINE_INDEX_DEFAULT = 'line_index'
+LINE_INDEX_NPROBE_DEFAULT = 8
+PARQUET_ROW_GROUP_SIZE_DEFAULT = 65536
+
+# Bump when the processed dataset changes so columnar caches are rebuilt
+LOADER_VERSION = 1
+INCREMENTAL_STATE_SUFFIX = '.state'
+
+# Serving Defaults
+BATCH_SIZE_DEFAULT = 32
+BATCH_WAIT_MS_DEFAULT = 5
+CACHE_SIZE_DEFAULT = 10000
+CACHE_FLUSH_SIZE_DEFAULT = 256
+CACHE_FLUSH_MS_DEFAULT = 100
+SIMILAR_LINES_DEFAULT = 10
+SIMILAR_LINES_MAX = 100
+SNAPSHOT_SUFFIX = '-snapshot'
+REQUEST_LOG_RATE_DEFAULT = 0.01
+BATCH_REQUEST_MAX_TEXTS_DEFAULT = 1024
+API_TIMEOUT_DEFAULT = 30
+
+# Deduplication Defaults
+DEDUP_CHUNK_SIZE_DEFAULT = 65536
+MINHASH_PERMUTATIONS_DEFAULT = 64
+LSH_BANDS_DEFAULT = 16
+SHINGLE_SIZE_DEFAULT = 3
+NEAR_DUPLICATE_THRESHOLD_DEFAULT = 0.7
+COMMON_PHRASE_THRESHOLD_DEFAULT = 10
+
+# Bulk Scoring Defaults
+SCORING_SHARD_SIZE_DEFAULT = 50000
+SCORING_TOP_K_DEFAULT = 5
@@ -0,0 +1,141 @@
+import os
+import json
+from hashlib import blake2b
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from movie_prediction.constants import *
+
+__all__ = ['raw_data_fingerprint', 'same_inputs', 'read_parquet_cache', 'write_parquet_cache', 'RAW_FILES']
+
+RAW_FILES = [
+    IMDB_PRINCIPALS_FILE, IMDB_NAMES_FILE, IMDB_MOVIES_FILE,
+    CORNELL_LINES_FILE, CORNELL_TITLES_FILE,
+]
+DICTIONARY_COLS = [PRINCIPAL, TITLE, CHARAC]
+
+_FINGERPRINT_KEY = b'movie_prediction.fingerprint'
+_BLOCK_SIZE = 1 << 20
+
+
+def _file_digest(path: str) -> str:
+    digest = blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def raw_data_fingerprint(data_dir: str = DATA_DIR, known: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Fingerprint the raw input files and the loader version.
+
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :param known: Dict[str, Any], optional
+        A previous fingerprint. Content digests of files whose size and modification time are unchanged
+        are reused from it instead of being recomputed.
+    :return:
+        Dict[str, Any] or None
+        The fingerprint, or None if any raw file is missing.
+    """
+    known_files = (known or {}).get('files', {})
+    files = {}
+    for name in RAW_FILES:
+        path = data_dir + '/' + name
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        previous = known_files.get(name)
+        if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+            digest = previous['digest']
+        else:
+            digest = _file_digest(path)
+        files[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+    return {'version': LOADER_VERSION, 'files': files}
+
+
+def same_inputs(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]]) -> bool:
+    """
+    Whether two fingerprints from `raw_data_fingerprint` have the same loader version and raw file contents.
+    Missing fingerprints never match.
+    """
+    if a is None or b is None or a.get('version') != b.get('version'):
+        return False
+    return {k: v['digest'] for k, v in a['files'].items()} == {k: v['digest'] for k, v in b['files'].items()}
+
+
+def _read_fingerprint(path: str) -> Optional[Dict[str, Any]]:
+    metadata = pq.read_schema(path).metadata or {}
+    if _FINGERPRINT_KEY not in metadata:
+        return None
+    return json.loads(metadata[_FINGERPRINT_KEY])
+
+
+def read_parquet_cache(path: str, data_dir: str = DATA_DIR, columns: Optional[List[str]] = None,
+                       categorical: bool = False, validate: bool = True) -> Optional[pd.DataFrame]:
+    """
+    Read a processed dataset cached with `write_parquet_cache`, if it is still fresh.
+
+    The cache is stale when the loader version or the content of any raw input file changed since it was written.
+    When the raw files are not available, e.g. on a serving machine, the cache is trusted as is.
+
+    :param path: str
+        Path of the parquet cache.
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :param columns: List[str], optional
+        Only read these columns.
+    :param categorical: bool, default False
+        Whether to read the `Principal`, `Title` and `Character` columns as pandas categoricals.
+    :param validate: bool, default True
+        Whether to check the cache against the raw input files.
+    :return:
+        pd.DataFrame or None
+        The cached dataset, or None if there is no cache or it is stale.
+    """
+    if not os.path.isfile(path):
+        return None
+    if validate:
+        stored = _read_fingerprint(path)
+        current = raw_data_fingerprint(data_dir, known=stored)
+        if current is not None and not same_inputs(stored, current):
+            print(f"Principal lines cache is stale: {path}")
+            return None
+
+    read_dictionary = [col for col in DICTIONARY_COLS if columns is None or col in columns] if categorical else None
+    table = pq.read_table(path, columns=columns, memory_map=True, read_dictionary=read_dictionary)
+    return table.to_pandas()
+
+
+def write_parquet_cache(frame: pd.DataFrame, path: str, data_dir: str = DATA_DIR,
+                        fingerprint: Optional[Dict[str, Any]] = None):
+    """
+    Write a processed dataset to a parquet cache with dictionary encoded `Principal`, `Title` and `Character` columns.
+
+    :param frame: pd.DataFrame
+        The processed dataset.
+    :param path: str
+        Path of the parquet cache.
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :param fingerprint: Dict[str, Any], optional
+        Fingerprint of the raw inputs the dataset was built from, ideally taken before building it.
+        Computed from `data_dir` by default.
+    """
+    if fingerprint is None:
+        fingerprint = raw_data_fingerprint(data_dir)
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    if fingerprint is not None:
+        metadata[_FINGERPRINT_KEY] = json.dumps(fingerprint).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    # Small row groups let `LineSampler` read a single row without decoding the whole file
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, use_dictionary=[col for col in DICTIONARY_COLS if col in frame],
+                   row_group_size=PARQUET_ROW_GROUP_SIZE_DEFAULT)
+    os.replace(tmp_path, path)
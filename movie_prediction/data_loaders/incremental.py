@@ -0,0 +1,306 @@
+"""
+Incremental build of the principal movie lines dataset, for when new scripts or IMDb dumps arrive:
+
+    python -m movie_prediction.data_loaders.incremental --output data/principal_lines.tsv
+
+The state of the last build is kept next to the output. Only the movies whose raw lines or title changed are
+sanitized and joined against the principal index, only the name keys competed for by principals whose line counts
+changed are resolved again, and only the rows of principals whose lines changed are written again, the rest of the
+TSV output is copied from the previous build. The output is identical to a full rebuild.
+"""
+import os
+import json
+import mmap
+import argparse
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from movie_prediction.data_loaders.raw import (
+    load_principal_character_data, read_movie_lines, read_movie_titles, sanitize_movie_titles,
+    process_movie_lines
+)
+from movie_prediction.data_loaders.columnar import raw_data_fingerprint, write_parquet_cache, same_inputs
+from movie_prediction.data_loaders.index import (
+    PrincipalIndex, count_line_keys, LINE_KEY_COLS, fill_keys, NULL_KEY
+)
+from movie_prediction.data_loaders.processed import OUTPUT_COLS, sort_principal_lines
+from movie_prediction.constants import *
+
+__all__ = ['build_principal_movie_lines', 'state_path', 'main']
+
+IMDB_FILES = [IMDB_PRINCIPALS_FILE, IMDB_NAMES_FILE, IMDB_MOVIES_FILE]
+
+# Files of the build state
+_MANIFEST = 'manifest.json'
+_LINES = 'lines.feather'
+_PRINCIPAL_LINES = 'principal_lines.feather'
+_INDEX = 'index.pkl'
+
+# Internal columns
+_MOVIE = 'movieID'
+_POS = '_movie_pos'
+_ROW = '_raw_row'
+_KEY_HASH = '_key_hash'
+
+
+def state_path(output_fp: str) -> str:
+    """
+    Directory of the incremental build state of an output file, next to it.
+    """
+    return output_fp + INCREMENTAL_STATE_SUFFIX
+
+
+def _key_hashes(lines: pd.DataFrame) -> np.ndarray:
+    # Selects the lines of a set of keys with a single `isin`, collisions only select a few lines too many
+    return pd.util.hash_pandas_object(fill_keys(lines[LINE_KEY_COLS]), index=False).values
+
+
+def _movie_digests(raw_lines: pd.DataFrame, raw_titles: pd.DataFrame) -> Dict[str, str]:
+    """
+    Digest the raw lines of every movie, in order, together with its title row.
+    """
+    row_hashes = pd.util.hash_pandas_object(raw_lines, index=False).values
+    positions = raw_lines.groupby(_MOVIE, sort=False).cumcount().values
+    row_hashes = pd.util.hash_pandas_object(pd.DataFrame({'row': row_hashes, 'pos': positions}), index=False)
+    movie_hashes = row_hashes.groupby(raw_lines[_MOVIE].values, sort=False).agg(['sum', 'size'])
+    title_hashes = pd.Series(
+        pd.util.hash_pandas_object(raw_titles, index=False).values, index=raw_titles[_MOVIE].values)
+    title_hashes = title_hashes[~title_hashes.index.duplicated()].reindex(movie_hashes.index)
+    return {
+        str(movie): f'{int(lines_hash):016x}{int(title_hash):016x}{int(size):x}'
+        for movie, lines_hash, size, title_hash in zip(
+            movie_hashes.index, movie_hashes['sum'], movie_hashes['size'], title_hashes.values)
+    }
+
+
+def _read_manifest(state_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(state_dir, _MANIFEST)
+    if not all(os.path.isfile(os.path.join(state_dir, name)) for name in [_MANIFEST, _LINES, _PRINCIPAL_LINES, _INDEX]):
+        return None
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    return manifest if manifest.get('version') == LOADER_VERSION else None
+
+
+def _output_stat(output_fp: str) -> Optional[List[int]]:
+    if not os.path.isfile(output_fp):
+        return None
+    stat = os.stat(output_fp)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _block_key(principal) -> str:
+    return NULL_KEY if pd.isnull(principal) else principal
+
+
+def _concat(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    # Concatenating empty frames would turn integer columns into objects
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0].reset_index(drop=True)
+
+
+def _write_tsv(principal_lines: pd.DataFrame, output_fp: str, dirty: Optional[set],
+               blocks: Optional[Dict[str, List[int]]]) -> Dict[str, List[int]]:
+    """
+    Write the output TSV one principal block at a time, rendering the blocks of `dirty` principals and copying the
+    other blocks from the previous output. Every block is rendered when `dirty` is None.
+    """
+    # Blocks are ordered like `sort_principal_lines`: most lines first, ties by descending name, no principal last
+    order = principal_lines.groupby(PRINCIPAL, sort=False, dropna=False)[PRINCIPAL_LINES].first().reset_index()
+    order = order.sort_values(by=[PRINCIPAL_LINES, PRINCIPAL], ascending=False)[PRINCIPAL].tolist()
+
+    rendered = principal_lines if dirty is None else principal_lines[principal_lines[PRINCIPAL].isin(dirty)]
+    rendered = sort_principal_lines(rendered)
+    rows = rendered.to_csv(sep='\t', index=False, header=False).encode('utf-8').split(b'\n')[:-1]
+    if len(rows) != len(rendered):
+        # A field spans several lines, render the whole output instead
+        if dirty is not None:
+            return _write_tsv(principal_lines, output_fp, None, None)
+        raise ValueError("Principal lines with line breaks can't be written incrementally")
+    sizes = rendered.groupby(PRINCIPAL, sort=False, dropna=False).size()
+    new_blocks, start = {}, 0
+    for principal, size in zip(sizes.index, sizes.values):
+        new_blocks[_block_key(principal)] = b''.join(row + b'\n' for row in rows[start:start + size])
+        start += size
+
+    header = pd.DataFrame(columns=OUTPUT_COLS).to_csv(sep='\t', index=False).encode('utf-8')
+    offsets = {}
+    tmp_fp = output_fp + '.tmp'
+    previous = open(output_fp, 'rb') if dirty is not None and os.path.getsize(output_fp) else None
+    try:
+        old = mmap.mmap(previous.fileno(), 0, access=mmap.ACCESS_READ) if previous else None
+        with open(tmp_fp, 'wb') as output_file:
+            output_file.write(header)
+            position = len(header)
+            for principal in order:
+                key = _block_key(principal)
+                block = new_blocks.get(key)
+                if block is None:
+                    offset, length = blocks[key]
+                    block = old[offset:offset + length]
+                output_file.write(block)
+                offsets[key] = [position, len(block)]
+                position += len(block)
+        if old is not None:
+            old.close()
+    finally:
+        if previous is not None:
+            previous.close()
+    os.replace(tmp_fp, output_fp)
+    return offsets
+
+
+def build_principal_movie_lines(output_fp: str, data_dir: str = DATA_DIR, state_dir: Optional[str] = None,
+                                full: bool = False) -> Dict[str, Any]:
+    """
+    Build or update the principal movie lines dataset, reprocessing only what changed since the last build.
+
+    Movies are tracked by a digest of their raw lines and title. Sanitized lines of unchanged movies are reused,
+    the lines of new and changed movies are joined against the principal index, and `PrincipalIndex.update`
+    re-evaluates only the conflicts of principals whose line counts changed. A changed IMDb dump rebuilds the index
+    and resolves every line again, and edits which renumber the lines of later movies resolve every line again,
+    both still reusing the sanitized lines. The written file is identical to the cache written by a full build
+    with `load_principal_movie_lines`.
+
+    :param output_fp: str
+        Path of the output file, TSV or parquet when it ends in `.parquet`.
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :param state_dir: str, optional
+        Directory of the build state, see `state_path` for the default.
+    :param full: bool, default False
+        Whether to ignore the state and build everything again.
+    :return:
+        Dict[str, Any]
+        Statistics of the build: the numbers of movies, changed and removed movies, keys resolved again,
+        principals whose lines were written again and output lines.
+    """
+    state_dir = state_dir or state_path(output_fp)
+    parquet = output_fp.endswith('.parquet')
+    manifest = None if full else _read_manifest(state_dir)
+    fingerprint = raw_data_fingerprint(data_dir, known=manifest and manifest['fingerprint'])
+    if fingerprint is None:
+        raise FileNotFoundError(f"Raw data files are missing from: {data_dir}")
+    output_valid = manifest is not None and _output_stat(output_fp) == manifest['output']
+    if output_valid and same_inputs(manifest['fingerprint'], fingerprint):
+        print(f"Principal lines are up to date: {output_fp}")
+        return dict(manifest['stats'], changed_movies=0, removed_movies=0, resolved_keys=0, written_principals=0)
+
+    # Digest the movies to find the new, changed and removed ones
+    print("Loading Characters Movie Lines Data...")
+    raw_titles = read_movie_titles(data_dir)
+    raw_lines = read_movie_lines(data_dir)
+    raw_lines = raw_lines[raw_lines[_MOVIE].isin(raw_titles[_MOVIE])].reset_index(drop=True)
+    digests = _movie_digests(raw_lines, raw_titles)
+    old_digests = manifest['movies'] if manifest else {}
+    changed = [movie for movie, digest in digests.items() if old_digests.get(movie) != digest]
+    removed = [movie for movie in old_digests if movie not in digests]
+    print(f"Movies: {len(digests)}, new or changed: {len(changed)}, removed: {len(removed)}")
+
+    # Sanitize the lines of new and changed movies only. Line ids are positions among all lines in the order of the
+    # title merge of `process_movie_lines`, which groups the lines of a movie together when they are not contiguous
+    line_ids = pd.DataFrame({
+        _MOVIE: raw_lines[_MOVIE].values,
+        _POS: raw_lines.groupby(_MOVIE, sort=False).cumcount().values,
+        _ROW: np.arange(len(raw_lines)),
+    }).merge(raw_titles[[_MOVIE]], on=_MOVIE)
+    line_ids[LINE_ID] = np.arange(len(line_ids))
+    rows = line_ids.pop(_ROW).values
+    is_changed = line_ids[_MOVIE].isin(changed).values
+    new_lines = pd.DataFrame(columns=[CHARAC, TITLE, YEAR, UTTERANCE])
+    if is_changed.any():
+        # Given in line id order, the merge keeps the lines in that order
+        new_lines = process_movie_lines(raw_lines.iloc[rows[is_changed]], sanitize_movie_titles(raw_titles))
+        for col in [_MOVIE, _POS, LINE_ID]:
+            new_lines[col] = line_ids.loc[is_changed, col].values
+        new_lines[_KEY_HASH] = _key_hashes(new_lines)
+    stored_lines = pd.read_feather(os.path.join(state_dir, _LINES)) if manifest else new_lines.iloc[:0]
+    is_stale = stored_lines[_MOVIE].isin(changed + removed).values
+    kept_lines = stored_lines[~is_stale].merge(line_ids, on=[_MOVIE, _POS], suffixes=('_old', ''))
+    renumbered = bool((kept_lines[LINE_ID + '_old'] != kept_lines[LINE_ID]).any())
+    lines = _concat([kept_lines.drop(columns=LINE_ID + '_old'), new_lines]).sort_values(LINE_ID)
+    lines = lines.reset_index(drop=True)
+
+    # Rebuild the principal index when the IMDb dumps changed
+    imdb_changed = manifest is None or any(
+        manifest['fingerprint']['files'][name]['digest'] != fingerprint['files'][name]['digest']
+        for name in IMDB_FILES)
+    if imdb_changed:
+        print("Indexing Principal Characters...")
+        index = PrincipalIndex.from_characters(load_principal_character_data(data_dir))
+    else:
+        index = PrincipalIndex.load(os.path.join(state_dir, _INDEX))
+
+    if imdb_changed or renumbered:
+        # Resolve every line again
+        index.fit(count_line_keys(lines))
+        principal_lines = index.lookup(lines)
+        resolved_keys, dirty = len(index.resolved), None
+    else:
+        # Count the lines of the keys of changed movies, including the lines of those keys in other movies
+        stale_lines = stored_lines[is_stale]
+        touched = np.union1d(stale_lines[_KEY_HASH].values, new_lines[_KEY_HASH].values if len(new_lines) else [])
+        key_counts = count_line_keys(lines[np.isin(lines[_KEY_HASH].values, touched)])
+        keys, changed_principals = index.update(
+            key_counts, pd.concat([stale_lines[LINE_KEY_COLS], key_counts[LINE_KEY_COLS]], ignore_index=True))
+        resolved_keys = len(keys)
+
+        # Look the lines of changed movies and of keys resolved again up, keep the other lines as they are
+        resolved_hashes = _key_hashes(keys)
+        stored = pd.read_feather(os.path.join(state_dir, _PRINCIPAL_LINES))
+        is_dropped = stored[_MOVIE].isin(changed + removed).values | np.isin(stored[_KEY_HASH].values, resolved_hashes)
+        relooked = index.lookup(
+            lines[lines[_MOVIE].isin(changed).values | np.isin(lines[_KEY_HASH].values, resolved_hashes)])
+        principal_lines = _concat([stored[~is_dropped], relooked])
+        principal_lines[PRINCIPAL_LINES] = principal_lines[PRINCIPAL_LINES].astype(index.resolved[PRINCIPAL_LINES].dtype)
+
+        dirty = set(changed_principals) | set(stored.loc[is_dropped, PRINCIPAL]) | set(relooked[PRINCIPAL])
+        if stored[PRINCIPAL_LINES].dtype != principal_lines[PRINCIPAL_LINES].dtype or not output_valid:
+            dirty = None
+    print(f"Number of Ambiguous Principal Lines: {index.num_ambiguous}")
+
+    # Write the output, and the state last so an interrupted build starts over
+    print(f"Exporting principal lines to: {output_fp}")
+    os.makedirs(state_dir, exist_ok=True)
+    if os.path.isfile(os.path.join(state_dir, _MANIFEST)):
+        os.remove(os.path.join(state_dir, _MANIFEST))
+    blocks = None
+    if parquet:
+        write_parquet_cache(sort_principal_lines(principal_lines), output_fp, fingerprint=fingerprint)
+        written = principal_lines[PRINCIPAL].nunique(dropna=False)
+    else:
+        blocks = _write_tsv(principal_lines, output_fp, dirty, manifest and manifest.get('blocks'))
+        written = len(blocks) if dirty is None else len(dirty)
+
+    # Uncompressed feather files are the fastest to write and read back
+    lines.to_feather(os.path.join(state_dir, _LINES), compression='uncompressed')
+    principal_lines.to_feather(os.path.join(state_dir, _PRINCIPAL_LINES), compression='uncompressed')
+    index.save(os.path.join(state_dir, _INDEX))
+    stats = {'movies': len(digests), 'lines': len(principal_lines)}
+    with open(os.path.join(state_dir, _MANIFEST + '.tmp'), 'w') as manifest_file:
+        json.dump({'version': LOADER_VERSION, 'fingerprint': fingerprint, 'movies': digests, 'stats': stats,
+                   'output': _output_stat(output_fp), 'blocks': blocks}, manifest_file)
+    os.replace(os.path.join(state_dir, _MANIFEST + '.tmp'), os.path.join(state_dir, _MANIFEST))
+
+    print(f"Lines after principal merge: {len(principal_lines)} ({resolved_keys} keys resolved, "
+          f"{written} principals written)")
+    return dict(stats, changed_movies=len(changed), removed_movies=len(removed), resolved_keys=resolved_keys,
+                written_principals=written)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Update the principal movie lines dataset, only reprocessing new or changed movies.")
+    parser.add_argument('--output', default=DATA_DIR + '/' + PRINCIPALS_LINES_DEFAULT,
+                        help="TSV file, or parquet file when ending in .parquet, to build or update.")
+    parser.add_argument('--data-dir', default=DATA_DIR, help="Directory containing the raw datasets.")
+    parser.add_argument('--state-dir', default=None, help="Directory of the build state, next to the output.")
+    parser.add_argument('--full', action='store_true', help="Ignore the state and build everything again.")
+    args = parser.parse_args(argv)
+    print(json.dumps(build_principal_movie_lines(args.output, args.data_dir, args.state_dir, args.full)))
+
+
+if __name__ == '__main__':
+    main()
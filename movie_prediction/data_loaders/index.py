@@ -0,0 +1,293 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from movie_prediction.utils import sanitize_string
+from movie_prediction.constants import *
+
+__all__ = [
+    'PrincipalIndex', 'count_line_keys', 'combine_line_key_counts', 'fill_keys', 'MERGE_COLS', 'LINE_KEY_COLS',
+    'NULL_KEY'
+]
+
+# Character name variants, in the order they are tried when matching a line's character
+MERGE_COLS = [
+    CHARAC_RAW, CHARAC_FIRST,
+    CHARAC_LAST, CHARAC_FIRST_LAST,
+    CHARAC_FULL,
+]
+LINE_KEY_COLS = [CHARAC, TITLE, YEAR]
+
+# Internal columns
+MERGE_PASS = '_pass'
+CHAR_ROW = '_char_row'
+KEY_LINES = '_key_lines'
+KEY_FIRST_LINE = '_key_first_line'
+
+# pandas merges match missing keys with each other, a sentinel which sanitized names can't contain keeps that behaviour
+NULL_KEY = '\0'
+
+
+def fill_keys(keys: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replace the missing values of line keys with `NULL_KEY`, so they can be grouped, merged and hashed.
+    """
+    return keys.fillna(NULL_KEY)
+
+
+def count_line_keys(movie_lines: pd.DataFrame) -> pd.DataFrame:
+    """
+    Count the lines of every (character, title, year) key and the first line id it appears on.
+
+    :param movie_lines: pd.DataFrame
+        Movie lines with `LINE_ID`, `CHARAC`, `TITLE` and `YEAR` columns.
+    :return:
+        pd.DataFrame
+        One row per key with `KEY_LINES` and `KEY_FIRST_LINE` columns.
+    """
+    keys = fill_keys(movie_lines[LINE_KEY_COLS])
+    keys[LINE_ID] = movie_lines[LINE_ID].values
+    return keys.groupby(LINE_KEY_COLS, sort=False)[LINE_ID].agg(['size', 'min']).rename(
+        columns={'size': KEY_LINES, 'min': KEY_FIRST_LINE}).reset_index()
+
+
+def combine_line_key_counts(key_counts: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Combine the `count_line_keys` results of several chunks of lines.
+    """
+    return pd.concat(key_counts, ignore_index=True).groupby(LINE_KEY_COLS, sort=False).agg(
+        {KEY_LINES: 'sum', KEY_FIRST_LINE: 'min'}).reset_index()
+
+
+class PrincipalIndex:
+    """
+    Lookup index mapping a line's (character name, title, year) to the principal who played the character.
+
+    A character name matches a principal's character through the first of the `MERGE_COLS` name variants which
+    has any match for that title and year. When a name matches several principals, the index is fit on line counts
+    so the principal with the most lines in the dataset wins, and every line is then resolved with a single probe.
+    """
+
+    def __init__(self, characters: pd.DataFrame, entries: pd.DataFrame):
+        """
+        :param characters: pd.DataFrame
+            Principal character data, as returned by `load_principal_character_data`, indexed by character row.
+        :param entries: pd.DataFrame
+            The candidate character rows of every name key, see `from_characters`.
+        """
+        self.characters = characters
+        self.entries = entries
+        self.principal_counts = None
+        self.resolved = None
+        self.num_ambiguous = 0
+        self._principals = None
+
+    @classmethod
+    def from_characters(cls, characters: pd.DataFrame, titles: Optional[pd.DataFrame] = None) -> 'PrincipalIndex':
+        """
+        Build the name lookup from principal character data.
+
+        :param characters: pd.DataFrame
+            Principal character data, as returned by `load_principal_character_data`.
+        :param titles: pd.DataFrame, optional
+            `TITLE` and `YEAR` of the movies to index, e.g. from `load_movie_title_data`. Defaults to all movies.
+        :return:
+            PrincipalIndex
+        """
+        characters = characters.reset_index(drop=True)
+        characters.index.name = CHAR_ROW
+        if titles is not None:
+            characters = characters.reset_index().merge(
+                titles[[TITLE, YEAR]].drop_duplicates(), on=[TITLE, YEAR]
+            ).set_index(CHAR_ROW).sort_index()
+
+        # Stack every name variant and keep the candidates of the first variant matching each key
+        entries = pd.concat([
+            pd.DataFrame({
+                CHARAC: characters[merge_col].values,
+                TITLE: characters[TITLE].values,
+                YEAR: characters[YEAR].values,
+                MERGE_PASS: merge_pass,
+                CHAR_ROW: characters.index.values,
+            })
+            for merge_pass, merge_col in enumerate(MERGE_COLS)
+        ], ignore_index=True)
+        entries[LINE_KEY_COLS] = fill_keys(entries[LINE_KEY_COLS])
+        first_pass = entries.groupby(LINE_KEY_COLS, sort=False)[MERGE_PASS].transform('min')
+        entries = entries[entries[MERGE_PASS] == first_pass].reset_index(drop=True)
+
+        return cls(characters, entries)
+
+    def fit(self, key_counts: pd.DataFrame) -> 'PrincipalIndex':
+        """
+        Count the lines of every principal and assign each name key to the principal with the most lines,
+        ties going to the principal with the greater name.
+
+        :param key_counts: pd.DataFrame
+            Line counts per key, see `count_line_keys`.
+        :return:
+            PrincipalIndex
+            The fitted index.
+        """
+        candidates = self._candidates(key_counts)
+        self.num_ambiguous = self._ambiguous_lines(candidates)
+
+        self.principal_counts = candidates.groupby(PRINCIPAL)[KEY_LINES].sum().sort_values(ascending=False)
+        candidates[PRINCIPAL_LINES] = candidates[PRINCIPAL].map(self.principal_counts)
+        if not candidates[PRINCIPAL_LINES].isnull().any():
+            candidates[PRINCIPAL_LINES] = candidates[PRINCIPAL_LINES].astype(np.int64)
+        self.resolved = self._resolve(candidates)
+        self._principals = None
+        return self
+
+    @staticmethod
+    def _resolve(candidates: pd.DataFrame) -> pd.DataFrame:
+        # Keep the candidate with the most principal lines per key, ties going to the greater principal name
+        return candidates.sort_values(
+            by=[PRINCIPAL_LINES, PRINCIPAL, CHAR_ROW], ascending=[False, False, True], kind='mergesort'
+        ).drop_duplicates(subset=LINE_KEY_COLS, keep='first').reset_index(drop=True)
+
+    def _candidates(self, key_counts: pd.DataFrame) -> pd.DataFrame:
+        candidates = self.entries.merge(key_counts, on=LINE_KEY_COLS, how='inner')
+        candidates[PRINCIPAL] = self.characters.loc[candidates[CHAR_ROW], PRINCIPAL].values
+        return candidates
+
+    @staticmethod
+    def _ambiguous_lines(candidates: pd.DataFrame) -> int:
+        return int(candidates.loc[candidates.duplicated(subset=LINE_KEY_COLS, keep=False), KEY_LINES].sum())
+
+    def update(self, key_counts: pd.DataFrame, keys: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Index]:
+        """
+        Refit the index after the lines of some keys changed, e.g. when movies were added, edited or removed.
+
+        The line counts of the principals who are candidates of the changed keys are updated, and only the keys
+        with one of those principals as a candidate are resolved again. The index ends up as if `fit` was called
+        on the line counts of all keys.
+
+        :param key_counts: pd.DataFrame
+            New line counts of the changed keys, see `count_line_keys`. Keys left without lines are omitted.
+        :param keys: pd.DataFrame
+            `CHARAC`, `TITLE` and `YEAR` of every changed key, including the keys left without lines.
+        :return:
+            Tuple[pd.DataFrame, pd.Index]
+            The keys resolved again, whose lines may have a new principal or principal line count,
+            and the principals whose line counts changed.
+        """
+        if self.resolved is None:
+            raise RuntimeError("PrincipalIndex.fit must be called before updating it")
+        keys = fill_keys(keys[LINE_KEY_COLS]).drop_duplicates()
+        key_counts = key_counts[LINE_KEY_COLS + [KEY_LINES, KEY_FIRST_LINE]]
+
+        # Swap the contribution of the changed keys to their candidates' line counts
+        old_candidates = self._candidates(self.resolved.merge(keys, on=LINE_KEY_COLS)[LINE_KEY_COLS + [KEY_LINES]])
+        new_candidates = self._candidates(key_counts)
+        delta = new_candidates.groupby(PRINCIPAL)[KEY_LINES].sum().sub(
+            old_candidates.groupby(PRINCIPAL)[KEY_LINES].sum(), fill_value=0)
+        changed_principals = delta.index[delta != 0]
+        principal_counts = self.principal_counts.add(delta[delta != 0], fill_value=0)
+        self.principal_counts = principal_counts[principal_counts > 0].astype(np.int64).sort_values(ascending=False)
+        self.num_ambiguous += self._ambiguous_lines(new_candidates) - self._ambiguous_lines(old_candidates)
+
+        # Resolve the changed keys and the unchanged keys competed for by a principal whose line count changed
+        entry_principals = self.characters.loc[self.entries[CHAR_ROW], PRINCIPAL]
+        competed = self.entries.loc[entry_principals.isin(changed_principals).values, LINE_KEY_COLS].drop_duplicates()
+        unchanged = self.resolved.merge(keys, on=LINE_KEY_COLS, how='left', indicator=True)
+        unchanged = self.resolved[(unchanged['_merge'] == 'left_only').values]
+        competed = unchanged.merge(competed, on=LINE_KEY_COLS)[LINE_KEY_COLS + [KEY_LINES, KEY_FIRST_LINE]]
+        resolved_keys = pd.concat([key_counts, competed], ignore_index=True)
+
+        candidates = self._candidates(resolved_keys)
+        candidates[PRINCIPAL_LINES] = candidates[PRINCIPAL].map(self.principal_counts)
+        kept = unchanged.merge(competed[LINE_KEY_COLS], on=LINE_KEY_COLS, how='left', indicator=True)
+        kept = unchanged[(kept['_merge'] == 'left_only').values]
+        resolved = pd.concat([kept, self._resolve(candidates)], ignore_index=True)
+
+        # Like `fit`, line counts are integers unless a key with lines has a candidate without a principal
+        null_entries = self.entries.loc[entry_principals.isnull().values, LINE_KEY_COLS]
+        if null_entries.empty or null_entries.merge(resolved[LINE_KEY_COLS], on=LINE_KEY_COLS).empty:
+            resolved[PRINCIPAL_LINES] = resolved[PRINCIPAL_LINES].astype(np.int64)
+        else:
+            resolved[PRINCIPAL_LINES] = resolved[PRINCIPAL_LINES].astype(np.float64)
+        self.resolved = resolved
+        self._principals = None
+        return resolved_keys[LINE_KEY_COLS], changed_principals
+
+    def lookup(self, movie_lines: pd.DataFrame) -> pd.DataFrame:
+        """
+        Assign principals to movie lines with a single probe per line.
+
+        :param movie_lines: pd.DataFrame
+            Movie lines with `CHARAC`, `TITLE` and `YEAR` columns.
+        :return:
+            pd.DataFrame
+            The matched lines, in their original order, with the matched character's name variants, `PRINCIPAL`
+            and `PRINCIPAL_LINES` columns, plus the internal `MERGE_PASS` and `KEY_FIRST_LINE` columns.
+        """
+        if self.resolved is None:
+            raise RuntimeError("PrincipalIndex.fit must be called before looking up lines")
+        keys = fill_keys(movie_lines[LINE_KEY_COLS])
+        keys['_row'] = np.arange(len(keys))
+        matched = keys.merge(self.resolved, on=LINE_KEY_COLS, how='inner').sort_values('_row')
+
+        principal_lines = movie_lines.iloc[matched['_row'].values].reset_index(drop=True)
+        principal_lines[MERGE_COLS] = self.characters.loc[matched[CHAR_ROW], MERGE_COLS].reset_index(drop=True)
+        for col in [PRINCIPAL, PRINCIPAL_LINES, MERGE_PASS, KEY_FIRST_LINE]:
+            if col in matched:
+                principal_lines[col] = matched[col].values
+        return principal_lines
+
+    @property
+    def principals(self) -> Dict[Tuple[str, str, int], str]:
+        """
+        Mapping from sanitized (character, title, year) keys to principals.
+        """
+        if self._principals is None:
+            self._principals = {
+                (name, title, year): principal for name, title, year, principal
+                in self.resolved[LINE_KEY_COLS + [PRINCIPAL]].itertuples(index=False)
+                if name != NULL_KEY and title != NULL_KEY
+            }
+        return self._principals
+
+    def who_plays(self, character: str, title: str, year: int) -> Optional[str]:
+        """
+        Return the principal who plays a character in a movie.
+
+        :param character: str
+            The character name as it appears in a script.
+        :param title: str
+            The movie title.
+        :param year: int
+            The movie release year.
+        :return:
+            str or None
+            The principal, or None if the character is unknown.
+        """
+        sanitize_args = dict(upper=True, alphanumeric_only=True, strip=True, whitespace=True)
+        return self.principals.get(
+            (sanitize_string(character, **sanitize_args), sanitize_string(title, **sanitize_args), int(year)))
+
+    def save(self, path: str):
+        """
+        Serialize the index to `path`.
+        """
+        pd.to_pickle({
+            'characters': self.characters,
+            'entries': self.entries,
+            'principal_counts': self.principal_counts,
+            'resolved': self.resolved,
+            'num_ambiguous': self.num_ambiguous,
+        }, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'PrincipalIndex':
+        """
+        Load an index serialized with `save`.
+        """
+        state = pd.read_pickle(path)
+        index = cls(state['characters'], state['entries'])
+        index.principal_counts = state['principal_counts']
+        index.resolved = state['resolved']
+        index.num_ambiguous = state['num_ambiguous']
+        return index
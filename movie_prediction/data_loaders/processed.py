@@ -1,72 +1,113 @@
 import os
+import heapq
+import tempfile
+from typing import Optional
+
+import numpy as np
 import pandas as pd
 
-from movie_prediction.data_loaders.raw import load_principal_character_data, load_movie_line_data
+from movie_prediction.data_loaders.raw import (
+    load_principal_character_data, load_movie_line_data, iter_movie_line_data, load_movie_title_data
+)
+from movie_prediction.data_loaders.columnar import raw_data_fingerprint, read_parquet_cache, write_parquet_cache
+from movie_prediction.data_loaders.index import (
+    PrincipalIndex, count_line_keys, combine_line_key_counts, MERGE_COLS, MERGE_PASS, KEY_FIRST_LINE
+)
 from movie_prediction.constants import *
 
-__all__ = ['load_principal_movie_lines']
+__all__ = ['load_principal_movie_lines', 'stream_principal_movie_lines', 'sort_principal_lines', 'OUTPUT_COLS']
+
+OUTPUT_COLS = [
+    LINE_ID, CHARAC, TITLE, YEAR, UTTERANCE,
+    CHARAC_RAW, CHARAC_FIRST, CHARAC_LAST, CHARAC_FIRST_LAST, CHARAC_FULL,
+    PRINCIPAL, PRINCIPAL_LINES,
+]
 
+_PRINCIPAL_RANK = '_principal_rank'
 
-def load_principal_movie_lines(cache_fp: str = None) -> pd.DataFrame:
+
+def load_principal_movie_lines(cache_fp: str = None, streaming: bool = False,
+                               chunksize: int = LINE_CHUNK_SIZE_DEFAULT,
+                               data_dir: str = DATA_DIR, categorical: bool = False,
+                               incremental: bool = False) -> pd.DataFrame:
     """
     Function for creating/loading principal and movie lines dataset.
 
     :param cache_fp: str
-        Path to file used for caching processed data.
+        Path to file used for caching processed data. Paths ending in `.parquet` use a columnar cache which
+        is memory mapped on load and rebuilt when the raw data or the loader version changes, other paths
+        use a TSV cache.
+    :param streaming: bool, default False
+        Whether to build the dataset with `stream_principal_movie_lines`, which bounds memory by `chunksize`
+        instead of the dataset size. The cache file it writes is identical to the in-memory build.
+    :param chunksize: int, default LINE_CHUNK_SIZE_DEFAULT
+        Number of movie lines processed at a time when streaming.
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :param categorical: bool, default False
+        Whether to load the `Principal`, `Title` and `Character` columns as categoricals from a parquet cache.
+    :param incremental: bool, default False
+        Whether to update the cache with `build_principal_movie_lines`, which only processes the movies that changed
+        since the cache was last built. The cache is identical to a full build. Requires `cache_fp`.
     :return:
         pd.DataFrame
     """
-    if cache_fp and os.path.isfile(cache_fp):
+    if incremental:
+        if not cache_fp:
+            raise ValueError("Incremental builds update a cache, set cache_fp")
+        from movie_prediction.data_loaders.incremental import build_principal_movie_lines
+        build_principal_movie_lines(cache_fp, data_dir=data_dir)
+        if cache_fp.endswith('.parquet'):
+            return read_parquet_cache(cache_fp, categorical=categorical, validate=False)
+        return pd.read_csv(cache_fp, sep='\t', converters={UTTERANCE: str})
+
+    if cache_fp and cache_fp.endswith('.parquet'):
+        principal_lines = read_parquet_cache(cache_fp, data_dir, categorical=categorical)
+        if principal_lines is None:
+            fingerprint = raw_data_fingerprint(data_dir)
+            principal_lines = load_principal_movie_lines(
+                streaming=streaming, chunksize=chunksize, data_dir=data_dir)
+            print(f"Exporting principal lines to: {cache_fp}")
+            write_parquet_cache(principal_lines, cache_fp, fingerprint=fingerprint)
+            principal_lines = read_parquet_cache(cache_fp, categorical=categorical, validate=False)
+        else:
+            print(f"Loading principal lines from cache: {cache_fp}")
+    elif cache_fp and os.path.isfile(cache_fp):
         print(f"Loading principal lines from cache: {cache_fp}")
         principal_lines = pd.read_csv(cache_fp, sep='\t', converters={UTTERANCE: str})
+    elif streaming:
+        if cache_fp:
+            stream_principal_movie_lines(cache_fp, chunksize=chunksize, data_dir=data_dir)
+            principal_lines = pd.read_csv(cache_fp, sep='\t', converters={UTTERANCE: str})
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                output_fp = tmp_dir + '/' + PRINCIPALS_LINES_DEFAULT
+                stream_principal_movie_lines(output_fp, chunksize=chunksize, data_dir=data_dir)
+                principal_lines = pd.read_csv(output_fp, sep='\t', converters={UTTERANCE: str})
     else:
         print("Creating principal movie lines dataset...")
         # Load Principals Characters Dataset
         print("Loading principals Data...")
-        characters = load_principal_character_data()
+        characters = load_principal_character_data(data_dir)
         raw_char_num = len(characters)
         print(f"Raw Number of Characters: {raw_char_num}")
 
         # Load Character Movie Lines
         print("Loading Characters Movie Lines Data...")
-        movie_lines = load_movie_line_data()
+        movie_lines = load_movie_line_data(data_dir)
         movie_lines = movie_lines.reset_index().rename(columns={'index': LINE_ID})
         raw_line_num = len(movie_lines)
         print(f"Raw number of lines: {raw_line_num}")
 
-        # Attempt to Merge Principals Using Character Names
+        # Index principals by character name and assign lines with conflicting principals
+        # to the principal with more total lines in our dataset
+        print("Indexing Principal Characters...")
+        index = PrincipalIndex.from_characters(characters).fit(count_line_keys(movie_lines))
+        print(f"Number of Ambiguous Principal Lines: {index.num_ambiguous}")
+
+        # Merge Principals Using Character Names
         print("Merging Principals and Character Lines...")
-        MERG_COLS = [
-            CHARAC_RAW, CHARAC_FIRST,
-            CHARAC_LAST, CHARAC_FIRST_LAST,
-            CHARAC_FULL,
-        ]
-        merged_line_ids = set()
-        principal_lines = []
-        for merge_col in MERG_COLS:
-            merged_filt = movie_lines[LINE_ID].isin(merged_line_ids)
-            data = movie_lines[~merged_filt].merge(
-                characters, left_on=[CHARAC, TITLE, YEAR],
-                right_on=[merge_col, TITLE, YEAR],
-                how='inner'
-            )
-            merged_line_ids.update(data[LINE_ID].values)
-            principal_lines.append(data)
-        principal_lines = pd.concat(principal_lines)
-
-        # Some characters have more than one principal
-        # Assign lines to the principal with more total lines in our dataset
-        print("Assigning Lines with Conflicting Principals...")
-        num_duplicates = principal_lines[LINE_ID].duplicated(keep=False).value_counts()[True]
-        print(f"Number of Ambiguous Principal Lines: {num_duplicates}")
-        principal_lines = principal_lines.merge(
-            principal_lines[PRINCIPAL].value_counts().reset_index().rename(
-                columns={PRINCIPAL: PRINCIPAL_LINES, 'index': PRINCIPAL}),
-                on=PRINCIPAL, how='left')
-        principal_lines = principal_lines.sort_values(
-            by=[PRINCIPAL_LINES, PRINCIPAL],
-            ascending=False
-        ).drop_duplicates(subset=[LINE_ID], keep='first')
+        principal_lines = sort_principal_lines(index.lookup(movie_lines))
 
         # Count Merge statistics
         merged_line_num = len(principal_lines)
@@ -76,3 +117,108 @@ def load_principal_movie_lines(cache_fp: str = None) -> pd.DataFrame:
             principal_lines.to_csv(cache_fp, sep='\t', index=False)
 
     return principal_lines
+
+
+def sort_principal_lines(principal_lines: pd.DataFrame) -> pd.DataFrame:
+    """
+    Order lines by principal, most lines first, then by the name variant they matched on,
+    the first line of their character and their line id, and keep the `OUTPUT_COLS`.
+    """
+    return principal_lines.sort_values(
+        by=[PRINCIPAL_LINES, PRINCIPAL, MERGE_PASS, KEY_FIRST_LINE, LINE_ID],
+        ascending=[False, False, True, True, True]
+    )[OUTPUT_COLS]
+
+
+def _run_lines(run_fp: str):
+    keys = np.load(run_fp + '.npy', mmap_mode='r')
+    with open(run_fp, newline='') as run_file:
+        for key, line in zip(keys, run_file):
+            yield tuple(key), line
+
+
+def _numbered_line_chunks(chunksize: int, data_dir: str):
+    line_offset = 0
+    for movie_lines in iter_movie_line_data(chunksize, data_dir):
+        movie_lines = movie_lines.reset_index(drop=True)
+        movie_lines.insert(0, LINE_ID, np.arange(line_offset, line_offset + len(movie_lines)))
+        line_offset += len(movie_lines)
+        yield movie_lines
+
+
+def stream_principal_movie_lines(output_fp: str, chunksize: int = LINE_CHUNK_SIZE_DEFAULT,
+                                 data_dir: str = DATA_DIR, index: Optional[PrincipalIndex] = None) -> int:
+    """
+    Build the principal movie lines dataset while reading the movie lines in chunks, and write it to `output_fp`.
+
+    A first pass over the chunks counts the lines of every character, which fits the principal index.
+    A second pass resolves every line with a single index probe and writes each chunk as a sorted run,
+    and the runs are merged into the output. Peak memory is bounded by the chunk size rather than the
+    dataset size, and the written file is identical to the cache written by the in-memory build of
+    `load_principal_movie_lines`.
+
+    :param output_fp: str
+        Path of the TSV file to write.
+    :param chunksize: int, default LINE_CHUNK_SIZE_DEFAULT
+        Number of movie lines processed at a time.
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :param index: PrincipalIndex, optional
+        A prebuilt principal index, it is refit on the line counts. By default one is built for the
+        movies with scripted lines.
+    :return:
+        int
+        The number of lines written.
+    """
+    print("Streaming principal movie lines dataset...")
+    if index is None:
+        print("Loading principals Data...")
+        characters = load_principal_character_data(data_dir)
+        print(f"Raw Number of Characters: {len(characters)}")
+        index = PrincipalIndex.from_characters(characters, titles=load_movie_title_data(data_dir))
+
+    # First pass: count the lines of every character to fit the index
+    print("Counting Character Lines...")
+    key_counts, raw_line_num = [], 0
+    for movie_lines in _numbered_line_chunks(chunksize, data_dir):
+        key_counts.append(count_line_keys(movie_lines))
+        raw_line_num += len(movie_lines)
+    print(f"Raw number of lines: {raw_line_num}")
+    index.fit(combine_line_key_counts(key_counts))
+    print(f"Number of Ambiguous Principal Lines: {index.num_ambiguous}")
+
+    # Principals ordered as in the output: most lines first, ties broken by descending name, unknown principals last
+    principal_rank = {
+        principal: rank for rank, (principal, _) in enumerate(
+            sorted(index.principal_counts.items(), key=lambda x: (x[1], x[0]), reverse=True))
+    }
+
+    # Second pass: probe the index and write each chunk as a sorted run
+    print("Merging Principals and Character Lines...")
+    merged_line_num = 0
+    with tempfile.TemporaryDirectory() as run_dir:
+        run_fps = []
+        for movie_lines in _numbered_line_chunks(chunksize, data_dir):
+            principal_lines = index.lookup(movie_lines)
+            if principal_lines.empty:
+                continue
+            principal_lines[_PRINCIPAL_RANK] = principal_lines[PRINCIPAL].map(principal_rank).fillna(
+                len(principal_rank)).astype(np.int64)
+            sort_cols = [_PRINCIPAL_RANK, MERGE_PASS, KEY_FIRST_LINE, LINE_ID]
+            principal_lines = principal_lines.sort_values(by=sort_cols)
+
+            run_fp = run_dir + f'/run_{len(run_fps)}.tsv'
+            np.save(run_fp + '.npy', principal_lines[sort_cols].to_numpy(dtype=np.int64))
+            principal_lines[OUTPUT_COLS].to_csv(run_fp, sep='\t', index=False, header=False)
+            run_fps.append(run_fp)
+            merged_line_num += len(principal_lines)
+
+        # Merge the sorted runs into the output
+        print(f"Exporting principal lines to: {output_fp}")
+        with open(output_fp, 'w', newline='') as output_file:
+            pd.DataFrame(columns=OUTPUT_COLS).to_csv(output_file, sep='\t', index=False)
+            for _, line in heapq.merge(*[_run_lines(run_fp) for run_fp in run_fps], key=lambda x: x[0]):
+                output_file.write(line)
+
+    print(f"Lines after principal merge: {merged_line_num} ({100 * merged_line_num / raw_line_num:.2f} %)")
+    return merged_line_num
@@ -1,22 +1,29 @@
+from typing import Iterator
+
 import pandas as pd
 
-from movie_prediction.utils import sanitize_string_column, extract_names
+from movie_prediction.utils import sanitize_string_column, extract_names_column
 from movie_prediction.constants import *
 
-__all__ = ['load_principal_character_data', 'load_movie_line_data']
+__all__ = [
+    'load_principal_character_data', 'load_movie_line_data', 'iter_movie_line_data', 'load_movie_title_data',
+    'read_movie_lines', 'read_movie_titles', 'sanitize_movie_titles', 'process_movie_lines'
+]
 
 
-def load_principal_character_data() -> pd.DataFrame:
+def load_principal_character_data(data_dir: str = DATA_DIR) -> pd.DataFrame:
     """
     This function reads the IMBD movie metadata dataset to create a dataframe which maps
     principals by their birth name to characters they played in a movie.
 
     ref: https://www.kaggle.com/stefanoleone992/imdb-extensive-dataset?select=IMDb+title_principals.csv
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
     :return:
     """
     # First read all movie characters
     movie_characters = pd.read_csv(
-        DATA_DIR + '/imdb_movie_meta/IMDb title_principals.csv',
+        data_dir + '/' + IMDB_PRINCIPALS_FILE,
         converters={"characters": lambda x: x.strip("[]").replace('"', '').split(", ")})
     movie_characters = movie_characters[
         movie_characters['category'].isin(['actor', 'actress'])
@@ -24,12 +31,12 @@ def load_principal_character_data() -> pd.DataFrame:
         ].explode('characters')
 
     # Next read all movie principals and merge
-    movie_principals = pd.read_csv('../data/imdb_movie_meta/IMDb names.csv')
+    movie_principals = pd.read_csv(data_dir + '/' + IMDB_NAMES_FILE)
     movie_characters = movie_characters.merge(
         movie_principals[['imdb_name_id', 'birth_name']], on='imdb_name_id')
 
     # Then read all movie titles and merge
-    movie_titles = pd.read_csv('../data/imdb_movie_meta/IMDb movies.csv', converters={'year': str})
+    movie_titles = pd.read_csv(data_dir + '/' + IMDB_MOVIES_FILE, converters={'year': str})
     movie_characters = movie_characters.merge(
         movie_titles[['imdb_title_id', 'original_title', 'year']], on='imdb_title_id')
     movie_characters['Year'] = movie_characters['year'].str.extract(r'.*(\d{4}).*').astype(int)[0]
@@ -37,12 +44,9 @@ def load_principal_character_data() -> pd.DataFrame:
     # Sanitize Character and Extract name elements
     movie_characters[CHARAC_RAW] = sanitize_string_column(
         movie_characters['characters'], upper=True, alphanumeric_only=True, strip=True, whitespace=True)
-    movie_characters = pd.concat([
-        movie_characters,
-        pd.DataFrame(
-            list(movie_characters[CHARAC_RAW].apply(extract_names).values),
-            columns=[CHARAC_FIRST, CHARAC_LAST, CHARAC_FIRST_LAST, CHARAC_FULL])
-    ], axis=1)
+    names = extract_names_column(movie_characters[CHARAC_RAW])
+    for name_col, name in zip([CHARAC_FIRST, CHARAC_LAST, CHARAC_FIRST_LAST, CHARAC_FULL], names):
+        movie_characters[name_col] = name
 
     # Finally process character, principals and titles data
     movie_characters[PRINCIPAL] = sanitize_string_column(
@@ -57,40 +61,127 @@ def load_principal_character_data() -> pd.DataFrame:
     return movie_characters
 
 
-def load_movie_line_data() -> pd.DataFrame:
+def read_movie_lines(data_dir: str, chunksize: int = None):
     """
-    This function reads the cornell movie scripts dataset to create a dataframe which maps movie lines to their
-    character, title, and year.
+    Read the raw cornell movie lines, unprocessed.
 
-    ref: https://www.kaggle.com/Cornell-University/movie-dialog-corpus
+    :param data_dir: str
+        Directory containing the raw datasets.
+    :param chunksize: int, optional
+        Read the lines this many at a time, returning an iterator of dataframes instead of a dataframe.
     :return:
+        pd.DataFrame or Iterator[pd.DataFrame]
+        The `lineID`, `characterID`, `movieID`, `character name` and `utterance` columns of the raw file.
     """
-    # Read in movie lines
-    movie_lines = pd.read_csv(
-        DATA_DIR + '/cornell_movie_scripts/movie_lines.tsv',
+    return pd.read_csv(
+        data_dir + '/' + CORNELL_LINES_FILE,
         sep='\t', encoding='utf-8',
         error_bad_lines=False, warn_bad_lines=False,
         names=['lineID', 'characterID', 'movieID',
-               'character name', 'utterance']
+               'character name', 'utterance'],
+        chunksize=chunksize
     )
 
-    # Read in movie titles and merge
-    movie_titles = pd.read_csv(
-        '../data/cornell_movie_scripts/movie_titles_metadata.tsv',
+
+def read_movie_titles(data_dir: str) -> pd.DataFrame:
+    """
+    Read the raw cornell movie titles metadata, unprocessed, see `sanitize_movie_titles`.
+
+    :param data_dir: str
+        Directory containing the raw datasets.
+    :return:
+        pd.DataFrame
+        The columns of the raw file, movie years read as strings.
+    """
+    return pd.read_csv(
+        data_dir + '/' + CORNELL_TITLES_FILE,
         sep='\t', encoding='utf-8',
         error_bad_lines=False,
         names=['movieID', 'movie title', 'movie year', 'IMDB rating',
                'IMDB votes', 'genres'],
         converters={'movie year': str}
     )
-    movie_lines = movie_lines.merge(movie_titles[['movieID', 'movie title', 'movie year']], on='movieID')
 
-    # Sanitize Character, Title, Year, and Utterance columns
+
+def sanitize_movie_titles(movie_titles: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the sanitized `Title` and the four digit `Year` to movie titles from `read_movie_titles`, in place.
+
+    :param movie_titles: pd.DataFrame
+        The raw movie titles.
+    :return:
+        pd.DataFrame
+        The same dataframe.
+    """
+    movie_titles[TITLE] = sanitize_string_column(
+        movie_titles['movie title'], upper=True, alphanumeric_only=True, strip=True, whitespace=True)
+    movie_titles[YEAR] = movie_titles['movie year'].str.extract(r'.*(\d{4}).*').astype(int)[0]
+    return movie_titles
+
+
+def process_movie_lines(movie_lines: pd.DataFrame, movie_titles: pd.DataFrame) -> pd.DataFrame:
+    """
+    Attach their movie's title and year to raw movie lines and sanitize their character names and utterances.
+    Lines are processed independently of each other, so chunks of lines can be processed separately.
+
+    :param movie_lines: pd.DataFrame
+        Raw movie lines from `read_movie_lines`.
+    :param movie_titles: pd.DataFrame
+        Movie titles from `sanitize_movie_titles`.
+    :return:
+        pd.DataFrame
+        The `Character`, `Title`, `Year` and `Utterance` of every line with a known movie.
+    """
+    # Merge sanitized movie titles
+    movie_lines = movie_lines.merge(movie_titles[['movieID', TITLE, YEAR]], on='movieID')
+
+    # Sanitize Character and Utterance columns
     movie_lines[CHARAC] = sanitize_string_column(
         movie_lines['character name'], upper=True, alphanumeric_only=True, strip=True, whitespace=True)
-    movie_lines[TITLE] = sanitize_string_column(
-        movie_lines['movie title'], upper=True, alphanumeric_only=True, strip=True, whitespace=True)
-    movie_lines[YEAR] = movie_lines['movie year'].str.extract(r'.*(\d{4}).*').astype(int)[0]
     movie_lines[UTTERANCE] = sanitize_string_column(movie_lines['utterance'].astype(str), whitespace=True)
 
     return movie_lines[[CHARAC, TITLE, YEAR, UTTERANCE]]
+
+
+def load_movie_line_data(data_dir: str = DATA_DIR) -> pd.DataFrame:
+    """
+    This function reads the cornell movie scripts dataset to create a dataframe which maps movie lines to their
+    character, title, and year.
+
+    ref: https://www.kaggle.com/Cornell-University/movie-dialog-corpus
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :return:
+    """
+    movie_titles = sanitize_movie_titles(read_movie_titles(data_dir))
+    return process_movie_lines(read_movie_lines(data_dir), movie_titles)
+
+
+def iter_movie_line_data(chunksize: int = LINE_CHUNK_SIZE_DEFAULT, data_dir: str = DATA_DIR) -> Iterator[pd.DataFrame]:
+    """
+    Chunked version of `load_movie_line_data` which reads the cornell movie lines `chunksize` raw lines at a time.
+    Concatenating the chunks gives the same rows, in the same order, as `load_movie_line_data` as long as the
+    lines of each movie are contiguous in the raw file, which is the case for the cornell corpus.
+
+    :param chunksize: int, default LINE_CHUNK_SIZE_DEFAULT
+        Number of raw lines to read per chunk.
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :return:
+        Iterator[pd.DataFrame]
+    """
+    movie_titles = sanitize_movie_titles(read_movie_titles(data_dir))
+    for movie_lines in read_movie_lines(data_dir, chunksize=chunksize):
+        yield process_movie_lines(movie_lines, movie_titles)
+
+
+def load_movie_title_data(data_dir: str = DATA_DIR) -> pd.DataFrame:
+    """
+    This function reads the cornell movie titles to create a dataframe of the sanitized title and year
+    of every movie with scripted lines.
+
+    :param data_dir: str, default DATA_DIR
+        Directory containing the raw datasets.
+    :return:
+    """
+    return sanitize_movie_titles(read_movie_titles(data_dir))[[TITLE, YEAR]]
@@ -0,0 +1,97 @@
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from movie_prediction.constants import *
+
+__all__ = ['LineSampler']
+
+
+class LineSampler:
+    """
+    Sample rows of a parquet principal lines dataset without loading it.
+
+    Only the cumulative row counts of the file's row groups are kept in memory. A sample is located with a
+    binary search over them and read from its row group alone, so memory stays flat as the dataset grows.
+    The file is reopened when it is replaced, e.g. by an incremental build.
+    """
+
+    def __init__(self, path: str, columns: Optional[List[str]] = None, seed: Optional[int] = None):
+        """
+        :param path: str
+            Path of the parquet dataset, see `write_parquet_cache`.
+        :param columns: List[str], optional
+            Columns of the sampled rows, defaults to the utterance and its principal.
+        :param seed: int, optional
+            Seed of the row selection.
+        """
+        self.path = path
+        self.columns = columns or [UTTERANCE, PRINCIPAL]
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._file = None
+        self._stat = None
+        self._offsets = None
+        self._open()
+
+    def _open(self):
+        stat = os.stat(self.path)
+        parquet_file = pq.ParquetFile(self.path, memory_map=True)
+        metadata = parquet_file.metadata
+        row_counts = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+        self._file = parquet_file
+        self._stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self._offsets = np.concatenate([[0], np.cumsum(row_counts, dtype=np.int64)])
+
+    def _refresh(self):
+        stat = os.stat(self.path)
+        if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != self._stat:
+            self._open()
+
+    def __len__(self) -> int:
+        return int(self._offsets[-1])
+
+    def refresh(self):
+        """
+        Reopen the file if it was replaced since it was last opened, sampling does so on its own.
+        """
+        with self._lock:
+            self._refresh()
+
+    def _read(self, i: int) -> Dict[str, Any]:
+        group = int(np.searchsorted(self._offsets, i, side='right')) - 1
+        table = self._file.read_row_group(group, columns=self.columns)
+        return table.slice(i - int(self._offsets[group]), 1).to_pylist()[0]
+
+    def row(self, i: int) -> Dict[str, Any]:
+        """
+        Read a single row.
+
+        :param i: int
+            Position of the row in the dataset.
+        :return:
+            Dict[str, Any]
+            The row's values by column.
+        """
+        with self._lock:
+            self._refresh()
+            if not 0 <= i < len(self):
+                raise IndexError(f"Row {i} out of range for {len(self)} rows")
+            return self._read(i)
+
+    def sample(self) -> Optional[Dict[str, Any]]:
+        """
+        Read a uniformly random row.
+
+        :return:
+            Dict[str, Any] or None
+            The row's values by column, or None if the dataset is empty.
+        """
+        with self._lock:
+            self._refresh()
+            if not len(self):
+                return None
+            return self._read(int(self._rng.integers(len(self))))
@@ -0,0 +1,96 @@
+from typing import Any, Dict, List, Mapping, Sequence
+
+import numpy as np
+import torch
+
+from movie_prediction.bucketing import pad_sequences
+
+__all__ = ['PrincipalDataset', 'PaddingCollator', 'EncoderFeatureDataset']
+
+
+class PrincipalDataset(torch.utils.data.Dataset):
+    """
+    Dataset of tokenized utterances and their principal labels.
+    Encodings may be unpadded, in which case batches should be padded by `PaddingCollator`.
+    """
+
+    def __init__(self, encodings: Mapping[str, Sequence], labels: Sequence,
+                 utterances: Sequence[str], principals: Sequence[str]):
+        self.encodings = encodings
+        self.labels = labels
+        self.utterances = utterances
+        self.principals = principals
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
+        item['labels'] = torch.tensor(self.labels[idx])
+        item['utterances'] = self.utterances[idx]
+        item['principals'] = self.principals[idx]
+        return item
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Token length of every item, excluding padding.
+        """
+        if 'attention_mask' in self.encodings:
+            return np.fromiter(
+                (sum(mask) for mask in self.encodings['attention_mask']),
+                dtype=np.int64, count=len(self))
+        return np.fromiter(
+            (len(ids) for ids in self.encodings['input_ids']),
+            dtype=np.int64, count=len(self))
+
+
+class PaddingCollator:
+    """
+    Collate function which pads `input_ids` and `attention_mask` to the longest item in the batch.
+    """
+
+    def __init__(self, pad_token_id: int = 0):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        batch = {}
+        lengths = [int(item['attention_mask'].sum()) if 'attention_mask' in item else len(item['input_ids'])
+                   for item in items]
+        batch['input_ids'], batch['attention_mask'] = pad_sequences(
+            [item['input_ids'][:length] for item, length in zip(items, lengths)], self.pad_token_id)
+        for key in items[0]:
+            if key in batch or key == 'attention_mask':
+                continue
+            values = [item[key] for item in items]
+            batch[key] = torch.stack(values) if isinstance(values[0], torch.Tensor) else values
+        return batch
+
+
+class EncoderFeatureDataset(torch.utils.data.Dataset):
+    """
+    Dataset of cached frozen encoder features and their principal labels, for training only the
+    classification head, see `movie_prediction.training.compute_encoder_features`.
+    Items hold `features` and `labels`, which `DistilBertForPrincipalPrediction` accepts directly.
+    """
+
+    def __init__(self, features: np.ndarray, labels: Sequence):
+        """
+        :param features: np.ndarray
+            Encoder `[CLS]` features of shape (n_items, dim), possibly memory mapped.
+        :param labels: Sequence
+            Labels aligned with the features.
+        """
+        if len(features) != len(labels):
+            raise ValueError(f"Got {len(labels)} labels for {len(features)} features")
+        self.features = features
+        self.labels = labels
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        return {
+            'features': torch.from_numpy(np.asarray(self.features[idx], dtype=np.float32)),
+            'labels': torch.tensor(self.labels[idx]),
+        }
+
+    def __len__(self) -> int:
+        return len(self.labels)
@@ -0,0 +1,279 @@
+"""
+Exact and near-duplicate detection of movie lines, run on the output of `load_principal_movie_lines`:
+
+    python -m movie_prediction.dedup data/principal_lines.parquet data/principal_lines_dedup.parquet
+
+Lines are sanitized and hashed, so exact duplicates are only processed once. The unique lines are then MinHashed
+over character shingles, chunk by chunk, and lines sharing an LSH band are clustered when their estimated
+Jaccard similarity passes a threshold. Every step is a sort or a vectorized pass, so the stage scales about linearly.
+"""
+import time
+import argparse
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.util import hash_pandas_object
+
+from movie_prediction.constants import *
+from movie_prediction.utils import sanitize_string_column
+
+__all__ = ['minhash_signatures', 'near_duplicate_clusters', 'deduplicate_lines', 'cluster_split', 'main']
+
+_SHINGLE_PRIME = np.uint32(16777619)
+_BAND_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_SEED = 0x5EED
+
+
+def _shingle_hashes(texts: Sequence[str], shingle_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hash the character shingles of texts to 32 bits. Texts shorter than a shingle are padded with spaces.
+    Returns the hashes, grouped by text, and the offset of each text's first shingle.
+    """
+    encoded = [text.encode('utf-8').ljust(shingle_size) for text in texts]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    counts = lengths - shingle_size + 1
+    offsets = np.cumsum(counts) - counts
+    # Start of every shingle in the joined buffer
+    starts = np.arange(counts.sum()) - np.repeat(offsets, counts) + np.repeat(np.cumsum(lengths) - lengths, counts)
+    hashes = np.zeros(len(starts), dtype=np.uint32)
+    for i in range(shingle_size):
+        hashes = (hashes * _SHINGLE_PRIME) ^ buffer[starts + i]
+    return hashes, offsets
+
+
+def minhash_signatures(texts: Sequence[str], num_perm: int = MINHASH_PERMUTATIONS_DEFAULT,
+                       shingle_size: int = SHINGLE_SIZE_DEFAULT, chunk_size: int = DEDUP_CHUNK_SIZE_DEFAULT,
+                       seed: int = _SEED) -> np.ndarray:
+    """
+    Compute MinHash signatures of texts over their character shingles.
+
+    :param texts: Sequence[str]
+        The texts, ideally sanitized.
+    :param num_perm: int, default MINHASH_PERMUTATIONS_DEFAULT
+        Number of hash functions, the share of equal values of two signatures estimates the Jaccard similarity of
+        the texts' shingle sets.
+    :param shingle_size: int, default SHINGLE_SIZE_DEFAULT
+        Number of characters per shingle.
+    :param chunk_size: int, default DEDUP_CHUNK_SIZE_DEFAULT
+        Number of texts hashed at a time, which bounds the memory of intermediate arrays.
+    :param seed: int
+        Seed of the hash functions, signatures are only comparable when computed with the same seed.
+    :return:
+        np.ndarray
+        Array of shape (len(texts), num_perm) and dtype uint32.
+    """
+    rng = np.random.default_rng(seed)
+    # Multiply-shift hashing, odd multipliers make every function a permutation of 64 bit values
+    multipliers = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    increments = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for start in range(0, len(texts), chunk_size):
+        hashes, offsets = _shingle_hashes(texts[start:start + chunk_size], shingle_size)
+        hashes = hashes.astype(np.uint64)
+        for i in range(num_perm):
+            permuted = ((hashes * multipliers[i] + increments[i]) >> np.uint64(32)).astype(np.uint32)
+            signatures[start:start + len(offsets), i] = np.minimum.reduceat(permuted, offsets)
+    return signatures
+
+
+def _connected_components(num_nodes: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Label every node with the smallest node of its component, by hooking roots and pointer jumping.
+    """
+    labels = np.arange(num_nodes)
+    while True:
+        source_roots, target_roots = labels[sources], labels[targets]
+        unmerged = source_roots != target_roots
+        if not unmerged.any():
+            return labels
+        sources, targets = sources[unmerged], targets[unmerged]
+        roots = np.minimum(source_roots[unmerged], target_roots[unmerged])
+        np.minimum.at(labels, source_roots[unmerged], roots)
+        np.minimum.at(labels, target_roots[unmerged], roots)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+def near_duplicate_clusters(signatures: np.ndarray, bands: int = LSH_BANDS_DEFAULT,
+                            threshold: float = NEAR_DUPLICATE_THRESHOLD_DEFAULT) -> np.ndarray:
+    """
+    Cluster texts by the MinHash signatures with locality sensitive hashing.
+
+    Signatures are cut into `bands` bands. Texts whose signatures are equal on a band are candidates, and each
+    is linked to the first candidate before it whose signature agrees with its own on at least `threshold` of
+    their values. Clusters are the connected components of the links, so near duplicates of near duplicates end
+    up together. A pair is still missed when its later text is linked to another candidate and its earlier text
+    is not connected to that one, unless another band makes them candidates again.
+
+    :param signatures: np.ndarray
+        Signatures from `minhash_signatures`, the number of values must be a multiple of `bands`.
+    :param bands: int, default LSH_BANDS_DEFAULT
+        Number of bands. More, narrower bands find less similar candidates, with 64 values and 16 bands, pairs
+        with a similarity of 0.5 are candidates half of the time and pairs with 0.7 almost always.
+    :param threshold: float, default NEAR_DUPLICATE_THRESHOLD_DEFAULT
+        Estimated Jaccard similarity from which candidates are linked.
+    :return:
+        np.ndarray
+        The cluster of every text, numbered from 0 in order of their first text.
+    """
+    num_texts, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError(f"{num_perm} signature values do not split into {bands} bands")
+    rows = num_perm // bands
+    sources, targets = [], []
+    for band in range(bands):
+        keys = np.zeros(num_texts, dtype=np.uint64)
+        for column in signatures[:, band * rows:(band + 1) * rows].T:
+            keys = (keys ^ column) * _BAND_MULTIPLIER
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        starts = np.repeat(group_starts, np.diff(np.r_[group_starts, num_texts]))
+        positions = np.arange(num_texts) - starts
+        # Link every member of a bucket to the first member before it that passes the threshold, comparing
+        # the members still unlinked with the bucket's members one position at a time
+        pending = np.flatnonzero(positions > 0)
+        offset = 0
+        while len(pending):
+            candidates = starts[pending] + offset
+            similarity = (signatures[order[pending]] == signatures[order[candidates]]).mean(axis=1)
+            linked = similarity >= threshold
+            sources.append(order[pending[linked]])
+            targets.append(order[candidates[linked]])
+            offset += 1
+            pending = pending[~linked]
+            pending = pending[positions[pending] > offset]
+    labels = _connected_components(
+        num_texts, np.concatenate(sources or [np.empty(0, dtype=np.int64)]),
+        np.concatenate(targets or [np.empty(0, dtype=np.int64)]))
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def deduplicate_lines(lines: pd.DataFrame, column: str = UTTERANCE,
+                      threshold: float = NEAR_DUPLICATE_THRESHOLD_DEFAULT, num_perm: int = MINHASH_PERMUTATIONS_DEFAULT,
+                      bands: int = LSH_BANDS_DEFAULT, shingle_size: int = SHINGLE_SIZE_DEFAULT,
+                      chunk_size: int = DEDUP_CHUNK_SIZE_DEFAULT) -> pd.DataFrame:
+    """
+    Find the exact and near duplicate lines of a dataset.
+
+    Adds the sanitized text, `UTTERANCE_SAN`, its hash, `UTTERANCE_HASH`, the near duplicate cluster, `CLUSTER_ID`,
+    numbered from 0 in order of the cluster's first line, and the number of lines of the cluster, `CLUSTER_SIZE`. Exact duplicates are dropped with
+    `drop_duplicates(subset=[UTTERANCE_HASH])` and near duplicates with `drop_duplicates(subset=[CLUSTER_ID])`.
+    Common phrases are the lines of large clusters, e.g. `CLUSTER_SIZE > COMMON_PHRASE_THRESHOLD_DEFAULT`, and
+    `cluster_split` keeps clusters on one side of a train and validation split.
+
+    :param lines: pd.DataFrame
+        The principal lines, as loaded by `load_principal_movie_lines`.
+    :param column: str, default UTTERANCE
+        Column holding the lines.
+    :param threshold: float, default NEAR_DUPLICATE_THRESHOLD_DEFAULT
+        Estimated Jaccard similarity of character shingles from which lines are near duplicates.
+    :param num_perm: int, default MINHASH_PERMUTATIONS_DEFAULT
+        Number of MinHash values per line.
+    :param bands: int, default LSH_BANDS_DEFAULT
+        Number of LSH bands, see `near_duplicate_clusters`.
+    :param shingle_size: int, default SHINGLE_SIZE_DEFAULT
+        Number of characters per shingle.
+    :param chunk_size: int, default DEDUP_CHUNK_SIZE_DEFAULT
+        Number of lines sanitized and hashed at a time.
+    :return:
+        pd.DataFrame
+        A copy of `lines` with the new columns.
+    """
+    sanitized, hashes = [], []
+    for start in range(0, len(lines), chunk_size):
+        chunk = sanitize_string_column(lines[column].iloc[start:start + chunk_size],
+                                       upper=True, alphanumeric_only=True, strip=True, whitespace=True)
+        chunk = chunk.fillna('').astype(str)
+        sanitized.append(chunk.values)
+        hashes.append(hash_pandas_object(chunk, index=False).values)
+    lines = lines.copy()
+    lines[UTTERANCE_SAN] = np.concatenate(sanitized) if sanitized else np.empty(0, dtype=object)
+    lines[UTTERANCE_HASH] = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+
+    # Only the first line of every exact duplicate is MinHashed
+    _, firsts, inverse = np.unique(lines[UTTERANCE_HASH].values, return_index=True, return_inverse=True)
+    texts = lines[UTTERANCE_SAN].values[firsts]
+    signatures = minhash_signatures(texts, num_perm=num_perm, shingle_size=shingle_size, chunk_size=chunk_size)
+    # Unique texts are in hash order, number the clusters in order of their first line instead
+    clusters = pd.factorize(near_duplicate_clusters(signatures, bands=bands, threshold=threshold)[inverse])[0]
+    lines[CLUSTER_ID] = clusters
+    lines[CLUSTER_SIZE] = np.bincount(clusters)[clusters] if len(clusters) else clusters
+    return lines
+
+
+def cluster_split(cluster_ids: Sequence[int], test_size: float = 0.2, seed: Optional[int] = None) -> np.ndarray:
+    """
+    Split lines into training and validation lines, keeping every cluster of near duplicates on one side.
+
+    :param cluster_ids: Sequence[int]
+        Cluster of every line, e.g. the `CLUSTER_ID` column of `deduplicate_lines`.
+    :param test_size: float, default 0.2
+        Share of the lines in the validation split.
+    :param seed: int, optional
+        Seed of the cluster shuffle.
+    :return:
+        np.ndarray
+        Boolean mask of the validation lines.
+    """
+    clusters, inverse = np.unique(np.asarray(cluster_ids), return_inverse=True)
+    sizes = np.bincount(inverse, minlength=len(clusters))
+    order = np.random.default_rng(seed).permutation(len(clusters))
+    # Shuffled clusters are taken until the validation split is full
+    before = np.cumsum(sizes[order]) - sizes[order]
+    validation = np.zeros(len(clusters), dtype=bool)
+    validation[order[before < test_size * len(inverse)]] = True
+    return validation[inverse]
+
+
+def _read_lines(input_fp: str, column: str) -> pd.DataFrame:
+    if input_fp.endswith('.parquet'):
+        return pd.read_parquet(input_fp)
+    return pd.read_csv(input_fp, sep='\t', converters={column: str})
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Cluster the exact and near duplicate lines of a principal lines "
+                                                 "dataset and write it with cluster columns.")
+    parser.add_argument('input', help="Principal lines, Parquet if the path ends in .parquet and TSV otherwise.")
+    parser.add_argument('output', help="Parquet file the lines and their clusters are written to.")
+    parser.add_argument('--column', default=UTTERANCE, help="Column holding the lines.")
+    parser.add_argument('--threshold', type=float, default=NEAR_DUPLICATE_THRESHOLD_DEFAULT,
+                        help="Estimated Jaccard similarity from which lines are near duplicates.")
+    parser.add_argument('--num-perm', type=int, default=MINHASH_PERMUTATIONS_DEFAULT)
+    parser.add_argument('--bands', type=int, default=LSH_BANDS_DEFAULT)
+    parser.add_argument('--shingle-size', type=int, default=SHINGLE_SIZE_DEFAULT)
+    parser.add_argument('--chunk-size', type=int, default=DEDUP_CHUNK_SIZE_DEFAULT)
+    return parser.parse_args(argv)
+
+
+def _summary(lines: pd.DataFrame) -> Dict[str, Any]:
+    return {
+        'lines': len(lines),
+        'unique_lines': lines[UTTERANCE_HASH].nunique(),
+        'clusters': lines[CLUSTER_ID].nunique(),
+        'common_phrase_lines': int((lines[CLUSTER_SIZE] > COMMON_PHRASE_THRESHOLD_DEFAULT).sum()),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(argv)
+    start = time.perf_counter()
+    lines = _read_lines(args.input, args.column)
+    print(f"Deduplicating {len(lines)} lines from: {args.input}")
+    lines = deduplicate_lines(lines, column=args.column, threshold=args.threshold, num_perm=args.num_perm,
+                              bands=args.bands, shingle_size=args.shingle_size, chunk_size=args.chunk_size)
+    lines.to_parquet(args.output, index=False)
+    summary = _summary(lines)
+    print(f"{summary['lines']} lines, {summary['unique_lines']} unique, in {summary['clusters']} clusters, "
+          f"{summary['common_phrase_lines']} lines in clusters over {COMMON_PHRASE_THRESHOLD_DEFAULT} lines")
+    print(f"Clusters written to: {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
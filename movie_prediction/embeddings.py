@@ -0,0 +1,284 @@
+import os
+import glob
+import json
+import logging
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import torch
+from pandas.util import hash_pandas_object
+
+from movie_prediction.bucketing import length_sorted_batches, pad_sequences
+from movie_prediction.constants import *
+
+__all__ = ['EmbeddingStore', 'embed_utterances', 'encode_utterances', 'hash_utterances']
+
+_META = 'meta.json'
+_CHUNK = 'embeddings_{:05d}.npy'
+_METADATA_PART = 'metadata_{:010d}.parquet'
+
+
+def hash_utterances(utterances: Sequence[str]) -> np.ndarray:
+    """
+    Hash utterance texts to 64 bit integers, as stored in the `UTTERANCE_HASH` column of an `EmbeddingStore`.
+    """
+    return hash_pandas_object(pd.Series(utterances, dtype=object).astype(str), index=False).values
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk store of utterance embeddings with row-aligned metadata.
+
+    Embeddings are written to fixed size `.npy` chunks which are memory mapped, so the store grows without
+    rewriting earlier rows and is read without loading it into memory. Each flush writes the metadata of its
+    rows to a parquet part and then commits the row count, so after an interruption the store reopens at the
+    last flush and rows appended after it are discarded. Every row's `UTTERANCE_HASH` is kept to skip
+    utterances which are already stored.
+    """
+
+    def __init__(self, path: str, dim: Optional[int] = None, dtype: str = 'float16',
+                 chunk_rows: int = EMBEDDING_CHUNK_ROWS_DEFAULT, model: Optional[str] = None):
+        """
+        :param path: str
+            Directory of the store, created if needed.
+        :param dim: int, optional
+            Embedding dimension, required to create a store.
+        :param dtype: str, default 'float16'
+            Storage dtype of new stores, `float16` or `float32`.
+        :param chunk_rows: int, default EMBEDDING_CHUNK_ROWS_DEFAULT
+            Number of rows per chunk file of new stores.
+        :param model: str, optional
+            Name of the model producing the embeddings. Opening a store with another model raises an error.
+        """
+        self.path = path
+        meta_fp = os.path.join(path, _META)
+        if os.path.isfile(meta_fp):
+            with open(meta_fp) as meta_file:
+                self.meta = json.load(meta_file)
+            for key, value in [('dim', dim), ('model', model)]:
+                if value is not None and self.meta[key] != value:
+                    raise ValueError(f"Embedding store {path} has {key} {self.meta[key]!r}, got {value!r}")
+        else:
+            if dim is None:
+                raise ValueError(f"No embedding store at {path}, dim is required to create one")
+            if np.dtype(dtype) not in (np.float16, np.float32):
+                raise ValueError(f"Embeddings are stored as float16 or float32, got {dtype}")
+            os.makedirs(path, exist_ok=True)
+            self.meta = {
+                'dim': dim, 'dtype': np.dtype(dtype).name, 'chunk_rows': chunk_rows,
+                'model': model, 'num_rows': 0,
+            }
+            self._write_meta()
+
+        self._chunks = {}
+        self._pending = []
+        self._num_rows = self.meta['num_rows']
+
+        # Drop metadata of rows which were appended but never committed
+        for part_fp in self._metadata_parts():
+            if self._part_start(part_fp) >= self.meta['num_rows']:
+                os.remove(part_fp)
+        self._hashes = set(self.metadata[UTTERANCE_HASH].tolist()) if len(self) else set()
+
+    def __enter__(self) -> 'EmbeddingStore':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def __len__(self) -> int:
+        return self.meta['num_rows']
+
+    @property
+    def dim(self) -> int:
+        return self.meta['dim']
+
+    def _write_meta(self):
+        tmp_fp = os.path.join(self.path, _META + '.tmp')
+        with open(tmp_fp, 'w') as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(tmp_fp, os.path.join(self.path, _META))
+
+    def _metadata_parts(self):
+        return sorted(glob.glob(os.path.join(self.path, _METADATA_PART.replace('{:010d}', '*'))))
+
+    @staticmethod
+    def _part_start(part_fp: str) -> int:
+        return int(os.path.basename(part_fp).split('_')[1].split('.')[0])
+
+    def _chunk(self, idx: int) -> np.memmap:
+        if idx not in self._chunks:
+            chunk_fp = os.path.join(self.path, _CHUNK.format(idx))
+            if os.path.isfile(chunk_fp):
+                self._chunks[idx] = np.load(chunk_fp, mmap_mode='r+')
+            else:
+                self._chunks[idx] = np.lib.format.open_memmap(
+                    chunk_fp, mode='w+', dtype=self.meta['dtype'],
+                    shape=(self.meta['chunk_rows'], self.meta['dim']))
+        return self._chunks[idx]
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Whether utterances with the given `hash_utterances` hashes are stored.
+        """
+        return np.fromiter((h in self._hashes for h in hashes.tolist()), dtype=bool, count=len(hashes))
+
+    def append(self, embeddings: np.ndarray, metadata: pd.DataFrame):
+        """
+        Append embeddings and their metadata, which are committed by the next `flush`.
+
+        :param embeddings: np.ndarray
+            Embeddings of shape (rows, dim).
+        :param metadata: pd.DataFrame
+            One row per embedding with a `UTTERANCE_HASH` column.
+        """
+        if embeddings.shape[1:] != (self.dim,) or len(embeddings) != len(metadata):
+            raise ValueError(f"Expected {len(metadata)} embeddings of dimension {self.dim}, got {embeddings.shape}")
+        chunk_rows = self.meta['chunk_rows']
+        row = self._num_rows
+        while row < self._num_rows + len(embeddings):
+            offset = row - self._num_rows
+            chunk_idx, chunk_row = divmod(row, chunk_rows)
+            size = min(chunk_rows - chunk_row, len(embeddings) - offset)
+            self._chunk(chunk_idx)[chunk_row:chunk_row + size] = embeddings[offset:offset + size]
+            row += size
+        self._num_rows = row
+        self._pending.append(metadata.reset_index(drop=True))
+        self._hashes.update(metadata[UTTERANCE_HASH].tolist())
+
+    def flush(self):
+        """
+        Write appended embeddings and metadata to disk and commit them.
+        """
+        if not self._pending:
+            return
+        for chunk in self._chunks.values():
+            chunk.flush()
+        pd.concat(self._pending, ignore_index=True).to_parquet(
+            os.path.join(self.path, _METADATA_PART.format(len(self))), index=False)
+        self._pending = []
+        self.meta['num_rows'] = self._num_rows
+        self._write_meta()
+
+    def iter_chunks(self) -> Iterator[np.ndarray]:
+        """
+        Iterate over the stored embeddings chunk by chunk, as read only memory mapped arrays.
+        """
+        chunk_rows = self.meta['chunk_rows']
+        for start in range(0, len(self), chunk_rows):
+            chunk_fp = os.path.join(self.path, _CHUNK.format(start // chunk_rows))
+            yield np.load(chunk_fp, mmap_mode='r')[:min(chunk_rows, len(self) - start)]
+
+    def load(self, dtype: Optional[str] = None) -> np.ndarray:
+        """
+        Load all stored embeddings into memory.
+
+        :param dtype: str, optional
+            Dtype of the returned array, defaults to the storage dtype.
+        :return:
+            np.ndarray
+            Embeddings of shape (rows, dim), aligned with `metadata`.
+        """
+        dtype = dtype or self.meta['dtype']
+        if not len(self):
+            return np.empty((0, self.dim), dtype=dtype)
+        return np.concatenate([chunk.astype(dtype) for chunk in self.iter_chunks()])
+
+    @property
+    def metadata(self) -> pd.DataFrame:
+        """
+        Metadata of the stored embeddings, one row per embedding.
+        """
+        parts = [part_fp for part_fp in self._metadata_parts() if self._part_start(part_fp) < len(self)]
+        if not parts:
+            return pd.DataFrame(columns=[UTTERANCE, UTTERANCE_HASH])
+        return pd.concat([pd.read_parquet(part_fp) for part_fp in parts], ignore_index=True)
+
+
+def embed_utterances(model, tokenizer, utterances: Sequence[str], store: EmbeddingStore,
+                     metadata: Optional[pd.DataFrame] = None, batch_size: int = BATCH_SIZE_DEFAULT,
+                     flush_rows: int = EMBEDDING_FLUSH_ROWS_DEFAULT,
+                     tokenizer_args: Dict[str, Any] = TOKENIZER_ARGS_UNPADDED) -> int:
+    """
+    Stream the `[CLS]` embeddings of utterances into an embedding store.
+
+    Utterances already in the store, or repeated in `utterances`, are skipped, so an interrupted run resumes by
+    calling it again. Utterances are tokenized and embedded `flush_rows` at a time in length sorted batches,
+    and every block is flushed to the store in input order.
+
+    :param model: DistilBertModel or DistilBertForPrincipalPrediction
+        The model to embed with, see `encode_utterances`.
+    :param tokenizer:
+        The model's huggingface tokenizer.
+    :param utterances: Sequence[str]
+        The utterance texts.
+    :param store: EmbeddingStore
+        The store to write to.
+    :param metadata: pd.DataFrame, optional
+        Metadata aligned with `utterances` stored next to every embedding, e.g. principals or labels.
+    :param batch_size: int, default BATCH_SIZE_DEFAULT
+        Number of utterances per forward pass.
+    :param flush_rows: int, default EMBEDDING_FLUSH_ROWS_DEFAULT
+        Number of utterances embedded between flushes.
+    :param tokenizer_args: Dict[str, Any], default TOKENIZER_ARGS_UNPADDED
+        Arguments passed to the tokenizer, batches are padded separately.
+    :return:
+        int
+        The number of embeddings added to the store.
+    """
+    utterances = pd.Series(utterances, dtype=object).astype(str).reset_index(drop=True)
+    rows = pd.DataFrame({UTTERANCE: utterances, UTTERANCE_HASH: hash_utterances(utterances)})
+    if metadata is not None:
+        if len(metadata) != len(rows):
+            raise ValueError(f"Got {len(metadata)} metadata rows for {len(rows)} utterances")
+        rows = pd.concat([metadata.reset_index(drop=True).drop(columns=rows.columns, errors='ignore'), rows], axis=1)
+    rows = rows[~rows[UTTERANCE_HASH].duplicated() & ~store.contains(rows[UTTERANCE_HASH].values)]
+    logging.info(f"Embedding {len(rows)} utterances, {len(utterances) - len(rows)} already stored or repeated")
+
+    for start in range(0, len(rows), flush_rows):
+        block = rows.iloc[start:start + flush_rows]
+        store.append(encode_utterances(model, tokenizer, block[UTTERANCE], batch_size, tokenizer_args), block)
+        store.flush()
+        logging.info(f"Stored {len(store)} embeddings in {store.path}")
+
+    return len(rows)
+
+
+def encode_utterances(model, tokenizer, utterances: Sequence[str], batch_size: int = BATCH_SIZE_DEFAULT,
+                      tokenizer_args: Dict[str, Any] = TOKENIZER_ARGS_UNPADDED) -> np.ndarray:
+    """
+    Compute the `[CLS]` embeddings of utterances, which are the input of the classifier's `pre_classifier`.
+
+    :param model: DistilBertModel or DistilBertForPrincipalPrediction
+        The model to embed with, its DistilBERT encoder is used in eval mode on its current device and put back in
+        the mode it was in.
+    :param tokenizer:
+        The model's huggingface tokenizer.
+    :param utterances: Sequence[str]
+        The utterance texts.
+    :param batch_size: int, default BATCH_SIZE_DEFAULT
+        Number of utterances per forward pass, batches are formed from utterances of similar length.
+    :param tokenizer_args: Dict[str, Any], default TOKENIZER_ARGS_UNPADDED
+        Arguments passed to the tokenizer, batches are padded separately.
+    :return:
+        np.ndarray
+        float32 embeddings of shape (n_utterances, dim) in input order.
+    """
+    encoder = getattr(model, 'distilbert', model)
+    device = next(encoder.parameters()).device
+
+    input_ids = tokenizer([str(utt) for utt in utterances], **tokenizer_args)['input_ids'] if len(utterances) else []
+    lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+    embeddings = np.empty((len(input_ids), encoder.config.dim), dtype=np.float32)
+    was_training = encoder.training
+    encoder.eval()
+    try:
+        with torch.inference_mode():
+            for batch in length_sorted_batches(lengths, batch_size):
+                batch_ids, attention_mask = pad_sequences([input_ids[i] for i in batch], tokenizer.pad_token_id)
+                hidden_state = encoder(input_ids=batch_ids.to(device), attention_mask=attention_mask.to(device))[0]
+                embeddings[batch] = hidden_state[:, 0].float().cpu().numpy()
+    finally:
+        encoder.train(was_training)
+    return embeddings
@@ -0,0 +1,60 @@
+import json
+import argparse
+import logging
+
+from transformers import DistilBertTokenizerFast
+
+from movie_prediction.backends import BACKENDS, TorchBackend, export_onnx, load_backend, compare_backends
+from movie_prediction.constants import *
+from movie_prediction.snapshot import is_snapshot, serving_path
+
+__all__ = ['main']
+
+
+def _held_out_utterances(args) -> list:
+    if args.utterances:
+        with open(args.utterances, encoding='utf-8') as utterances_file:
+            return [line.rstrip('\n') for line in utterances_file if line.strip()]
+
+    from movie_prediction.data_loaders.processed import load_principal_movie_lines
+    principal_lines = load_principal_movie_lines(args.lines)
+    sample = principal_lines[UTTERANCE].sample(min(args.sample_size, len(principal_lines)), random_state=args.seed)
+    return list(sample.astype(str))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export a principal prediction model to ONNX and check the inference backends against fp32.")
+    parser.add_argument('--model-path', default=MODEL_DIR + '/' + PRINC_PRED_MODEL_TUNED_INF,
+                        help="Directory of the pretrained model, the export is written next to it. "
+                             "The model's snapshot is exported instead when there is one.")
+    parser.add_argument('--opset', type=int, default=14)
+    parser.add_argument('--backends', nargs='*', default=[name for name in BACKENDS if name != TorchBackend.name],
+                        help="Backends to compare with fp32, none to skip the accuracy check.")
+    parser.add_argument('--utterances', default=None, help="Text file of held-out utterances, one per line.")
+    parser.add_argument('--lines', default=DATA_DIR + '/' + PRINCIPALS_LINES_PARQUET_DEFAULT,
+                        help="Principal lines dataset to sample utterances from when no file is given.")
+    parser.add_argument('--sample-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # Export and compare what is served, as the wrapper and the model registry load the snapshot if there is one
+    model_path = serving_path(args.model_path)
+    print(f"Exported ONNX model to: {export_onnx(model_path, opset=args.opset)}")
+    if not args.backends:
+        return
+
+    utterances = _held_out_utterances(args)
+    tokenizer = DistilBertTokenizerFast.from_pretrained(
+        model_path if is_snapshot(model_path) else HUGGINGFACE_PRETRAINED)
+    results = compare_backends(
+        load_backend(TorchBackend.name, model_path),
+        {name: load_backend(name, model_path) for name in args.backends},
+        tokenizer, utterances)
+    print(f"Backend accuracy against fp32 on {len(utterances)} utterances:")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
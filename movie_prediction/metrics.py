@@ -0,0 +1,221 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Sequence, Tuple
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'MetricsRegistry', 'METRICS', 'STAGE_SECONDS',
+           'LATENCY_BUCKETS', 'TOKEN_LENGTH_BUCKETS', 'BATCH_SIZE_BUCKETS']
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TOKEN_LENGTH_BUCKETS = (4, 8, 12, 16, 24, 32, 48, 64, 96, 128, 256, 512)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Shared by disabled timers, nullcontext holds no state
+_NULL_TIMER = nullcontext()
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = (value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {list(self.labelnames)}, got {list(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[Tuple[str, Sequence[str], Sequence[str], float]]:
+        with self._lock:
+            return [(self.name, self.labelnames, key, value) for key, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(
+            f'{name}{_format_labels(names, values)} {_format_value(value)}'
+            for name, names, values, value in self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing total, such as a number of requests.
+    """
+    type = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Value which goes up and down, such as a load time or a queue depth.
+    """
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class _HistogramTimer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: 'Histogram', labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values counted into cumulative buckets, such as latencies.
+    """
+    type = 'histogram'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets))
+
+    def _add(self, key: Tuple[str, ...], bucket_counts, total: float, count: int):
+        with self._lock:
+            counts, previous_total, previous_count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            for i, bucket_count in enumerate(bucket_counts):
+                counts[i] += bucket_count
+            self._values[key] = (counts, previous_total + total, previous_count + count)
+
+    def observe(self, value: float, **labels):
+        if not self.registry.enabled:
+            return
+        bucket_counts = [0] * (len(self.buckets) + 1)
+        # Buckets are upper bounds, the last one is +Inf
+        bucket_counts[bisect.bisect_left(self.buckets, value)] = 1
+        self._add(self._key(labels), bucket_counts, value, 1)
+
+    def observe_many(self, values, **labels):
+        """
+        Observe every value of an array at once.
+        """
+        if not self.registry.enabled or not len(values):
+            return
+        import numpy as np
+        values = np.asarray(values, dtype=np.float64)
+        bucket_counts = np.bincount(
+            np.searchsorted(self.buckets, values, side='left'), minlength=len(self.buckets) + 1)
+        self._add(self._key(labels), bucket_counts.tolist(), float(values.sum()), len(values))
+
+    def time(self, **labels):
+        """
+        Context manager observing the seconds spent in its block, a no-op while metrics are disabled.
+        """
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _HistogramTimer(self, labels)
+
+    def _samples(self) -> List[Tuple[str, Sequence[str], Sequence[str], float]]:
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        samples = []
+        bucket_names = self.labelnames + ('le',)
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket', bucket_names, key + (_format_value(bound),), cumulative))
+            samples.append((self.name + '_sum', self.labelnames, key, total))
+            samples.append((self.name + '_count', self.labelnames, key, count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered in the Prometheus text exposition format.
+
+    Recording is skipped entirely while `enabled` is False, so instrumented code only pays an attribute lookup.
+    Metrics are created once by name, asking for an existing name returns the registered metric.
+    """
+
+    def __init__(self, enabled: bool = True):
+        """
+        :param enabled: bool, default True
+            Whether metrics are recorded, can be changed at any time.
+        """
+        self.enabled = enabled
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_type: type, name: str, *args, **kwargs) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_type(self, name, *args, **kwargs)
+            elif not isinstance(metric, metric_type):
+                raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format, version 0.0.4.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+# Registry of the serving app, disabled with PRINCIPAL_METRICS=0
+METRICS = MetricsRegistry(enabled=os.environ.get('PRINCIPAL_METRICS', '1') != '0')
+
+STAGE_SECONDS = METRICS.histogram(
+    'principal_stage_seconds',
+    "Seconds spent per inference stage: sanitize, tokenize, pad, to_device, forward, softmax and postprocess. "
+    "On GPU the forward pass runs asynchronously and is partly counted in the softmax stage.",
+    ['stage'])
@@ -1,3 +1,8 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
 from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 
@@ -6,10 +11,55 @@ from transformers import (
 )
 from transformers.modeling_outputs import SequenceClassifierOutput
 
-___all__ = ['DistilBertForPrincipalPrediction']
+__all__ = ['DistilBertForPrincipalPrediction', 'balanced_label_clusters']
+
+# Clusters scored by `DistilBertForPrincipalPrediction.top_k` unless the config sets `cluster_beam`
+CLUSTER_BEAM_DEFAULT = 4
+
+
+def balanced_label_clusters(keys: Sequence, num_clusters: Optional[int] = None) -> List[int]:
+    """
+    Group labels into clusters of near equal size by sorting them on a key, such as the median year or the
+    main movie of each principal, for the two-level head of `DistilBertForPrincipalPrediction`.
+
+    Example, clustering principals by era:
+        years = principal_lines.groupby(PRINCIPAL)[YEAR].median()
+        config.label_clusters = balanced_label_clusters([years[config.id2label[i]] for i in range(num_labels)])
+
+    :param keys: Sequence
+        Sortable key of every label, in label index order.
+    :param num_clusters: int, optional
+        Number of clusters, defaults to the square root of the number of labels, which minimizes the
+        labels scored per prediction.
+    :return:
+        List[int]
+        The cluster of every label.
+    """
+    num_labels = len(keys)
+    num_clusters = min(num_clusters or max(1, round(math.sqrt(num_labels))), num_labels)
+    order = np.argsort(np.asarray(keys), kind='stable')
+    clusters = np.empty(num_labels, dtype=np.int64)
+    clusters[order] = np.arange(num_labels) * num_clusters // num_labels
+    return clusters.tolist()
+
+
+def _linear_parameters(layer: nn.Module) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Dynamically quantized Linear layers expose their parameters through methods
+    if callable(layer.weight):
+        return layer.weight().dequantize(), layer.bias()
+    return layer.weight, layer.bias
 
 
 class DistilBertForPrincipalPrediction(DistilBertPreTrainedModel):
+    """
+    DistilBERT with a classification head predicting principals from the `[CLS]` output.
+
+    When the config has `label_clusters`, the cluster of every label, the head is two-level: a cluster classifier
+    is added and the logits become log probabilities of the cluster times the label within its cluster. `top_k`
+    then only scores the labels of the `cluster_beam` most probable clusters, so its cost grows with the number
+    of clusters plus the cluster size instead of with the number of labels.
+    """
+
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
@@ -21,8 +71,42 @@ class DistilBertForPrincipalPrediction(DistilBertPreTrainedModel):
         self.dropout = nn.Dropout(config.seq_classif_dropout)
         self.class_weights = None
 
+        self.hierarchical = getattr(config, 'label_clusters', None) is not None
+        if self.hierarchical:
+            label_clusters = torch.tensor(config.label_clusters, dtype=torch.long)
+            if len(label_clusters) != config.num_labels:
+                raise ValueError(f"label_clusters has {len(label_clusters)} entries for {config.num_labels} labels")
+            num_clusters = int(label_clusters.max()) + 1
+            sizes = torch.bincount(label_clusters, minlength=num_clusters)
+            # Label ids of every cluster, padded with -1 to the largest cluster
+            members = torch.full((num_clusters, int(sizes.max())), -1, dtype=torch.long)
+            for cluster in range(num_clusters):
+                cluster_labels = torch.nonzero(label_clusters == cluster).flatten()
+                members[cluster, :len(cluster_labels)] = cluster_labels
+            self.cluster_classifier = nn.Linear(config.dim, num_clusters)
+            self.min_cluster_size = max(1, int(sizes.min()))
+            # Derived from the config, so not saved with the weights
+            self.register_buffer('label_clusters', label_clusters, persistent=False)
+            self.register_buffer('cluster_members', members, persistent=False)
+
         self.init_weights()
 
+    def _head_input(self, pooled_output: torch.Tensor) -> torch.Tensor:
+        pooled_output = self.pre_classifier(pooled_output)  # (bs, dim)
+        pooled_output = nn.ReLU()(pooled_output)  # (bs, dim)
+        return self.dropout(pooled_output)  # (bs, dim)
+
+    def _hierarchical_log_probs(self, label_logits: torch.Tensor, cluster_logits: torch.Tensor) -> torch.Tensor:
+        """
+        Combine label and cluster logits into log probabilities of every label, softmax normalized within
+        each cluster and over clusters.
+        """
+        members = self.cluster_members
+        member_logits = label_logits[:, members.clamp(min=0)].masked_fill(members < 0, float('-inf'))
+        cluster_norms = torch.logsumexp(member_logits, dim=-1)  # (bs, num_clusters)
+        cluster_log_probs = torch.log_softmax(cluster_logits, dim=-1)  # (bs, num_clusters)
+        return (cluster_log_probs - cluster_norms)[:, self.label_clusters] + label_logits
+
     def forward(
         self,
         input_ids=None,
@@ -33,29 +117,36 @@ class DistilBertForPrincipalPrediction(DistilBertPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        features=None,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
             Labels for computing the sequence classification/regression loss. Indices should be in :obj:`[0, ...,
             config.num_labels - 1]`. If :obj:`config.num_labels == 1` a regression loss is computed (Mean-Square loss),
             If :obj:`config.num_labels > 1` a classification loss is computed (Cross-Entropy).
+        features (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, dim)`, `optional`):
+            Precomputed `[CLS]` outputs of a frozen encoder, see
+            :func:`movie_prediction.training.compute_encoder_features`. When given, the encoder is skipped
+            and only the classification head is run.
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
-        distilbert_output = self.distilbert(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
-        hidden_state = distilbert_output[0]  # (bs, seq_len, dim)
-        pooled_output = hidden_state[:, 0]  # (bs, dim)
-        pooled_output = self.pre_classifier(pooled_output)  # (bs, dim)
-        pooled_output = nn.ReLU()(pooled_output)  # (bs, dim)
-        pooled_output = self.dropout(pooled_output)  # (bs, dim)
+        if features is None:
+            distilbert_output = self.distilbert(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
+            hidden_state = distilbert_output[0]  # (bs, seq_len, dim)
+            pooled_output = hidden_state[:, 0]  # (bs, dim)
+        else:
+            distilbert_output = None
+            pooled_output = features.to(self.pre_classifier.weight.dtype)  # (bs, dim)
+        pooled_output = self._head_input(pooled_output)  # (bs, dim)
         logits = self.classifier(pooled_output)  # (bs, num_labels)
 
         loss = None
@@ -63,13 +154,66 @@ class DistilBertForPrincipalPrediction(DistilBertPreTrainedModel):
             loss_fct = BCEWithLogitsLoss(pos_weight=self.class_weights)
             loss = loss_fct(logits, labels)
 
+        if self.hierarchical:
+            cluster_logits = self.cluster_classifier(pooled_output)  # (bs, num_clusters)
+            if labels is not None:
+                # A cluster is a target when any of its labels is
+                cluster_labels = torch.zeros_like(cluster_logits).index_add_(1, self.label_clusters, labels.float())
+                loss = loss + BCEWithLogitsLoss()(cluster_logits, cluster_labels.clamp(max=1))
+            logits = self._hierarchical_log_probs(logits, cluster_logits)  # (bs, num_labels)
+
         if not return_dict:
-            output = (logits,) + distilbert_output[1:]
+            output = (logits,) + (distilbert_output[1:] if distilbert_output is not None else ())
             return ((loss,) + output) if loss is not None else output
 
         return SequenceClassifierOutput(
             loss=loss,
             logits=logits,
-            hidden_states=distilbert_output.hidden_states,
-            attentions=distilbert_output.attentions,
-        )
\ No newline at end of file
+            hidden_states=distilbert_output.hidden_states if distilbert_output is not None else None,
+            attentions=distilbert_output.attentions if distilbert_output is not None else None,
+        )
+
+    def top_k(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, k: int,
+              cluster_beam: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Predict the `k` most probable principals of a padded batch, without scoring every label when the head
+        is two-level. Probabilities are exact, but labels outside the most probable clusters are not considered.
+
+        :param input_ids: torch.Tensor
+            Token ids of shape (bs, seq_len).
+        :param attention_mask: torch.Tensor
+            Attention mask of shape (bs, seq_len).
+        :param k: int
+            Number of principals returned per utterance, at most `num_labels`.
+        :param cluster_beam: int, optional
+            Number of clusters scored, defaults to the config's `cluster_beam` and is raised to cover `k` labels.
+        :return:
+            Tuple[torch.Tensor, torch.Tensor]
+            Probabilities and label indices of shape (bs, k), most probable first.
+        """
+        hidden_state = self.distilbert(input_ids=input_ids, attention_mask=attention_mask)[0]
+        pooled_output = self._head_input(hidden_state[:, 0])  # (bs, dim)
+        if not self.hierarchical:
+            return torch.topk(torch.softmax(self.classifier(pooled_output).float(), dim=-1), k, dim=-1)
+
+        num_clusters, cluster_size = self.cluster_members.shape
+        beam = cluster_beam or getattr(self.config, 'cluster_beam', CLUSTER_BEAM_DEFAULT)
+        beam = min(num_clusters, max(beam, -(-k // self.min_cluster_size)))
+        cluster_log_probs = torch.log_softmax(self.cluster_classifier(pooled_output).float(), dim=-1)
+        top_cluster_log_probs, top_clusters = torch.topk(cluster_log_probs, beam, dim=-1)  # (bs, beam)
+
+        # Score the members of the clusters any utterance of the batch needs with a single matrix product
+        clusters, positions = torch.unique(top_clusters, return_inverse=True)  # (n_clusters,), (bs, beam)
+        member_ids = self.cluster_members[clusters].clamp(min=0).flatten()  # (n_clusters * cluster_size,)
+        weight, bias = _linear_parameters(self.classifier)
+        member_logits = nn.functional.linear(pooled_output, weight[member_ids], bias[member_ids])
+        member_logits = member_logits.view(-1, len(clusters), cluster_size)
+
+        # Then keep the top clusters of every utterance
+        label_ids = self.cluster_members[top_clusters]  # (bs, beam, cluster_size)
+        label_logits = member_logits.gather(1, positions[..., None].expand(-1, -1, cluster_size))
+        label_logits = label_logits.float().masked_fill(label_ids < 0, float('-inf'))
+        log_probs = top_cluster_log_probs[..., None] + torch.log_softmax(label_logits, dim=-1)
+
+        top_log_probs, positions = torch.topk(log_probs.flatten(1), k, dim=-1)
+        return top_log_probs.exp(), label_ids.flatten(1).gather(1, positions)
@@ -0,0 +1,368 @@
+import os
+import time
+import logging
+import threading
+import weakref
+from hashlib import blake2b
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from movie_prediction.cache import PredictionCache
+from movie_prediction.metrics import METRICS
+from movie_prediction.snapshot import serving_path
+from movie_prediction.constants import (
+    MODEL_DIR, PRINC_PRED_MODEL, PRINC_PRED_MODEL_INF, PRINC_PRED_MODEL_TUNED, PRINC_PRED_MODEL_TUNED_INF
+)
+
+__all__ = ['ModelRegistry', 'default_models', 'encoder_fingerprint', 'encoder_state_fingerprint', 'MODEL_VARIANTS']
+
+# Model variants served by default, see `default_models`
+MODEL_VARIANTS = [PRINC_PRED_MODEL_TUNED_INF, PRINC_PRED_MODEL_TUNED, PRINC_PRED_MODEL_INF, PRINC_PRED_MODEL]
+
+# Weights of the DistilBERT encoder in the principal prediction model's state dict
+_ENCODER_PREFIX = 'distilbert.'
+_WEIGHTS = 'model.safetensors'
+
+# Fingerprints by weights file, size and modification time, hashing the encoder takes a few hundred ms
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+MODELS_LOADED = METRICS.gauge('principal_models_loaded', "Number of model variants loaded in the registry.")
+MODELS_MEMORY = METRICS.gauge(
+    'principal_models_memory_bytes', "Bytes of weights held by the loaded models, shared encoders counted once.")
+MODEL_LOADS = METRICS.counter('principal_model_loads_total', "Model loads and hot swaps by model.", ['model'])
+MODEL_EVICTIONS = METRICS.counter(
+    'principal_model_evictions_total', "Models unloaded to stay within the memory budget.", ['model'])
+MODEL_LOAD_SECONDS = METRICS.gauge('principal_model_load_seconds', "Seconds spent loading a model.", ['model'])
+
+
+def default_models(model_dir: str = MODEL_DIR) -> Dict[str, str]:
+    """
+    Find the model variants in a model directory, preferring their snapshots.
+
+    :param model_dir: str, default MODEL_DIR
+        Directory holding the models named in `MODEL_VARIANTS`.
+    :return:
+        Dict[str, str]
+        The directory of every variant found, by name.
+    """
+    models = {}
+    for name in MODEL_VARIANTS:
+        path = serving_path(model_dir + '/' + name)
+        if os.path.isdir(path):
+            models[name] = path
+    return models
+
+
+def encoder_fingerprint(model_path: str) -> Optional[str]:
+    """
+    Hash the DistilBERT encoder weights of a model, so models whose heads were trained on the same frozen
+    encoder can share it. Only safetensors weights are read, see `movie_prediction.snapshot`.
+
+    :param model_path: str
+        Directory of the pretrained model or of its snapshot.
+    :return:
+        str or None
+        A 128 bit hex digest, or None if the model has no safetensors weights.
+    """
+    weights = os.path.join(model_path, _WEIGHTS)
+    if not os.path.isfile(weights):
+        return None
+    stat = os.stat(weights)
+    key = (os.path.realpath(weights), stat.st_size, stat.st_mtime_ns)
+    with _fingerprints_lock:
+        if key in _fingerprints:
+            return _fingerprints[key]
+
+    from safetensors import safe_open
+    with safe_open(weights, framework='np') as tensors:
+        names = sorted(name for name in tensors.keys() if name.startswith(_ENCODER_PREFIX))
+        fingerprint = _encoder_digest((name, tensors.get_tensor(name)) for name in names)
+    with _fingerprints_lock:
+        _fingerprints[key] = fingerprint
+    return fingerprint
+
+
+def encoder_state_fingerprint(encoder) -> str:
+    """
+    Hash the weights of a loaded DistilBERT encoder, e.g. `model.distilbert`. Unchanged weights hash to the
+    `encoder_fingerprint` of the model they were loaded from.
+
+    :param encoder: DistilBertModel
+        The encoder, on any device.
+    :return:
+        str
+        A 128 bit hex digest.
+    """
+    state = encoder.state_dict()
+    return _encoder_digest((_ENCODER_PREFIX + name, state[name].detach().cpu().numpy()) for name in sorted(state))
+
+
+def _encoder_digest(tensors: Iterable[Tuple[str, Any]]) -> str:
+    # Hash (name, array) pairs given in name order, one tensor at a time
+    digest = blake2b(digest_size=16)
+    for name, array in tensors:
+        digest.update(name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _state_bytes(value) -> int:
+    import torch
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    # Packed parameters of quantized layers are (weight, bias) tuples
+    if isinstance(value, (tuple, list)):
+        return sum(_state_bytes(item) for item in value)
+    return 0
+
+
+class _Entry:
+    __slots__ = ('name', 'model_path', 'backend', 'line_index', 'wrapper', 'fingerprint', 'last_used',
+                 'load_seconds', 'load_lock')
+
+    def __init__(self, name: str, model_path: str, backend: str, line_index=None):
+        self.name = name
+        self.model_path = model_path
+        self.backend = backend
+        self.line_index = line_index
+        self.wrapper = None
+        self.fingerprint = None
+        self.last_used = 0.0
+        self.load_seconds = None
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    Thread-safe registry serving several principal prediction model variants from one process.
+
+    Models are loaded on first use. Models whose heads were trained on the same frozen DistilBERT encoder share
+    a single copy of it, see `encoder_fingerprint`. `reload` builds the new version next to the old one and swaps
+    it in atomically, so in-flight requests finish on the version they started with. When the loaded weights
+    exceed the memory budget the least recently used models are unloaded, and load again when asked for.
+    """
+
+    def __init__(self, models: Mapping[str, str], default: Optional[str] = None, backend: str = 'fp32',
+                 memory_budget_mb: Optional[float] = None, cache: Optional[PredictionCache] = None,
+                 share_encoders: bool = True):
+        """
+        :param models: Mapping[str, str]
+            Directory of the pretrained model or snapshot of every variant, by name. See `default_models`.
+        :param default: str, optional
+            Name of the model served when none is asked for, defaults to the first model.
+        :param backend: str, default 'fp32'
+            Inference backend of the models, see `movie_prediction.backends.BACKENDS`.
+        :param memory_budget_mb: float, optional
+            Megabytes of weights the loaded models may hold. The budget is enforced after every load, so it is
+            exceeded by at most one model, and the model just loaded is never unloaded. Unlimited by default.
+        :param cache: PredictionCache, optional
+            Prediction cache shared by the models, keys include the model identity.
+        :param share_encoders: bool, default True
+            Whether models with identical encoder weights share them. Only applies to PyTorch backends.
+        """
+        if not models:
+            raise ValueError("The registry needs at least one model")
+        self.backend = backend
+        self.memory_budget_mb = memory_budget_mb
+        self.cache = cache
+        self.share_encoders = share_encoders
+        self._entries = {name: _Entry(name, path, backend) for name, path in models.items()}
+        self.default = default or next(iter(models))
+        if self.default not in self._entries:
+            raise KeyError(f"Unknown default model {self.default!r}, expected one of {list(self._entries)}")
+        # Shared encoders by fingerprint, backend and device, freed once no loaded model uses them
+        self._encoders = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._entries)
+
+    def _entry(self, name: Optional[str]) -> _Entry:
+        entry = self._entries.get(self.default if name is None else name)
+        if entry is None:
+            raise KeyError(f"Unknown model {name!r}, expected one of {self.names}")
+        return entry
+
+    def register(self, name: str, model_path: str, backend: Optional[str] = None, line_index=None):
+        """
+        Add a model variant, or change where one is loaded from. A loaded model keeps serving its current
+        version until it is reloaded.
+
+        :param name: str
+            Name of the model, as passed to `get`.
+        :param model_path: str
+            Directory of the pretrained model or of its snapshot.
+        :param backend: str, optional
+            Inference backend of the model, defaults to the registry's.
+        :param line_index: LineIndex, optional
+            Index of movie line embeddings built with this model, see `movie_prediction.search`.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self._entries[name] = _Entry(name, model_path, backend or self.backend, line_index)
+                return
+            entry.model_path = model_path
+            entry.backend = backend or entry.backend
+            if line_index is not None:
+                entry.line_index = line_index
+
+    def get(self, name: Optional[str] = None, load: bool = True):
+        """
+        Return the wrapper of a model, loading it first if needed. Concurrent calls load a model once.
+
+        :param name: str, optional
+            Name of the model, defaults to the default model.
+        :param load: bool, default True
+            Whether to load the model if it is not loaded, otherwise None is returned.
+        :return:
+            DistilBertForPrincipalPredictionWrapper or None
+        """
+        entry = self._entry(name)
+        wrapper = entry.wrapper
+        if wrapper is None and load:
+            with entry.load_lock:
+                wrapper = entry.wrapper
+                if wrapper is None:
+                    wrapper = self._load(entry)
+        if wrapper is not None:
+            entry.last_used = time.monotonic()
+        return wrapper
+
+    def reload(self, name: Optional[str] = None, model_path: Optional[str] = None):
+        """
+        Load a new version of a model and swap it in atomically. Until the swap requests are served by the
+        current version, and requests already holding it finish on it.
+
+        :param name: str, optional
+            Name of the model, defaults to the default model.
+        :param model_path: str, optional
+            Directory of the new version, defaults to the registered directory.
+        :return:
+            DistilBertForPrincipalPredictionWrapper
+            The new version.
+        """
+        entry = self._entry(name)
+        if model_path is not None:
+            self.register(entry.name, model_path)
+        with entry.load_lock:
+            wrapper = self._load(entry)
+        entry.last_used = time.monotonic()
+        return wrapper
+
+    def unload(self, name: str) -> bool:
+        """
+        Drop a loaded model. Its memory is freed once in-flight requests using it finish.
+
+        :return:
+            bool
+            Whether the model was loaded.
+        """
+        entry = self._entry(name)
+        with self._lock:
+            loaded = entry.wrapper is not None
+            entry.wrapper = None
+            MODELS_LOADED.set(sum(e.wrapper is not None for e in self._entries.values()))
+        if loaded:
+            logging.info(f"Unloaded model {entry.name}")
+        return loaded
+
+    def _load(self, entry: _Entry):
+        # Imported here so the registry can be created without importing torch
+        from movie_prediction.wrappers import DistilBertForPrincipalPredictionWrapper
+
+        start = time.perf_counter()
+        logging.info(f"Loading model {entry.name} from {entry.model_path}...")
+        wrapper = DistilBertForPrincipalPredictionWrapper(
+            cache=self.cache, line_index=entry.line_index, backend=entry.backend, model_path=entry.model_path)
+        fingerprint = encoder_fingerprint(entry.model_path) if self.share_encoders else None
+        if fingerprint is not None and wrapper.model is not None:
+            self._share_encoder(wrapper, fingerprint)
+
+        with self._lock:
+            entry.wrapper = wrapper
+            entry.fingerprint = fingerprint
+            entry.load_seconds = time.perf_counter() - start
+            MODELS_LOADED.set(sum(e.wrapper is not None for e in self._entries.values()))
+        MODEL_LOADS.inc(model=entry.name)
+        MODEL_LOAD_SECONDS.set(entry.load_seconds, model=entry.name)
+        logging.info(f"Model {entry.name} loaded in {entry.load_seconds:.2f}s")
+        self._enforce_budget(keep=entry)
+        return wrapper
+
+    def _share_encoder(self, wrapper, fingerprint: str):
+        key = (fingerprint, wrapper.backend.name, str(wrapper.device))
+        with self._lock:
+            encoder = self._encoders.get(key)
+            if encoder is None:
+                self._encoders[key] = wrapper.model.distilbert
+                return
+        # The freshly loaded copy is freed once it is replaced
+        wrapper.model.distilbert = encoder
+        logging.info(f"Model {wrapper.model_path} shares its encoder with a loaded model")
+
+    @staticmethod
+    def _components(wrapper) -> Dict[int, Any]:
+        # Top-level modules of a PyTorch model, or the ONNX file of an ONNX Runtime session, by identity
+        if wrapper.model is not None:
+            return {id(module): module for module in wrapper.model.children()}
+        from movie_prediction.backends import onnx_path
+        return {id(wrapper): onnx_path(wrapper.model_path)}
+
+    @staticmethod
+    def _component_bytes(component) -> int:
+        if isinstance(component, str):
+            return os.path.getsize(component) if os.path.isfile(component) else 0
+        return sum(_state_bytes(value) for value in component.state_dict().values())
+
+    def memory_bytes(self) -> int:
+        """
+        Bytes of weights held by the loaded models, shared encoders counted once.
+        """
+        components = {}
+        for entry in list(self._entries.values()):
+            if entry.wrapper is not None:
+                components.update(self._components(entry.wrapper))
+        return sum(self._component_bytes(component) for component in components.values())
+
+    def _enforce_budget(self, keep: _Entry):
+        memory = self.memory_bytes()
+        if self.memory_budget_mb is not None:
+            budget = self.memory_budget_mb * 2 ** 20
+            candidates = sorted(
+                (entry for entry in self._entries.values() if entry is not keep and entry.wrapper is not None),
+                key=lambda entry: entry.last_used)
+            for entry in candidates:
+                if memory <= budget:
+                    break
+                self.unload(entry.name)
+                MODEL_EVICTIONS.inc(model=entry.name)
+                memory = self.memory_bytes()
+        MODELS_MEMORY.set(memory)
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Describe every registered model: its directory, backend, whether it is loaded, its identity, the
+        megabytes of its weights including shared ones, its load time and the seconds since it was last used.
+        """
+        now = time.monotonic()
+        entries = list(self._entries.values())
+        components = [self._components(entry.wrapper) if entry.wrapper is not None else {} for entry in entries]
+        status = {}
+        for entry, own in zip(entries, components):
+            wrapper = entry.wrapper
+            status[entry.name] = {
+                'default': entry.name == self.default,
+                'path': entry.model_path,
+                'backend': entry.backend,
+                'loaded': wrapper is not None,
+                'model_id': wrapper.model_id if wrapper is not None else None,
+                'memory_mb': sum(map(self._component_bytes, own.values())) / 2 ** 20 if wrapper is not None else None,
+                'shared_encoder': any(
+                    other is not own and own.keys() & other.keys() for other in components),
+                'load_seconds': entry.load_seconds,
+                'idle_seconds': now - entry.last_used if wrapper is not None else None,
+            }
+        return status
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from movie_prediction.constants import *
+
+__all__ = ['split_shards', 'score_shards', 'main']
+
+_MANIFEST = 'manifest.json'
+_SHARD = 'shard_{:05d}.parquet'
+_SHARD_DIR = 'shards'
+_PREDICTION_DIR = 'predictions'
+
+# Model wrapper of a worker process, created by `_init_worker`
+_worker_wrapper = None
+_worker_args = None
+
+
+def _input_identity(input_fp: str) -> Dict[str, Any]:
+    stat = os.stat(input_fp)
+    return {'input': os.path.abspath(input_fp), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _iter_input_chunks(input_fp: str, column: str, shard_size: int):
+    if input_fp.endswith('.parquet'):
+        for batch in pq.ParquetFile(input_fp).iter_batches(batch_size=shard_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_fp, sep='\t', chunksize=shard_size, converters={column: str})
+
+
+def split_shards(input_fp: str, output_dir: str, column: str = UTTERANCE,
+                 shard_size: int = SCORING_SHARD_SIZE_DEFAULT, job: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Split a TSV or Parquet file of utterances into Parquet shards under `output_dir`, streaming the input.
+    Shards are only written once, later calls with the same input and settings reuse them.
+
+    :param input_fp: str
+        Path of the input, Parquet if it ends in `.parquet` and TSV with a header otherwise.
+    :param output_dir: str
+        Directory of the scoring job.
+    :param column: str, default UTTERANCE
+        Column holding the utterances.
+    :param shard_size: int, default SCORING_SHARD_SIZE_DEFAULT
+        Number of lines per shard.
+    :param job: Dict[str, Any], optional
+        Settings of the scoring job recorded in the manifest, resuming with other settings is refused.
+    :return:
+        int
+        The number of shards.
+    """
+    manifest = dict(_input_identity(input_fp), column=column, shard_size=shard_size, job=job or {})
+    manifest_fp = os.path.join(output_dir, _MANIFEST)
+    if os.path.isfile(manifest_fp):
+        with open(manifest_fp) as manifest_file:
+            previous = json.load(manifest_file)
+        num_shards = previous.pop('num_shards')
+        if previous != manifest:
+            raise ValueError(f"{output_dir} holds a scoring job with other input or settings, use a new directory")
+        return num_shards
+
+    shard_dir = os.path.join(output_dir, _SHARD_DIR)
+    os.makedirs(shard_dir, exist_ok=True)
+    num_shards = 0
+    for num_shards, chunk in enumerate(_iter_input_chunks(input_fp, column, shard_size), 1):
+        if column not in chunk:
+            raise KeyError(f"Input {input_fp} has no {column!r} column")
+        chunk.reset_index(drop=True).to_parquet(os.path.join(shard_dir, _SHARD.format(num_shards - 1)), index=False)
+
+    # The manifest is written last, so an interrupted split starts over
+    with open(manifest_fp + '.tmp', 'w') as manifest_file:
+        json.dump(dict(manifest, num_shards=num_shards), manifest_file)
+    os.replace(manifest_fp + '.tmp', manifest_fp)
+    return num_shards
+
+
+def _init_worker(args: Dict[str, Any]):
+    global _worker_wrapper, _worker_args
+    # One intra-op pool per worker, sized so the workers together use each core once
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    import torch
+    torch.set_num_threads(args['threads'])
+    torch.set_num_interop_threads(1)
+
+    from transformers import DistilBertTokenizerFast
+    from movie_prediction.wrappers import DistilBertForPrincipalPredictionWrapper
+    _worker_wrapper = DistilBertForPrincipalPredictionWrapper(
+        backend=args['backend'], model_path=args['model_path'],
+        tokenizer=DistilBertTokenizerFast.from_pretrained(args['tokenizer']))
+    _worker_args = args
+
+
+def _score_shard(shard: int) -> Tuple[int, int, float, int]:
+    start = time.perf_counter()
+    output_dir, column, top_k = _worker_args['output_dir'], _worker_args['column'], _worker_args['top_k']
+    lines = pd.read_parquet(os.path.join(output_dir, _SHARD_DIR, _SHARD.format(shard)))
+    probs, indices = _worker_wrapper.predict_batch(
+        lines[column].astype(str).tolist(), batch_size=_worker_args['batch_size'], top_k=top_k, as_numpy=True)
+
+    labels = _worker_wrapper.labels
+    for rank in range(probs.shape[1]):
+        lines[f'{PREDICTION} {rank + 1}'] = labels[indices[:, rank]]
+        lines[f'{PROBABILITY} {rank + 1}'] = probs[:, rank]
+
+    # Write atomically, a finished shard file is the checkpoint
+    prediction_fp = os.path.join(output_dir, _PREDICTION_DIR, _SHARD.format(shard))
+    lines.to_parquet(prediction_fp + '.tmp', index=False)
+    os.replace(prediction_fp + '.tmp', prediction_fp)
+    return shard, len(lines), time.perf_counter() - start, os.getpid()
+
+
+def score_shards(output_dir: str, num_shards: int, workers: int, threads: int, column: str = UTTERANCE,
+                 top_k: int = SCORING_TOP_K_DEFAULT, batch_size: int = BATCH_SIZE_DEFAULT, backend: str = 'fp32',
+                 model_path: Optional[str] = None, tokenizer: str = HUGGINGFACE_PRETRAINED) -> Dict[str, Any]:
+    """
+    Score the shards written by `split_shards` with a pool of worker processes, skipping finished shards.
+
+    Each worker loads its own model wrapper with `threads` intra-op threads and writes the `top_k` predictions
+    of a shard to `predictions/` once the whole shard is scored, so a killed job resumes at the first unfinished
+    shards. Prediction shards hold the input columns followed by `Prediction <rank>` and `Probability <rank>`.
+
+    :param output_dir: str
+        Directory of the scoring job.
+    :param num_shards: int
+        Number of input shards.
+    :param workers: int
+        Number of worker processes.
+    :param threads: int
+        Number of torch threads per worker.
+    :param column: str, default UTTERANCE
+        Column holding the utterances.
+    :param top_k: int, default SCORING_TOP_K_DEFAULT
+        Number of predicted principals kept per line.
+    :param batch_size: int, default BATCH_SIZE_DEFAULT
+        Number of utterances per forward pass.
+    :param backend: str, default 'fp32'
+        Inference backend of the workers, see `movie_prediction.backends.BACKENDS`.
+    :param model_path: str, optional
+        Directory of the pretrained model, defaults to the wrapper's model.
+    :param tokenizer: str, default HUGGINGFACE_PRETRAINED
+        Name or directory of the model's tokenizer.
+    :return:
+        Dict[str, Any]
+        Throughput statistics: lines, seconds and lines per second overall and per worker.
+    """
+    os.makedirs(os.path.join(output_dir, _PREDICTION_DIR), exist_ok=True)
+    pending = [
+        shard for shard in range(num_shards)
+        if not os.path.isfile(os.path.join(output_dir, _PREDICTION_DIR, _SHARD.format(shard)))]
+    print(f"Scoring {len(pending)} of {num_shards} shards with {workers} workers of {threads} threads...")
+    stats = {'shards': len(pending), 'lines': 0, 'seconds': 0.0, 'lines_per_second': 0.0, 'workers': {}}
+    if not pending:
+        return stats
+
+    worker_args = dict(output_dir=output_dir, column=column, top_k=top_k, batch_size=batch_size,
+                       backend=backend, model_path=model_path, tokenizer=tokenizer, threads=threads)
+    worker_stats = defaultdict(lambda: {'shards': 0, 'lines': 0, 'seconds': 0.0})
+    start = time.perf_counter()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(workers, len(pending)), initializer=_init_worker, initargs=(worker_args,)) as pool:
+        for done, (shard, lines, seconds, pid) in enumerate(pool.imap_unordered(_score_shard, pending), 1):
+            worker = worker_stats[pid]
+            worker['shards'] += 1
+            worker['lines'] += lines
+            worker['seconds'] += seconds
+            stats['lines'] += lines
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(pending)}] shard {shard}: {lines} lines at {lines / seconds:.1f} lines/sec "
+                  f"(worker {pid}), overall {stats['lines'] / elapsed:.1f} lines/sec")
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['lines_per_second'] = stats['lines'] / stats['seconds']
+    stats['workers'] = {
+        str(pid): dict(worker, lines_per_second=worker['lines'] / worker['seconds'])
+        for pid, worker in worker_stats.items()}
+    return stats
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(
+        description="Score a corpus of utterances with the principal prediction model using worker processes. "
+                    "Rerun the same command to resume an interrupted job.")
+    parser.add_argument('input', help="TSV (with header) or Parquet file of utterances.")
+    parser.add_argument('output', help="Job directory for shards, predictions and checkpoints.")
+    parser.add_argument('--column', default=UTTERANCE, help="Column holding the utterances.")
+    parser.add_argument('--workers', type=int, default=max(1, cpus // 4), help="Number of worker processes.")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Torch threads per worker, defaults to the cores divided among the workers.")
+    parser.add_argument('--shard-size', type=int, default=SCORING_SHARD_SIZE_DEFAULT)
+    parser.add_argument('--top-k', type=int, default=SCORING_TOP_K_DEFAULT)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE_DEFAULT)
+    parser.add_argument('--backend', default='fp32', help="Inference backend: fp32, int8 or onnx.")
+    parser.add_argument('--model-path', default=None, help="Directory of the pretrained model.")
+    parser.add_argument('--tokenizer', default=HUGGINGFACE_PRETRAINED, help="Name or directory of the tokenizer.")
+    args = parser.parse_args(argv)
+    if args.threads is None:
+        args.threads = max(1, cpus // args.workers)
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(argv)
+    job = {'top_k': args.top_k, 'backend': args.backend, 'model_path': args.model_path, 'tokenizer': args.tokenizer}
+    num_shards = split_shards(args.input, args.output, column=args.column, shard_size=args.shard_size, job=job)
+    stats = score_shards(
+        args.output, num_shards, args.workers, args.threads, column=args.column, top_k=args.top_k,
+        batch_size=args.batch_size, backend=args.backend, model_path=args.model_path, tokenizer=args.tokenizer)
+
+    for pid, worker in stats['workers'].items():
+        print(f"Worker {pid}: {worker['lines']} lines in {worker['shards']} shards, "
+              f"{worker['lines_per_second']:.1f} lines/sec")
+    print(f"Scored {stats['lines']} lines in {stats['seconds']:.1f}s, {stats['lines_per_second']:.1f} lines/sec")
+    print(f"Predictions written to: {os.path.join(args.output, _PREDICTION_DIR)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import os
+import json
+import argparse
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from movie_prediction.embeddings import EmbeddingStore
+from movie_prediction.constants import *
+
+__all__ = ['LineIndex']
+
+_META = 'meta.json'
+_VECTORS = 'vectors.npy'
+_CENTROIDS = 'centroids.npy'
+_LIST_OFFSETS = 'list_offsets.npy'
+_LINES = 'lines.parquet'
+
+_BLOCK_ROWS = 65536
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def _merge_top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Keep the k best of each row of candidates, sorted by descending score
+    if scores.shape[1] > k:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, ids = np.take_along_axis(scores, best, 1), np.take_along_axis(ids, best, 1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, 1), np.take_along_axis(ids, order, 1)
+
+
+def _spherical_kmeans(vectors: np.ndarray, nlist: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        counts = np.bincount(assignment, minlength=nlist)
+        order = np.argsort(assignment, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        # Restart empty lists from random vectors
+        sums = vectors[rng.choice(len(vectors), nlist, replace=False)]
+        filled = counts > 0
+        sums[filled] = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        centroids = _normalize(sums)
+    return centroids
+
+
+class LineIndex:
+    """
+    Cosine similarity index over the `[CLS]` embeddings of movie lines.
+
+    Vectors are L2 normalized and stored in a `.npy` file which is memory mapped on load. Without centroids the
+    index is searched exactly with blocked matrix products. With centroids it is an inverted file (IVF) index:
+    vectors are grouped by their nearest centroid into contiguous lists, and a query only scans the `nprobe`
+    lists whose centroids are most similar to it, which trades a little recall for scanning a small fraction
+    of the lines.
+    """
+
+    def __init__(self, vectors: np.ndarray, lines: pd.DataFrame, centroids: Optional[np.ndarray] = None,
+                 list_offsets: Optional[np.ndarray] = None, meta: Optional[Dict[str, Any]] = None):
+        """
+        :param vectors: np.ndarray
+            Normalized line embeddings of shape (n_lines, dim), grouped by list for IVF indexes.
+        :param lines: pd.DataFrame
+            Metadata aligned with `vectors`.
+        :param centroids: np.ndarray, optional
+            Normalized list centroids of shape (nlist, dim), None for an exact index.
+        :param list_offsets: np.ndarray, optional
+            Start row of every list in `vectors`, followed by the number of rows.
+        :param meta: Dict[str, Any], optional
+            Build information, such as the model the embeddings come from.
+        """
+        self.vectors = vectors
+        self.lines = lines
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.meta = meta or {}
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    @classmethod
+    def build(cls, store: EmbeddingStore, path: str, nlist: Optional[int] = None, sample_per_list: int = 32,
+              iterations: int = 20, seed: int = 0) -> 'LineIndex':
+        """
+        Build an index from an embedding store and write it to `path`.
+
+        :param store: EmbeddingStore
+            Store of the line embeddings, its metadata is kept with the index.
+        :param path: str
+            Directory to write the index to.
+        :param nlist: int, optional
+            Number of IVF lists, 0 for an exact index. Defaults to the square root of the number of lines.
+        :param sample_per_list: int, default 32
+            Number of vectors sampled per list to train the centroids on.
+        :param iterations: int, default 20
+            Number of k-means iterations.
+        :param seed: int, default 0
+            Seed for sampling and initializing centroids.
+        :return:
+            LineIndex
+            The built index, loaded from `path`.
+        """
+        num_rows = len(store)
+        if nlist is None:
+            nlist = int(np.sqrt(num_rows))
+        nlist = min(nlist, num_rows)
+        os.makedirs(path, exist_ok=True)
+        rng = np.random.default_rng(seed)
+
+        # Train centroids on a sample, then assign every vector to its list
+        position = np.arange(num_rows)
+        list_offsets = None
+        if nlist:
+            sample = np.sort(rng.choice(num_rows, min(sample_per_list * nlist, num_rows), replace=False))
+            vectors = np.concatenate([
+                _normalize(chunk[sample[(sample >= start) & (sample < start + len(chunk))] - start])
+                for start, chunk in zip(range(0, num_rows, store.meta['chunk_rows']), store.iter_chunks())
+            ])
+            logging.info(f"Training {nlist} centroids on {len(vectors)} vectors...")
+            centroids = _spherical_kmeans(vectors, nlist, iterations, rng)
+            np.save(os.path.join(path, _CENTROIDS), centroids)
+
+            assignment = np.concatenate([
+                np.argmax(_normalize(chunk[i:i + _BLOCK_ROWS]) @ centroids.T, axis=1)
+                for chunk in store.iter_chunks() for i in range(0, len(chunk), _BLOCK_ROWS)
+            ])
+            order = np.argsort(assignment, kind='stable')
+            position[order] = np.arange(num_rows)
+            list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+            np.save(os.path.join(path, _LIST_OFFSETS), list_offsets)
+
+        # Write normalized vectors and metadata in list order
+        logging.info(f"Writing {num_rows} vectors to {path}...")
+        vectors = np.lib.format.open_memmap(
+            os.path.join(path, _VECTORS), mode='w+', dtype=np.float32, shape=(num_rows, store.dim))
+        for start, chunk in zip(range(0, num_rows, store.meta['chunk_rows']), store.iter_chunks()):
+            vectors[position[start:start + len(chunk)]] = _normalize(chunk)
+        vectors.flush()
+        lines = store.metadata
+        lines.iloc[np.argsort(position)].drop(columns=[UTTERANCE_HASH], errors='ignore').to_parquet(
+            os.path.join(path, _LINES), index=False)
+        with open(os.path.join(path, _META), 'w') as meta_file:
+            json.dump({'model': store.meta['model'], 'nlist': nlist, 'num_rows': num_rows}, meta_file)
+
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str) -> 'LineIndex':
+        """
+        Load an index written by `build`, memory mapping its vectors.
+        """
+        with open(os.path.join(path, _META)) as meta_file:
+            meta = json.load(meta_file)
+        centroids, list_offsets = None, None
+        if meta['nlist']:
+            centroids = np.load(os.path.join(path, _CENTROIDS))
+            list_offsets = np.load(os.path.join(path, _LIST_OFFSETS))
+        return cls(
+            np.load(os.path.join(path, _VECTORS), mmap_mode='r'),
+            pd.read_parquet(os.path.join(path, _LINES)),
+            centroids, list_offsets, meta)
+
+    def _search_exact(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), _BLOCK_ROWS):
+            block_scores = queries @ self.vectors[start:start + _BLOCK_ROWS].T
+            block_ids = np.broadcast_to(np.arange(start, start + block_scores.shape[1]), block_scores.shape)
+            scores, ids = _merge_top_k(
+                np.concatenate([scores, block_scores], axis=1), np.concatenate([ids, block_ids], axis=1), k)
+        return scores, ids
+
+    def _search_lists(self, query: np.ndarray, k: int, nprobe: int) -> Tuple[np.ndarray, np.ndarray]:
+        probe = np.argsort(-(self.centroids @ query), kind='stable')[:nprobe]
+        bounds = [(self.list_offsets[i], self.list_offsets[i + 1]) for i in probe]
+        scores = np.concatenate([np.zeros(0, dtype=np.float32)] + [self.vectors[a:b] @ query for a, b in bounds])
+        ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.arange(a, b) for a, b in bounds])
+        return _merge_top_k(scores[None], ids[None], k)
+
+    def search(self, queries: np.ndarray, k: int = SIMILAR_LINES_DEFAULT, nprobe: int = LINE_INDEX_NPROBE_DEFAULT,
+               exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the lines most similar to query embeddings.
+
+        :param queries: np.ndarray
+            Query embeddings of shape (n_queries, dim), they are normalized here.
+        :param k: int, default SIMILAR_LINES_DEFAULT
+            Number of lines to return per query, at least 1.
+        :param nprobe: int, default LINE_INDEX_NPROBE_DEFAULT
+            Number of IVF lists scanned per query.
+        :param exact: bool, default False
+            Whether to scan all lines even if the index has lists.
+        :return:
+            Tuple[np.ndarray, np.ndarray]
+            Cosine similarities and row ids into `lines`, both of shape (n_queries, k) and sorted by descending
+            similarity. Rows have fewer than k columns when fewer lines were scanned.
+        """
+        if k < 1:
+            raise ValueError(f"k must be positive, got {k}")
+        queries = _normalize(np.atleast_2d(queries))
+        k = min(k, len(self))
+        if exact or self.centroids is None:
+            return self._search_exact(queries, k)
+
+        results = [self._search_lists(query, k, nprobe) for query in queries]
+        k = min(len(ids[0]) for _, ids in results)
+        return (np.concatenate([scores[:, :k] for scores, _ in results]),
+                np.concatenate([ids[:, :k] for _, ids in results]))
+
+
+def main():
+    from movie_prediction.data_loaders.processed import load_principal_movie_lines
+    from movie_prediction.embeddings import embed_utterances
+    from movie_prediction.wrappers import DistilBertForPrincipalPredictionWrapper
+
+    parser = argparse.ArgumentParser(description="Build the similar lines index of the serving model.")
+    parser.add_argument('--lines', default=DATA_DIR + '/' + PRINCIPALS_LINES_PARQUET_DEFAULT,
+                        help="Principal lines dataset cache to index.")
+    parser.add_argument('--output', default=DATA_DIR + '/' + LINE_INDEX_DEFAULT, help="Index directory.")
+    parser.add_argument('--nlist', type=int, default=None, help="Number of IVF lists, 0 for an exact index.")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE_DEFAULT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    wrapper = DistilBertForPrincipalPredictionWrapper()
+    principal_lines = load_principal_movie_lines(args.lines)
+    store = EmbeddingStore(
+        EMBEDDING_DIR + '/lines-' + wrapper.model_id, dim=wrapper.config.dim, model=wrapper.model_id)
+    embed_utterances(
+        wrapper.model, wrapper.tokenizer, principal_lines[UTTERANCE], store,
+        metadata=principal_lines[[LINE_ID, CHARAC, TITLE, YEAR, PRINCIPAL]], batch_size=args.batch_size)
+    index = LineIndex.build(store, args.output, nlist=args.nlist)
+    print(f"Indexed {len(index)} lines in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import os
+import argparse
+import logging
+from typing import Optional
+
+from movie_prediction.constants import *
+
+__all__ = ['snapshot_path', 'is_snapshot', 'serving_path', 'save_snapshot', 'main']
+
+# Written by `save_pretrained(safe_serialization=True)` and by fast tokenizers
+_WEIGHTS = 'model.safetensors'
+_TOKENIZER = 'tokenizer.json'
+
+
+def snapshot_path(model_path: str) -> str:
+    """
+    Path of the serving snapshot of a model, next to the model directory.
+    """
+    return model_path.rstrip('/') + SNAPSHOT_SUFFIX
+
+
+def is_snapshot(path: str) -> bool:
+    """
+    Whether a directory holds safetensors weights and a serialized tokenizer, as written by `save_snapshot`.
+    """
+    return os.path.isfile(os.path.join(path, _WEIGHTS)) and os.path.isfile(os.path.join(path, _TOKENIZER))
+
+
+def serving_path(model_path: str) -> str:
+    """
+    Directory a model is served from: its snapshot when there is one, the model directory otherwise.
+    """
+    return snapshot_path(model_path) if is_snapshot(snapshot_path(model_path)) else model_path
+
+
+def save_snapshot(model_path: str, tokenizer: str = HUGGINGFACE_PRETRAINED, output_path: Optional[str] = None) -> str:
+    """
+    Write a self-contained serving snapshot of a model: its configuration, its weights as safetensors and
+    its tokenizer as a single `tokenizer.json`.
+
+    Safetensors files are memory mapped on load instead of unpickled, and the serialized tokenizer is built
+    without the vocabulary conversion or hub lookups of `from_pretrained` on a model name, so a server loads
+    the snapshot much faster and fully offline.
+
+    :param model_path: str
+        Directory of the pretrained model.
+    :param tokenizer: str, default HUGGINGFACE_PRETRAINED
+        Name or directory of the model's tokenizer.
+    :param output_path: str, optional
+        Directory of the snapshot, see `snapshot_path` for the default.
+    :return:
+        str
+        The directory of the snapshot.
+    """
+    # Imported here so checking for snapshots does not import transformers
+    from transformers import DistilBertTokenizerFast
+    from movie_prediction.models import DistilBertForPrincipalPrediction
+
+    output_path = output_path or snapshot_path(model_path)
+    logging.info(f"Writing snapshot of {model_path} to {output_path}...")
+    model = DistilBertForPrincipalPrediction.from_pretrained(model_path)
+    model.save_pretrained(output_path, safe_serialization=True)
+    DistilBertTokenizerFast.from_pretrained(tokenizer).save_pretrained(output_path)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a safetensors snapshot of a principal prediction model and its tokenizer for serving.")
+    parser.add_argument('--model-path', default=MODEL_DIR + '/' + PRINC_PRED_MODEL_TUNED_INF,
+                        help="Directory of the pretrained model, the snapshot is written next to it.")
+    parser.add_argument('--tokenizer', default=HUGGINGFACE_PRETRAINED, help="Name or directory of the tokenizer.")
+    parser.add_argument('--output', default=None, help="Directory of the snapshot.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"Snapshot written to: {save_snapshot(args.model_path, args.tokenizer, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
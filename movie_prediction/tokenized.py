@@ -0,0 +1,136 @@
+import os
+import json
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+import torch
+
+from movie_prediction.constants import TOKENIZER_ARGS_UNPADDED
+
+__all__ = ['pretokenize', 'TokenizedDataset']
+
+_INPUT_IDS = 'input_ids.bin'
+_OFFSETS = 'offsets.npy'
+_LABELS = 'labels.npy'
+_META = 'meta.json'
+
+
+def pretokenize(utterances: Sequence[str], tokenizer, path: str, labels: Optional[np.ndarray] = None,
+                batch_size: int = 10000, tokenizer_args: Dict[str, Any] = TOKENIZER_ARGS_UNPADDED) -> 'TokenizedDataset':
+    """
+    Tokenize utterances once and store them as packed token ids in a memory mappable directory.
+
+    Token ids of all utterances are concatenated without padding into `input_ids.bin`, as int16 when the vocabulary
+    fits and int32 otherwise, and `offsets.npy` holds the start of every utterance. Since nothing is padded the
+    attention mask is all ones and is not stored. Tokenization is done `batch_size` utterances at a time, so
+    memory does not grow with the number of utterances.
+
+    :param utterances: Sequence[str]
+        The utterance texts to tokenize.
+    :param tokenizer:
+        A huggingface tokenizer.
+    :param path: str
+        Directory to write the store to.
+    :param labels: np.ndarray, optional
+        Labels aligned with the utterances, stored in `labels.npy`.
+    :param batch_size: int, default 10000
+        Number of utterances tokenized at a time.
+    :param tokenizer_args: Dict[str, Any], default TOKENIZER_ARGS_UNPADDED
+        Arguments passed to the tokenizer, padding must be disabled.
+    :return:
+        TokenizedDataset
+        The dataset reading the written store.
+    """
+    if tokenizer_args.get('padding'):
+        raise ValueError("Pre-tokenized stores are packed, tokenizer_args must not pad")
+    if labels is not None and len(labels) != len(utterances):
+        raise ValueError(f"Got {len(labels)} labels for {len(utterances)} utterances")
+    os.makedirs(path, exist_ok=True)
+    dtype = np.int16 if len(tokenizer) <= np.iinfo(np.int16).max else np.int32
+
+    offsets = np.zeros(len(utterances) + 1, dtype=np.int64)
+    with open(os.path.join(path, _INPUT_IDS), 'wb') as ids_file:
+        for start in range(0, len(utterances), batch_size):
+            input_ids = tokenizer(
+                [str(utt) for utt in utterances[start:start + batch_size]], **tokenizer_args)['input_ids']
+            lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+            offsets[start + 1:start + 1 + len(input_ids)] = offsets[start] + np.cumsum(lengths)
+            ids_file.write(np.fromiter(
+                (token for ids in input_ids for token in ids), dtype=dtype, count=int(lengths.sum())).tobytes())
+
+    np.save(os.path.join(path, _OFFSETS), offsets)
+    if labels is not None:
+        np.save(os.path.join(path, _LABELS), np.asarray(labels))
+    with open(os.path.join(path, _META), 'w') as meta_file:
+        json.dump({
+            'dtype': np.dtype(dtype).name,
+            'num_utterances': len(utterances),
+            'num_tokens': int(offsets[-1]),
+            'tokenizer': getattr(tokenizer, 'name_or_path', None),
+            'tokenizer_args': tokenizer_args,
+        }, meta_file)
+    return TokenizedDataset(path)
+
+
+class TokenizedDataset(torch.utils.data.Dataset):
+    """
+    Dataset over a store written by `pretokenize`.
+
+    Token ids are memory mapped and items are zero-copy tensor views into the mapping, so DataLoader workers and
+    repeated runs share the same on-disk tokens through the page cache. The mapping is opened lazily in every
+    process and never pickled. Items are unpadded, batch them with `PaddingCollator`.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: str
+            Directory written by `pretokenize`.
+        """
+        self.path = path
+        with open(os.path.join(path, _META)) as meta_file:
+            self.meta = json.load(meta_file)
+        self._input_ids = None
+        self._offsets = None
+        self._labels = None
+
+    def _open(self):
+        if self._offsets is None:
+            self._offsets = np.load(os.path.join(self.path, _OFFSETS), mmap_mode='r')
+            # Copy-on-write mappings are writable numpy arrays, which torch can wrap without copying
+            self._input_ids = np.memmap(
+                os.path.join(self.path, _INPUT_IDS), dtype=self.meta['dtype'], mode='c',
+                shape=(self.meta['num_tokens'],)) if self.meta['num_tokens'] else np.empty(0, self.meta['dtype'])
+            labels_fp = os.path.join(self.path, _LABELS)
+            if os.path.isfile(labels_fp):
+                self._labels = np.load(labels_fp, mmap_mode='c')
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state.update(_input_ids=None, _offsets=None, _labels=None)
+        return state
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        self._open()
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+        item = {'input_ids': torch.from_numpy(self._input_ids[start:end])}
+        if self._labels is not None:
+            item['labels'] = torch.as_tensor(self._labels[idx])
+        return item
+
+    def __len__(self) -> int:
+        return self.meta['num_utterances']
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Token length of every item.
+        """
+        self._open()
+        return np.diff(self._offsets)
+
+    def token_ids(self, idx: int) -> np.ndarray:
+        """
+        Token ids of an item as a memory mapped array.
+        """
+        self._open()
+        return self._input_ids[self._offsets[idx]:self._offsets[idx + 1]]
@@ -0,0 +1,129 @@
+import os
+import json
+import logging
+from hashlib import blake2b
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from transformers import Trainer
+
+from movie_prediction.bucketing import LengthBucketSampler, length_sorted_batches
+from movie_prediction.datasets import PaddingCollator
+from movie_prediction.registry import encoder_state_fingerprint
+
+__all__ = ['BucketedTrainer', 'compute_encoder_features']
+
+# Written next to a features cache, see `compute_encoder_features`
+_FINGERPRINT_SUFFIX = '.json'
+
+
+class BucketedTrainer(Trainer):
+    """
+    Trainer which draws training batches of similar token length with `LengthBucketSampler`,
+    so each batch is only padded to its own longest utterance.
+    Expects a training dataset exposing `lengths`, such as an unpadded `PrincipalDataset`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('data_collator', PaddingCollator())
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = None
+
+    def get_train_dataloader(self) -> DataLoader:
+        self.train_batch_sampler = LengthBucketSampler(
+            self.train_dataset.lengths, self.args.train_batch_size, seed=self.args.seed)
+        return DataLoader(
+            self.train_dataset,
+            batch_sampler=self.train_batch_sampler,
+            # Drop item fields the model does not accept, such as the utterance texts
+            collate_fn=self._get_collator_with_removed_columns(self.data_collator, description='training'),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+
+def _features_fingerprint(encoder, dataset: Dataset) -> Dict[str, Any]:
+    # The features only depend on the encoder weights and the token ids, in dataset order
+    input_ids = blake2b(digest_size=16)
+    for i in range(len(dataset)):
+        ids = np.asarray(dataset[i]['input_ids'], dtype=np.int64)
+        input_ids.update(len(ids).to_bytes(8, 'little'))
+        input_ids.update(ids.tobytes())
+    return {'encoder': encoder_state_fingerprint(encoder), 'items': len(dataset), 'input_ids': input_ids.hexdigest()}
+
+
+def _read_features_cache(cache_fp: str, fingerprint: Dict[str, Any]) -> Optional[np.ndarray]:
+    if not (os.path.isfile(cache_fp) and os.path.isfile(cache_fp + _FINGERPRINT_SUFFIX)):
+        return None
+    with open(cache_fp + _FINGERPRINT_SUFFIX) as fingerprint_file:
+        if json.load(fingerprint_file) != fingerprint:
+            logging.info(f"Encoder features cache {cache_fp} was computed with another encoder or dataset")
+            return None
+    return np.load(cache_fp, mmap_mode='r')
+
+
+def _write_features_cache(cache_fp: str, features: np.ndarray, fingerprint: Dict[str, Any]):
+    # Both files are replaced once complete, the fingerprint last, so an interrupted write is never read back
+    with open(cache_fp + '.tmp', 'wb') as cache_file:
+        np.save(cache_file, features)
+    os.replace(cache_fp + '.tmp', cache_fp)
+    with open(cache_fp + _FINGERPRINT_SUFFIX + '.tmp', 'w') as fingerprint_file:
+        json.dump(fingerprint, fingerprint_file)
+    os.replace(cache_fp + _FINGERPRINT_SUFFIX + '.tmp', cache_fp + _FINGERPRINT_SUFFIX)
+
+
+def compute_encoder_features(model, dataset: Dataset, batch_size: int = 64, cache_fp: Optional[str] = None,
+                             pad_token_id: int = 0) -> np.ndarray:
+    """
+    Compute the `[CLS]` outputs of a model's DistilBERT encoder for every item of a dataset.
+
+    When the encoder is frozen its outputs never change, so they can be computed once and the classification
+    head trained on them with `EncoderFeatureDataset`, which skips the encoder in every epoch. The encoder is
+    run in eval mode, so the features match a frozen encoder without dropout.
+
+    :param model: DistilBertForPrincipalPrediction
+        The model whose encoder to run, on its current device.
+    :param dataset: Dataset
+        Dataset with `input_ids` items and `lengths`, such as `PrincipalDataset` or `TokenizedDataset`.
+    :param batch_size: int, default 64
+        Number of items per forward pass, batches are formed from items of similar length.
+    :param cache_fp: str, optional
+        `.npy` file the features are saved to, and memory mapped from when they were computed by the same
+        encoder weights from the same token ids. Its fingerprint is stored next to it, in `<cache_fp>.json`.
+    :param pad_token_id: int, default 0
+        Token id used to pad batches.
+    :return:
+        np.ndarray
+        float32 features of shape (n_items, dim) in dataset order.
+    """
+    encoder = model.distilbert
+    fingerprint = None
+    if cache_fp:
+        fingerprint = _features_fingerprint(encoder, dataset)
+        features = _read_features_cache(cache_fp, fingerprint)
+        if features is not None:
+            logging.info(f"Loading encoder features from cache: {cache_fp}")
+            return features
+
+    features = np.empty((len(dataset), encoder.config.dim), dtype=np.float32)
+    device = next(encoder.parameters()).device
+    collator = PaddingCollator(pad_token_id)
+    was_training = encoder.training
+    encoder.eval()
+    try:
+        with torch.inference_mode():
+            for batch in length_sorted_batches(dataset.lengths, batch_size):
+                inputs = collator([
+                    {key: item[key] for key in ('input_ids', 'attention_mask') if key in item}
+                    for item in (dataset[i] for i in batch)])
+                hidden_state = encoder(
+                    input_ids=inputs['input_ids'].to(device), attention_mask=inputs['attention_mask'].to(device))[0]
+                features[batch] = hidden_state[:, 0].float().cpu().numpy()
+    finally:
+        encoder.train(was_training)
+
+    if cache_fp:
+        _write_features_cache(cache_fp, features, fingerprint)
+    return features
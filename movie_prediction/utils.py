@@ -1,12 +1,24 @@
 import re
-from typing import Tuple
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
 
-import pandas as pd
+# pandas is imported by the column functions, so the string functions stay cheap to import for serving
+if TYPE_CHECKING:
+    import pandas as pd
 
-__all__ = ['sanitize_string', 'sanitize_string_column', 'extract_names']
+__all__ = ['sanitize_string', 'sanitize_string_column', 'extract_names', 'extract_names_column']
 
 __ALPHANUMERIC_REGEX = re.compile(r'[^0-9A-Za-z\s]')
 __SPACING_REGEX = re.compile(r'\s+')
+# Non alpha-numeric runs, what replacing non alpha-numeric characters and then whitespace runs amounts to
+__NON_ALPHANUMERIC_RUN_REGEX = re.compile(r'[^0-9A-Za-z]+')
+
+# Characters matched by `\s` and stripped by `str.strip`, spelled out for regex engines with ASCII-only `\s`.
+# The last unicode whitespace character is U+3000.
+_WHITESPACE = ''.join(chr(c) for c in range(0x3001) if chr(c).isspace())
+_WHITESPACE_CLASS = ''.join(f'\\x{{{ord(c):x}}}' for c in _WHITESPACE)
+
+# Title prefixes removed by `extract_names`, in the order they are checked
+_NAME_PREFIXES = ['LT ', 'MR ', 'MS ', 'MRS ', 'MISS ']
 
 
 def sanitize_string(text: str,
@@ -42,11 +54,68 @@ def sanitize_string(text: str,
     return text
 
 
-def sanitize_string_column(series: pd.Series, upper: bool = False,
+def _fused_sanitizer(upper: bool, alphanumeric_only: bool, strip: bool,
+                     whitespace: bool) -> Callable[[str], str]:
+    if alphanumeric_only and whitespace:
+        replace = lambda text: __NON_ALPHANUMERIC_RUN_REGEX.sub(' ', text)
+    elif alphanumeric_only:
+        replace = lambda text: __ALPHANUMERIC_REGEX.sub(' ', text)
+    elif whitespace:
+        replace = lambda text: __SPACING_REGEX.sub(' ', text)
+    else:
+        replace = lambda text: text
+
+    if strip and upper:
+        return lambda text: replace(text).strip().upper()
+    if strip:
+        return lambda text: replace(text).strip()
+    if upper:
+        return lambda text: replace(text).upper()
+    return replace
+
+
+def _sanitize_arrow(series: 'pd.Series', upper: bool, alphanumeric_only: bool, strip: bool,
+                    whitespace: bool) -> Optional['pd.Series']:
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        return None
+    import pandas as pd
+    # Arrow's upper casing differs from python's outside ASCII
+    if series.dtype != object or (upper and not alphanumeric_only):
+        return None
+    try:
+        array = pa.array(series.values, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+
+    if alphanumeric_only and whitespace:
+        array = pc.replace_substring_regex(array, r'[^0-9A-Za-z]+', ' ')
+    elif alphanumeric_only:
+        array = pc.replace_substring_regex(array, f'[^0-9A-Za-z{_WHITESPACE_CLASS}]', ' ')
+    elif whitespace:
+        array = pc.replace_substring_regex(array, f'[{_WHITESPACE_CLASS}]+', ' ')
+    if strip:
+        array = pc.utf8_trim(array, _WHITESPACE)
+    if upper:
+        array = pc.ascii_upper(array)
+
+    sanitized = pd.Series(array.to_numpy(zero_copy_only=False), index=series.index, name=series.name)
+    # Keep missing values as they were, None or NaN
+    if array.null_count:
+        sanitized = sanitized.where(series.notnull(), series)
+    return sanitized
+
+
+def sanitize_string_column(series: 'pd.Series', upper: bool = False,
                            alphanumeric_only: bool = False, strip: bool = False,
-                           whitespace: bool = False) -> pd.Series:
+                           whitespace: bool = False) -> 'pd.Series':
     """
     Function for conditionally sanitizing string series in pandas.
+    Gives the same results as `sanitize_string` on every element, in a single pass over the series.
+    String columns are sanitized with Arrow compute kernels when pyarrow is available, other columns
+    fall back to python, where non string values become NaN like with the pandas `str` accessor.
 
     :param series: pd.Series,
         the pandas series containing strings to sanitize
@@ -63,16 +132,17 @@ def sanitize_string_column(series: pd.Series, upper: bool = False,
         The sanitized Pandas series.
 
     """
+    sanitized = _sanitize_arrow(series, upper, alphanumeric_only, strip, whitespace)
+    if sanitized is not None:
+        return sanitized
 
-    if alphanumeric_only:
-        series = series.str.replace(__ALPHANUMERIC_REGEX, ' ')
-    if whitespace:
-        series = series.str.replace(__SPACING_REGEX, ' ')
-    if strip:
-        series = series.str.strip()
-    if upper:
-        series = series.str.upper()
-    return series
+    import numpy as np
+    import pandas as pd
+    sanitize = _fused_sanitizer(upper, alphanumeric_only, strip, whitespace)
+    return pd.Series([
+        sanitize(text) if isinstance(text, str) else (None if text is None else np.nan)
+        for text in series.values
+    ], index=series.index, name=series.name, dtype=object)
 
 
 def extract_names(text: str) -> Tuple[str, str, str, str]:
@@ -111,3 +181,60 @@ def extract_names(text: str) -> Tuple[str, str, str, str]:
 
     return first, last, first_last, full
 
+
+
+def _extract_names_arrow(series: 'pd.Series') -> Optional[Tuple['pd.Series', 'pd.Series', 'pd.Series', 'pd.Series']]:
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        return None
+    import pandas as pd
+    try:
+        text = pa.array(series.values, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+
+    # Strip title prefixes, `lstrip` removes any of the prefix characters and not just the prefix
+    for prefix in _NAME_PREFIXES:
+        text = pc.if_else(pc.starts_with(text, prefix), pc.utf8_ltrim(text, prefix), text)
+
+    # Pad with spaces so every name splits into at least four parts
+    n_spaces = pc.count_substring(text, ' ')
+    parts = pc.split_pattern(pc.binary_join_element_wise(text, '   ', ''), ' ', max_splits=3)
+    first, middle, last = [pc.list_element(parts, i) for i in range(3)]
+    single, multiple = pc.equal(n_spaces, 1), pc.greater(n_spaces, 1)
+    none = pa.scalar(None, pa.string())
+
+    columns = [
+        first,
+        pc.if_else(multiple, last, pc.if_else(single, middle, none)),
+        pc.if_else(multiple, pc.binary_join_element_wise(first, last, ' '), pc.if_else(single, text, none)),
+        pc.if_else(multiple, pc.binary_join_element_wise(first, middle, last, ' '), text),
+    ]
+    # `to_pandas` gives a default index, which `pd.Series` would align on instead of taking `series.index`
+    return tuple(pd.Series(column.to_numpy(zero_copy_only=False), index=series.index, dtype=object)
+                 for column in columns)
+
+
+def extract_names_column(series: 'pd.Series') -> Tuple['pd.Series', 'pd.Series', 'pd.Series', 'pd.Series']:
+    """
+    Function for extracting names from a string series in pandas.
+    Gives the same results as `extract_names` on every element, missing values give missing names.
+    :param series: pd.Series
+        the pandas series containing names with sanitized spaces
+    :return:
+        (first, last, first_last, full)
+        A tuple of series containing the first names, last names, first name + last name combinations,
+        and full names.
+    """
+    names = _extract_names_arrow(series)
+    if names is not None:
+        return names
+
+    import pandas as pd
+    names = [extract_names(text) if isinstance(text, str) else (None,) * 4 for text in series.values]
+    return tuple(
+        pd.Series([name[i] for name in names], index=series.index, dtype=object)
+        for i in range(4)
+    )
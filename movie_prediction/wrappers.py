@@ -1,62 +1,317 @@
-from typing import Mapping
+import os
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+import numpy as np
 import torch
 import logging
 from transformers import DistilBertTokenizerFast
 
-from movie_prediction.models import DistilBertForPrincipalPrediction
+from movie_prediction.backends import load_backend
+from movie_prediction.bucketing import PaddingStats, length_sorted_batches, pad_sequences
+from movie_prediction.cache import PredictionCache
+from movie_prediction.metrics import METRICS, STAGE_SECONDS, TOKEN_LENGTH_BUCKETS
+from movie_prediction.search import LineIndex
+from movie_prediction.snapshot import is_snapshot, serving_path
+from movie_prediction.tokenized import TokenizedDataset
 from movie_prediction.constants import (
-    HUGGINGFACE_PRETRAINED, TOKENIZER_ARGS_DEFAULT,
-    PRINC_PRED_MODEL_TUNED_INF, MODEL_DIR
+    HUGGINGFACE_PRETRAINED, TOKENIZER_ARGS_UNPADDED, BATCH_SIZE_DEFAULT,
+    PRINC_PRED_MODEL_TUNED_INF, MODEL_DIR, SIMILAR_LINES_DEFAULT, LINE_INDEX_NPROBE_DEFAULT,
+    UTTERANCE, CHARAC, TITLE, YEAR, PRINCIPAL, SIMILARITY
 )
 
+SIMILAR_LINE_COLS = [UTTERANCE, PRINCIPAL, CHARAC, TITLE, YEAR]
+
 __all__ = ['DistilBertForPrincipalPredictionWrapper']
 
+INPUT_TOKENS = METRICS.histogram(
+    'principal_input_tokens', "Token lengths of predicted utterances, special tokens included.",
+    buckets=TOKEN_LENGTH_BUCKETS)
+PREDICTED_UTTERANCES = METRICS.counter(
+    'principal_predicted_utterances_total', "Utterances run through the model, cache hits excluded.")
+
 
 class DistilBertForPrincipalPredictionWrapper:
     """
     Wrapper class for loading and serving the Principal Prediction Model
     """
 
-    def __init__(self):
-        self.model_path = MODEL_DIR + '/' + PRINC_PRED_MODEL_TUNED_INF
-        logging.info(f"Loading model from {self.model_path}...")
-        self.tokenizer = DistilBertTokenizerFast.from_pretrained(HUGGINGFACE_PRETRAINED)
-        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    def __init__(self, cache: Optional[PredictionCache] = None, line_index: Optional[LineIndex] = None,
+                 backend: str = 'fp32', model_path: Optional[str] = None, tokenizer=None):
+        """
+        :param cache: PredictionCache, optional
+            Cache consulted before running the model on an utterance.
+        :param line_index: LineIndex, optional
+            Index of movie line embeddings searched by `similar_lines`, built with this model.
+        :param backend: str, default 'fp32'
+            Inference backend, one of `movie_prediction.backends.BACKENDS`: eager 'fp32', 'int8' dynamically
+            quantized Linear layers on CPU, or 'onnx' for the model's ONNX export on ONNX Runtime.
+        :param model_path: str, optional
+            Directory of the pretrained model or of its snapshot, see `movie_prediction.snapshot`.
+            Defaults to the tuned inference model, loaded from its snapshot when there is one.
+        :param tokenizer: optional
+            The model's huggingface tokenizer, defaults to the snapshot's tokenizer when loading a snapshot
+            and to the pretrained DistilBERT tokenizer otherwise.
+        """
+        if model_path is None:
+            model_path = serving_path(MODEL_DIR + '/' + PRINC_PRED_MODEL_TUNED_INF)
+        self.model_path = model_path
+        if tokenizer is None:
+            tokenizer = DistilBertTokenizerFast.from_pretrained(
+                model_path if is_snapshot(model_path) else HUGGINGFACE_PRETRAINED)
+        self.tokenizer = tokenizer
 
-        self.model = DistilBertForPrincipalPrediction.from_pretrained(self.model_path)
-        self.model.to(self.device)
-        self.model.eval()
+        self.backend = load_backend(backend, self.model_path)
+        self.device = self.backend.device
+        self.config = self.backend.config
+        # The PyTorch model, None for ONNX backends
+        self.model = getattr(self.backend, 'model', None)
+        self._labels = None
+        self.padding_stats = PaddingStats()
+        self.cache = cache
+        self.model_id = self._model_identity()
+        self.line_index = line_index
+        if line_index is not None and line_index.meta.get('model') not in (None, self.model_id):
+            logging.warning(f"Line index was built with model {line_index.meta['model']}, not {self.model_id}")
 
-    def predict(self, utt: str) -> Mapping[str, float]:
+    def _model_identity(self) -> str:
+        """
+        Identify the loaded model by its path, configuration, weight files and backend so cached
+        predictions are not reused after the model changes.
+        """
+        identity = [self.model_path, self.config.to_json_string(), self.backend.name]
+        if os.path.isdir(self.model_path):
+            for name in sorted(os.listdir(self.model_path)):
+                stat = os.stat(os.path.join(self.model_path, name))
+                identity.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+        return PredictionCache.make_key('', *identity)
+
+    @property
+    def labels(self) -> np.ndarray:
+        """
+        Principal names ordered by their label index.
+        """
+        if self._labels is None:
+            id2label = self.config.id2label
+            self._labels = np.array(
+                [id2label[i] for i in range(self.config.num_labels)], dtype=object)
+        return self._labels
+
+    def predict(self, utt: str, top_k: Optional[int] = None, min_prob: Optional[float] = None) -> Mapping[str, float]:
         """
         Given an utterance text return the predicted probabilities of what actors said it.
         :param utt: str
             The utterance text to classify.
+        :param top_k: int, optional
+            Only return the `top_k` most probable principals, see `predict_batch`.
+        :param min_prob: float, optional
+            Leave principals less probable than `min_prob` out.
         :return:
             Mapping[str, float]
             A mapping between each principal and their softmax probabilities in the model.
         """
-        # Tokenize Ids
-        input_ids, attention_mask = self.tokenizer([utt], **TOKENIZER_ARGS_DEFAULT).values()
-
-        # Send to backend
-        input_ids = torch.tensor(input_ids).to(self.device)
-        attention_mask = torch.tensor(attention_mask).to(self.device)
-
-        # Predict Principal
-        predicted_output = self.model(input_ids, attention_mask)
-        predicted_output = torch.softmax(predicted_output[0].squeeze(), dim=0)
-
-        # Extract prediction and beautify
-        predicted_output = predicted_output.cpu().detach().tolist()
-        predicted_output = {
-            self.model.config.id2label[i]: v
-            for i, v in enumerate(predicted_output)
-        }
-        predicted_output = {
-            k: v for k, v in sorted(
-                predicted_output.items(), key=lambda x: x[1],
-                reverse=True)
-        }
-
-        return predicted_output
+        return self.predict_batch([utt], top_k=top_k, min_prob=min_prob)[0]
+
+    def predict_batch(self, utterances: Sequence[str], batch_size: int = BATCH_SIZE_DEFAULT,
+                      top_k: Optional[int] = None, as_numpy: bool = False, min_prob: Optional[float] = None
+                      ) -> Union[List[Mapping[str, float]], Tuple[np.ndarray, np.ndarray]]:
+        """
+        Given a sequence of utterance texts return the predicted probabilities of what actors said them.
+        Utterances are sorted by token length and scored `batch_size` at a time, each batch padded to
+        its longest member, so little compute is spent on pad tokens. See `padding_stats` for the savings.
+        :param utterances: Sequence[str]
+            The utterance texts to classify.
+        :param batch_size: int, default BATCH_SIZE_DEFAULT
+            Number of utterances per forward pass.
+        :param top_k: int, optional
+            Only return the `top_k` most probable principals per utterance. Defaults to all principals.
+            The selection happens on the output tensors, and models with a two-level head only score the
+            principals of their most probable clusters.
+        :param as_numpy: bool, default False
+            Whether to return compact arrays instead of mappings.
+        :param min_prob: float, optional
+            Leave principals less probable than `min_prob` out of the mappings. Ignored with `as_numpy`.
+        :return:
+            List[Mapping[str, float]] or Tuple[np.ndarray, np.ndarray]
+            One mapping per utterance between principals and their softmax probabilities, sorted by
+            descending probability. If `as_numpy` a tuple of (probabilities, label indices) arrays
+            of shape (n_utterances, top_k) is returned instead, see `labels` for the index names.
+            Mappings may be shared with the prediction cache and should not be mutated.
+        """
+        if self.cache is None or as_numpy:
+            return self._predict_batch(utterances, batch_size, top_k, as_numpy, min_prob)
+
+        # Look up cached predictions and only run the model on unique missing utterances
+        utterances = list(utterances)
+        predictions = [self.cached_prediction(utt, top_k, min_prob) for utt in utterances]
+        missing = {}
+        for i, prediction in enumerate(predictions):
+            if prediction is None:
+                missing.setdefault(utterances[i], []).append(i)
+        if missing:
+            predicted = self._predict_batch(list(missing), batch_size, top_k, as_numpy, min_prob)
+            for (utt, indices), prediction in zip(missing.items(), predicted):
+                self.cache.put(self._cache_key(utt, top_k, min_prob), prediction)
+                for i in indices:
+                    predictions[i] = prediction
+        return predictions
+
+    def cached_prediction(self, utt: str, top_k: Optional[int] = None, min_prob: Optional[float] = None,
+                          memory_only: bool = False) -> Optional[Mapping[str, float]]:
+        """
+        Return the cached prediction for an utterance without running the model.
+        :param utt: str
+            The sanitized utterance text.
+        :param top_k: int, optional
+            The `top_k` the prediction was made with.
+        :param min_prob: float, optional
+            The `min_prob` the prediction was made with.
+        :param memory_only: bool, default False
+            Whether to only look the in-memory cache up, see `PredictionCache.peek`. Misses are then left to be
+            counted by the `predict_batch` that follows.
+        :return:
+            Mapping[str, float] or None
+            The cached prediction, or None if there is no cache or the utterance is not cached.
+        """
+        if self.cache is None:
+            return None
+        key = self._cache_key(utt, top_k, min_prob)
+        return self.cache.peek(key) if memory_only else self.cache.get(key)
+
+    def _cache_key(self, utt: str, top_k: Optional[int], min_prob: Optional[float]) -> str:
+        # Keys of predictions without `min_prob` are unchanged, so persisted caches stay valid
+        if min_prob is None:
+            return self.cache.make_key(utt, self.model_id, top_k)
+        return self.cache.make_key(utt, self.model_id, top_k, min_prob)
+
+    def embed(self, utterances: Sequence[str], batch_size: int = BATCH_SIZE_DEFAULT) -> np.ndarray:
+        """
+        Compute the `[CLS]` embeddings the classifier head consumes.
+        :param utterances: Sequence[str]
+            The utterance texts.
+        :param batch_size: int, default BATCH_SIZE_DEFAULT
+            Number of utterances per forward pass.
+        :return:
+            np.ndarray
+            float32 embeddings of shape (n_utterances, dim).
+        """
+        utterances = [str(utt) for utt in utterances]
+        input_ids = self.tokenizer(utterances, **TOKENIZER_ARGS_UNPADDED)['input_ids'] if utterances else []
+        lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+        embeddings = np.empty((len(input_ids), self.config.dim), dtype=np.float32)
+        for batch, batch_embeddings in self._forward_batches(
+                input_ids.__getitem__, length_sorted_batches(lengths, batch_size), self.backend.embed):
+            embeddings[batch] = batch_embeddings.float().cpu().numpy()
+        return embeddings
+
+    def similar_lines(self, utt: str, k: int = SIMILAR_LINES_DEFAULT,
+                      nprobe: int = LINE_INDEX_NPROBE_DEFAULT) -> List[Dict[str, Any]]:
+        """
+        Given an utterance text return the most similar movie lines from the line index.
+        :param utt: str
+            The utterance text to search for.
+        :param k: int, default SIMILAR_LINES_DEFAULT
+            Number of lines to return.
+        :param nprobe: int, default LINE_INDEX_NPROBE_DEFAULT
+            Number of index lists to scan, see `LineIndex.search`.
+        :return:
+            List[Dict[str, Any]]
+            The lines with their principal, character, title, year and cosine similarity,
+            most similar first.
+        """
+        if self.line_index is None:
+            raise RuntimeError("No line index loaded, build one with `python -m movie_prediction.search`")
+        scores, ids = self.line_index.search(self.embed([utt]), k=k, nprobe=nprobe)
+        lines = self.line_index.lines.iloc[ids[0]]
+        lines = lines[[col for col in SIMILAR_LINE_COLS if col in lines]].assign(**{SIMILARITY: scores[0]})
+        return lines.to_dict('records')
+
+    def predict_tokenized(self, dataset: TokenizedDataset, batch_size: int = BATCH_SIZE_DEFAULT,
+                          top_k: Optional[int] = None, as_numpy: bool = True
+                          ) -> Union[List[Mapping[str, float]], Tuple[np.ndarray, np.ndarray]]:
+        """
+        Score a pre-tokenized dataset, see `movie_prediction.tokenized.pretokenize`, without tokenizing again.
+        Items are batched by token length like in `predict_batch`.
+        :param dataset: TokenizedDataset
+            The pre-tokenized utterances, tokenized with this wrapper's tokenizer.
+        :param batch_size: int, default BATCH_SIZE_DEFAULT
+            Number of utterances per forward pass.
+        :param top_k: int, optional
+            Only return the `top_k` most probable principals per utterance. Defaults to all principals.
+        :param as_numpy: bool, default True
+            Whether to return compact arrays instead of mappings.
+        :return:
+            List[Mapping[str, float]] or Tuple[np.ndarray, np.ndarray]
+            See `predict_batch`.
+        """
+        return self._predict_token_ids(dataset.token_ids, dataset.lengths, batch_size, top_k, as_numpy)
+
+    def _predict_batch(self, utterances: Sequence[str], batch_size: int, top_k: Optional[int], as_numpy: bool,
+                       min_prob: Optional[float] = None
+                       ) -> Union[List[Mapping[str, float]], Tuple[np.ndarray, np.ndarray]]:
+        # Tokenize Ids without padding
+        utterances = list(utterances)
+        with STAGE_SECONDS.time(stage='tokenize'):
+            input_ids = self.tokenizer(utterances, **TOKENIZER_ARGS_UNPADDED)['input_ids'] if utterances else []
+        lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+        return self._predict_token_ids(input_ids.__getitem__, lengths, batch_size, top_k, as_numpy, min_prob)
+
+    def _forward_batches(self, token_ids: Callable[[int], Sequence[int]], batches: Sequence[np.ndarray],
+                         forward: Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+                         ) -> Iterator[Tuple[np.ndarray, torch.Tensor]]:
+        with torch.inference_mode():
+            for batch in batches:
+                # Pad to the longest utterance of the batch and send to backend
+                with STAGE_SECONDS.time(stage='pad'):
+                    batch_ids, attention_mask = pad_sequences(
+                        [token_ids(i) for i in batch], self.tokenizer.pad_token_id)
+                with STAGE_SECONDS.time(stage='to_device'):
+                    batch_ids, attention_mask = batch_ids.to(self.device), attention_mask.to(self.device)
+                with STAGE_SECONDS.time(stage='forward'):
+                    outputs = forward(batch_ids, attention_mask)
+                yield batch, outputs
+
+    def _predict_token_ids(self, token_ids: Callable[[int], Sequence[int]], lengths: np.ndarray, batch_size: int,
+                           top_k: Optional[int], as_numpy: bool, min_prob: Optional[float] = None
+                           ) -> Union[List[Mapping[str, float]], Tuple[np.ndarray, np.ndarray]]:
+        num_labels = self.config.num_labels
+        k = num_labels if top_k is None else max(1, min(top_k, num_labels))
+        top_probs = np.empty((len(lengths), k), dtype=np.float32)
+        top_indices = np.empty((len(lengths), k), dtype=np.int64)
+
+        if len(lengths):
+            # Batch utterances of similar length together
+            batches = length_sorted_batches(lengths, batch_size)
+            self.padding_stats.update(lengths, batches, batch_size)
+            INPUT_TOKENS.observe_many(lengths)
+            PREDICTED_UTTERANCES.inc(len(lengths))
+
+            # Two-level heads only score the labels of likely clusters when not all labels are requested
+            sparse = top_k is not None and getattr(self.backend, 'hierarchical', False)
+            forward = partial(self.backend.top_k, k=k) if sparse else self.backend
+            for batch, outputs in self._forward_batches(token_ids, batches, forward):
+                # Predict Principals, keep the most probable ones and restore the input order
+                with STAGE_SECONDS.time(stage='softmax'):
+                    if sparse:
+                        probs, indices = outputs
+                    else:
+                        probs, indices = torch.topk(torch.softmax(outputs.float(), dim=-1), k, dim=-1)
+                    top_probs[batch] = probs.cpu().numpy()
+                    top_indices[batch] = indices.cpu().numpy()
+
+        if as_numpy:
+            return top_probs, top_indices
+
+        # Beautify
+        with STAGE_SECONDS.time(stage='postprocess'):
+            labels = self.labels
+            if min_prob is not None:
+                # Probabilities are sorted, so the kept principals are a prefix of every row
+                counts = (top_probs >= min_prob).sum(axis=1).tolist()
+                return [
+                    dict(zip(labels[indices[:count]], probs[:count]))
+                    for probs, indices, count in zip(top_probs.tolist(), top_indices, counts)
+                ]
+            return [
+                dict(zip(labels[indices], probs))
+                for probs, indices in zip(top_probs.tolist(), top_indices)
+            ]
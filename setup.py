@@ -13,7 +13,17 @@ setup(
     ),
     python_requires='>=python3.7',
     install_requires=[
-        'seaborn', 'transformers', 'pandas', 'umap-learn',
-        'fastapi[all]', 'tqdm', 'streamlit'
-    ]
+        'torch', 'transformers', 'safetensors', 'numpy', 'pandas', 'pyarrow'
+    ],
+    entry_points={
+        'console_scripts': [
+            'movie-prediction-score=movie_prediction.scoring:main',
+        ],
+    },
+    extras_require={
+        'serve': ['fastapi', 'uvicorn[standard]'],
+        'app': ['streamlit'],
+        'notebook': ['seaborn', 'matplotlib', 'umap-learn', 'tqdm', 'scikit-learn', 'datasets', 'accelerate'],
+        'onnx': ['onnx', 'onnxruntime'],
+    }
 )
\ No newline at end of file
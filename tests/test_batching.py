@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+from movie_prediction.batching import MicroBatcher
+
+
+def test_batches_concurrent_requests():
+    async def run():
+        batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=8, max_wait_ms=50)
+        await batcher.start()
+        results = await asyncio.gather(*[batcher.submit(i) for i in range(5)])
+        await batcher.stop()
+        return results, batcher.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == [0, 2, 4, 6, 8]
+    assert stats['batches'] == 1
+
+
+def test_stop_fails_requests_of_a_partial_batch():
+    async def run():
+        batcher = MicroBatcher(lambda items: items, max_batch_size=8, max_wait_ms=60000)
+        await batcher.start()
+        request = asyncio.ensure_future(batcher.submit('waiting'))
+        # Let the worker take the request off the queue and wait for more
+        await asyncio.sleep(0.05)
+        await batcher.stop()
+        return await asyncio.wait_for(request, 1)
+
+    with pytest.raises(RuntimeError, match="Batcher stopped"):
+        asyncio.run(run())
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from movie_prediction.cache import PredictionCache
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def cache(request, tmp_path):
+    cache = PredictionCache(disk_path=str(tmp_path / 'cache.sqlite') if request.param == 'disk' else None)
+    yield cache
+    cache.close()
+
+
+def test_peek_leaves_misses_to_get(cache):
+    key = cache.make_key('HELLO THERE', 'model')
+    assert cache.peek(key) is None
+    assert cache.get(key) is None
+    cache.put(key, {'JOHN DOE': 1.0})
+    assert cache.peek(key) == {'JOHN DOE': 1.0}
+    stats = cache.stats()
+    assert (stats['hits'], stats['disk_hits'], stats['misses']) == (1, 0, 1)
+
+
+def test_peek_does_not_read_disk(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    key = PredictionCache.make_key('HELLO THERE', 'model')
+    writer = PredictionCache(disk_path=path)
+    writer.put(key, {'JOHN DOE': 1.0})
+    writer.close()
+
+    cache = PredictionCache(disk_path=path)
+    assert cache.peek(key) is None
+    assert cache.get(key) == {'JOHN DOE': 1.0}
+    assert cache.peek(key) == {'JOHN DOE': 1.0}
+    stats = cache.stats()
+    assert (stats['hits'], stats['disk_hits'], stats['misses']) == (1, 1, 0)
+    cache.close()
+
+
+def test_service_counts_a_miss_then_a_hit_once(tmp_path, monkeypatch):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    from benchmarks.tiny_model import write_tiny_model
+
+    monkeypatch.setenv('PRINCIPAL_MODEL_PATH', write_tiny_model(str(tmp_path / 'model')))
+    monkeypatch.setenv('PRINCIPAL_LINE_INDEX', str(tmp_path / 'missing-index'))
+    import main
+
+    with TestClient(main.app) as client:
+        deadline = time.monotonic() + 60
+        while client.get('/ready').status_code == 503 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        main.prediction_cache.clear()
+        main.prediction_cache.hits = main.prediction_cache.misses = 0
+        first = client.get('/principal-prediction', params={'text': 'where is the car'})
+        second = client.get('/principal-prediction', params={'text': 'where is the car'})
+        stats = client.get('/cache-stats').json()
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert (stats['hits'], stats['misses']) == (1, 1)
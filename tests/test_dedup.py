@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_utterances
+from movie_prediction.constants import UTTERANCE, CLUSTER_ID, CLUSTER_SIZE
+from movie_prediction.dedup import near_duplicate_clusters, deduplicate_lines
+
+
+def test_bucket_members_link_past_a_dissimilar_first_member():
+    # All three share the first band, only the last two are similar and they share no other band
+    signatures = np.array([
+        [1, 2, 0, 0, 0, 0],
+        [1, 2, 3, 4, 5, 6],
+        [1, 2, 3, 9, 5, 8],
+    ], dtype=np.uint32)
+    clusters = near_duplicate_clusters(signatures, bands=3, threshold=0.5)
+    assert clusters.tolist() == [0, 1, 1]
+
+
+def test_cluster_ids_follow_first_lines():
+    texts = synthetic_utterances(50, seed=3)
+    lines = pd.DataFrame({UTTERANCE: texts + [text.lower() + '!' for text in texts[::5]]})
+    lines = deduplicate_lines(lines)
+    clusters = lines[CLUSTER_ID].values
+    assert clusters.tolist() == pd.factorize(clusters)[0].tolist()
+    assert (lines[CLUSTER_SIZE].values[50:] >= 2).all()
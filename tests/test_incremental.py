@@ -0,0 +1,63 @@
+import os
+
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import write_raw_data
+from movie_prediction.constants import CORNELL_LINES_FILE
+from movie_prediction.data_loaders.incremental import build_principal_movie_lines
+
+# Columns of the raw lines file
+_LINE, _MOVIE, _UTTERANCE = 0, 2, 4
+
+
+def _read_lines(data_dir: str) -> pd.DataFrame:
+    return pd.read_csv(os.path.join(data_dir, CORNELL_LINES_FILE), sep='\t', header=None, dtype=str,
+                       keep_default_na=False)
+
+
+def _write_lines(lines: pd.DataFrame, data_dir: str):
+    lines.to_csv(os.path.join(data_dir, CORNELL_LINES_FILE), sep='\t', header=False, index=False)
+
+
+def _removed(lines, movie):
+    return lines[lines[_MOVIE] != movie]
+
+
+def _changed(lines, movie):
+    lines = lines.copy()
+    is_movie = lines[_MOVIE] == movie
+    lines.loc[is_movie, _UTTERANCE] = lines.loc[is_movie, _UTTERANCE].str.upper() + ' again'
+    return lines
+
+
+def _interleaved(lines, movie):
+    # Lines of an existing movie appended in the middle and at the end of the file
+    extra = lines[lines[_MOVIE] == movie].head(20).copy()
+    extra[_LINE] = [f'LX{i}' for i in range(len(extra))]
+    middle = len(lines) // 2
+    return pd.concat([lines.iloc[:middle], extra.iloc[:10], lines.iloc[middle:], extra.iloc[10:]])
+
+
+@pytest.mark.parametrize('before, after', [
+    (None, _removed),
+    (_removed, None),
+    (None, _changed),
+    (None, _interleaved),
+    (_interleaved, _changed),
+], ids=['removed', 'new', 'changed', 'interleaved', 'interleaved-changed'])
+def test_incremental_build_matches_full_build(tmp_path, before, after):
+    data_dir = write_raw_data(str(tmp_path / 'data'), 3000, lines_per_movie=100, seed=1)
+    lines = _read_lines(data_dir)
+    movie = lines[_MOVIE].unique()[3]
+    incremental_fp, full_fp = str(tmp_path / 'incremental.tsv'), str(tmp_path / 'full.tsv')
+
+    _write_lines(before(lines, movie) if before else lines, data_dir)
+    build_principal_movie_lines(incremental_fp, data_dir)
+    _write_lines(after(lines, movie) if after else lines, data_dir)
+    stats = build_principal_movie_lines(incremental_fp, data_dir)
+    build_principal_movie_lines(full_fp, data_dir, full=True)
+
+    assert stats['changed_movies'] + stats['removed_movies'] == 1
+    with open(incremental_fp, 'rb') as incremental_file, open(full_fp, 'rb') as full_file:
+        assert incremental_file.read() == full_file.read()
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from movie_prediction.constants import UTTERANCE
+from movie_prediction.search import LineIndex
+
+
+@pytest.fixture
+def index():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((50, 8)).astype(np.float32)
+    return LineIndex(vectors, pd.DataFrame({UTTERANCE: [f'line {i}' for i in range(50)]}))
+
+
+@pytest.mark.parametrize('k', [0, -2])
+def test_search_rejects_non_positive_k(index, k):
+    with pytest.raises(ValueError):
+        index.search(np.ones(8, dtype=np.float32), k=k)
+
+
+def test_search_caps_k_at_index_size(index):
+    scores, ids = index.search(np.ones(8, dtype=np.float32), k=80)
+    assert scores.shape == ids.shape == (1, 50)
+    assert np.all(np.diff(scores[0]) <= 0)
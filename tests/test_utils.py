@@ -0,0 +1,65 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from movie_prediction import utils
+from movie_prediction.utils import sanitize_string, sanitize_string_column, extract_names, extract_names_column
+
+UTTERANCES = [
+    '', ' ', 'hello world', '  Hello,  World!  ', '...leading', 'trailing!!!', '!?', "don't STOP -- me now",
+    'Café crème brûlée', 'straße', 'ÉCOLE ñandú', 'ﬁne ligature', 'ǆungla', 'Ωmega 42',
+    'tab\tseparated\twords', 'no\xa0break\xa0space', 'new\nline\r\nend\n', '　ideographic　space　',
+    'line separator', '\x0bvertical\x0cfeed\x1c', 'mixed \t\xa0\n runs', None, np.nan,
+]
+NAMES = [
+    '', 'CHER', 'TOM HANKS', 'MARY ANN SMITH', 'JOHN PAUL GEORGE RINGO', 'A B C D E F',
+    'MR TOM HANKS', 'LT DAN', 'MISS MARPLE', 'MRS ROBINSON', 'MS ANN LEE', 'MRS MR SMITH', 'MISSY ELLIOTT',
+    'LTD', 'MRMR', None,
+]
+FLAGS = list(itertools.product([False, True], repeat=4))
+
+
+@pytest.fixture(params=['arrow', 'fallback'])
+def path(request, monkeypatch):
+    if request.param == 'fallback':
+        monkeypatch.setattr(utils, '_sanitize_arrow', lambda *args: None)
+        monkeypatch.setattr(utils, '_extract_names_arrow', lambda *args: None)
+    return request.param
+
+
+def assert_same(actual, expected):
+    assert len(actual) == len(expected)
+    for i, (got, want) in enumerate(zip(actual, expected)):
+        if want is None or (isinstance(want, float) and np.isnan(want)):
+            assert pd.isna(got), f"element {i}: expected missing, got {got!r}"
+        else:
+            assert got == want, f"element {i}: expected {want!r}, got {got!r}"
+
+
+@pytest.mark.parametrize('upper, alphanumeric_only, strip, whitespace', FLAGS)
+def test_sanitize_string_column_matches_sanitize_string(path, upper, alphanumeric_only, strip, whitespace):
+    series = pd.Series(UTTERANCES, dtype=object)
+    flags = dict(upper=upper, alphanumeric_only=alphanumeric_only, strip=strip, whitespace=whitespace)
+    expected = series.map(lambda text: sanitize_string(text, **flags), na_action='ignore')
+    sanitized = sanitize_string_column(series, **flags)
+    assert sanitized.index.equals(series.index)
+    assert_same(list(sanitized), list(expected))
+
+
+def test_sanitize_string_column_keeps_index_and_name(path):
+    series = pd.Series(['a, b', 'C'], index=[7, 3], name='Utterance', dtype=object)
+    sanitized = sanitize_string_column(series, upper=True, alphanumeric_only=True, strip=True, whitespace=True)
+    assert sanitized.name == 'Utterance'
+    assert list(sanitized.index) == [7, 3]
+    assert list(sanitized) == ['A B', 'C']
+
+
+def test_extract_names_column_matches_extract_names(path):
+    series = pd.Series(NAMES, index=range(10, 10 + len(NAMES)), dtype=object)
+    columns = extract_names_column(series)
+    expected = [extract_names(name) if isinstance(name, str) else (None,) * 4 for name in NAMES]
+    for i, column in enumerate(columns):
+        assert column.index.equals(series.index)
+        assert_same(list(column), [names[i] for names in expected])